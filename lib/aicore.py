@@ -0,0 +1,63 @@
+########################################################################################################################
+# SAP AI Core helpers
+#
+# use the following methods:
+# aicore_credentials()     ==> get one credential for each running deployment, e.g., to execute API requests against
+#                              the OpenAI models deployed in SAP AI Core with `openai_execute(...)`
+#
+# configure the service key with the environment variables `AICORE_AUTH_URL`, `AICORE_CLIENT_ID`,
+# `AICORE_CLIENT_SECRET`, `AICORE_BASE_URL`, and `AICORE_RESOURCE_GROUP`
+########################################################################################################################
+
+import logging
+import os
+
+import requests
+
+from lib.openai import Credential
+
+logger = logging.getLogger(__name__)
+
+_api_version = "2023-05-15"
+_default_resource_group = "default"
+_model_names = {  # AI Core deploys OpenAI models under the names of Azure OpenAI
+    "gpt-3.5-turbo-1106": "gpt-35-turbo",
+    "gpt-4-0613": "gpt-4"
+}
+
+
+def aicore_credentials() -> list[Credential]:
+    """Get one credential for each running deployment of an OpenAI model in SAP AI Core.
+
+    Returns:
+        The list of credentials, each of which serves the models whose names match the deployed model.
+    """
+    auth_url = os.environ["AICORE_AUTH_URL"].rstrip("/")
+    base_url = os.environ["AICORE_BASE_URL"].rstrip("/")
+    resource_group = os.environ.get("AICORE_RESOURCE_GROUP", _default_resource_group)
+
+    http_response = requests.post(f"{auth_url}/oauth/token", data={"grant_type": "client_credentials"},
+                                  auth=(os.environ["AICORE_CLIENT_ID"], os.environ["AICORE_CLIENT_SECRET"]))
+    http_response.raise_for_status()
+    token = http_response.json()["access_token"]
+
+    http_response = requests.get(f"{base_url}/v2/lm/deployments", params={"status": "RUNNING"},
+                                 headers={"Authorization": f"Bearer {token}", "AI-Resource-Group": resource_group})
+    http_response.raise_for_status()
+
+    credentials = []
+    for deployment in http_response.json()["resources"]:
+        deployed_model = deployment.get("details", {}).get("resources", {}).get("backend_details", {}).get("model", {})
+        models = [model for model, name in _model_names.items() if name == deployed_model.get("name")]
+        if len(models) == 0 or deployment.get("deploymentUrl") is None:
+            continue
+        credentials.append(Credential(
+            base_url=deployment["deploymentUrl"],
+            api_key=token,
+            name=f"aicore-{deployment['id']}",
+            headers={"AI-Resource-Group": resource_group},
+            params={"api-version": _api_version},
+            models=models
+        ))
+    logger.info(f"Found {len(credentials)} deployments of OpenAI models in SAP AI Core.")
+    return credentials
@@ -0,0 +1,891 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import pathlib
+import random
+import re
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from typing import Callable, Iterable, Iterator
+
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+_index_dir_name = "index"
+_index_file_name = "index.sqlite3"
+_index_schema_version = 4
+_index_busy_timeout = 60.0  # seconds that a process waits for another process to finish writing to the index
+_segments_dir_name = "segments"
+_leases_dir_name = "leases"
+_lease_write_timeout = 60.0
+_cache_file_name_pattern = re.compile(r"^(.+)-([0-9a-f]{64})\.json$")
+_segment_file_name_pattern = re.compile(r"^(\d+)\.seg$")
+_dictionary_file_name_pattern = re.compile(r"^dict-(\d+)\.zstd$")
+_timestamp_format = "%Y-%m-%d-%H-%M-%S-%f"
+_max_pending_accesses = 1_000
+_eviction_chunk_size = 1_000
+_lookup_chunk_size = 500  # below SQLite's limit on the number of parameters of a statement
+
+# segment records: magic, raw request hash, creation timestamp, dictionary id (0 for none), payload length, payload
+_record_header = struct.Struct(">2s32s26sII")
+_record_magic = b"RC"
+_segment_max_bytes = 64_000_000
+_compaction_dead_ratio = 0.5
+_compression_level = 3
+_dictionary_size = 112_640
+_dictionary_min_samples = 256
+_dictionary_max_samples = 2_000
+_dictionary_random = random.Random(280536931)
+
+
+class ResponseCache:
+    """Persistent cache of request-response pairs keyed by request hash.
+
+    Pairs are stored in one of two layouts, which can be mixed within one cache directory:
+
+    * `files`: each pair is a timestamped JSON file `<timestamp>-<hash>.json` in the cache directory, which is the
+      layout of `openai_cache.zip`
+    * `segments`: pairs are appended as zstd-compressed records to segment files in the `segments` subdirectory; the
+      records are compressed with a dictionary that is trained on the cached pairs, since the prompts are very
+      repetitive
+
+    An SQLite index in the `index` subdirectory maps each request hash to its file or to its segment and offset, so that
+    lookups do not have to scan the directory. The index is (re)built automatically whenever the cache directory has
+    been modified by someone other than the cache itself (e.g., after unpacking `openai_cache.zip`), which is detected
+    via the modification time of the directory.
+
+    The index also tracks the size and the last access of each pair. When the cache exceeds its entry-count or
+    byte-size limit, the least recently used pairs are evicted, except for pinned pairs, which are never evicted.
+    Evicted records remain in their segments until compaction rewrites segments with many dead records.
+
+    Several processes can share the cache directory. The index is written in WAL mode, so that readers never block,
+    and every change to it is a transaction that takes the write lock right away, so that the entry count and byte size
+    that eviction is based on are consistent across processes. Each process appends to segments of its own, which it
+    owns until it closes the cache (or dies), and only segments without owner are compacted. Pairs are written before
+    they are added to the index and files are written to a temporary file that is renamed, so that no process reads a
+    partially written pair. Processes can also coalesce identical requests with lease files in the `leases`
+    subdirectory: only the process that holds the lease for a request hash executes the request, while the others wait
+    for the response to appear in the cache.
+    """
+    path: pathlib.Path
+    max_entries: int | None
+    max_bytes: int | None
+    storage: str
+
+    def __init__(
+            self,
+            path: pathlib.Path,
+            *,
+            max_entries: int | None = None,
+            max_bytes: int | None = None,
+            storage: str = "segments"
+    ) -> None:
+        """Open the cache.
+
+        Args:
+            path: The cache directory.
+            max_entries: The maximum number of cached pairs or None for no limit.
+            max_bytes: The maximum total size of the cached pairs in bytes or None for no limit.
+            storage: The layout in which new pairs are stored, either `files` or `segments`.
+        """
+        if storage not in ("files", "segments"):
+            raise AssertionError(f"Unknown cache storage '{storage}'!")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.storage = storage
+        self._lock = threading.RLock()
+        self._pending_accesses = {}
+        self._segment_readers = {}
+        self._segment_writer = None  # (segment id, file) of the segment to which this process appends
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._compressors = {}
+        self._decompressors = {}
+        self._compaction_thread = None
+        self._leases = set()
+        os.makedirs(self.path / _index_dir_name, exist_ok=True)
+        os.makedirs(self.path / _segments_dir_name, exist_ok=True)
+        os.makedirs(self.path / _leases_dir_name, exist_ok=True)
+        self._load_dictionaries()
+        # transactions are explicit, see `_transaction`
+        self._connection = sqlite3.connect(self.path / _index_dir_name / _index_file_name, timeout=_index_busy_timeout,
+                                           isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        with self._transaction():
+            if self._create_index():
+                self._scan_segments()
+            self._release_segments_of_dead_processes()
+        self._sync_index()
+
+    def get(self, request_hash: str) -> dict | None:
+        """Load the cached pair for the given request hash.
+
+        Args:
+            request_hash: The hash of the request.
+
+        Returns:
+            The cached pair (a dictionary with `request` and `response`) or None if there is no cached pair.
+        """
+        with self._lock:
+            # a compaction in another process may have moved the pair since it was looked up, so look it up again
+            for attempt in range(2):
+                row = self._connection.execute("SELECT file, segment, offset, size FROM entries WHERE hash = ?",
+                                               (request_hash,)).fetchone()
+                if row is None:
+                    return None
+                try:
+                    pair = self._load_pair(*row)
+                    break
+                except FileNotFoundError:
+                    if attempt == 1:
+                        logger.warning(f"Cached pair '{request_hash}' vanished and will be removed from the index.")
+                        with self._transaction():
+                            self._connection.execute(
+                                "DELETE FROM entries WHERE hash = ? AND file IS ? AND segment IS ? AND offset IS ?",
+                                (request_hash, *row[:3]))
+                        return None
+
+            self._pending_accesses[request_hash] = time.time()
+            if len(self._pending_accesses) >= _max_pending_accesses:
+                self._flush_accesses()
+            return pair
+
+    def get_first(self, request_hashes: list[str]) -> dict | None:
+        """Load the cached pair for the first of the given request hashes that is cached, e.g., for the hash of a
+        request and its legacy hash.
+
+        Args:
+            request_hashes: The hashes of the request in the order of preference.
+
+        Returns:
+            The cached pair or None if there is no cached pair for any of the hashes.
+        """
+        for request_hash in request_hashes:
+            pair = self.get(request_hash)
+            if pair is not None:
+                return pair
+        return None
+
+    def put(self, request_hash: str, pair: dict, *, created: str | None = None) -> None:
+        """Store the pair for the given request hash and evict pairs if the cache exceeds its limits.
+
+        Args:
+            request_hash: The hash of the request.
+            pair: The pair (a dictionary with `request` and `response`) to store.
+            created: An optional creation timestamp, which defaults to now.
+        """
+        created = datetime.datetime.now().strftime(_timestamp_format) if created is None else created
+        content = json.dumps(pair)
+        with self._lock:
+            with self._transaction():
+                if request_hash in self:
+                    # keep the oldest pair for each hash, which is the one that a directory scan would find first
+                    return
+                if self.storage == "files":
+                    file_name = f"{created}-{request_hash}.json"
+                    # the temporary file does not match the pattern of cache files, so a directory scan ignores it
+                    temporary_path = self.path / f".{file_name}.{os.getpid()}.tmp"
+                    with open(temporary_path, "w", encoding="utf-8") as file:
+                        file.write(content)
+                    os.replace(temporary_path, self.path / file_name)
+                    size = os.stat(self.path / file_name).st_size
+                    location = (file_name, None, None, None)
+                else:
+                    segment_id, offset, size, dictionary_id = self._append_record(request_hash, created, content)
+                    location = (None, segment_id, offset, dictionary_id)
+                self._connection.execute(
+                    "INSERT INTO entries (hash, created, file, segment, offset, dictionary, size, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (request_hash, created, *location, size, time.time()))
+                if self.storage == "files":
+                    self._store_directory_mtime()
+            if self._exceeds_limits():
+                self.evict()
+
+    def pin(self, request_hashes: Iterable[str], pinned: bool = True) -> None:
+        """Pin (or unpin) the cached pairs for the given request hashes so that they are never evicted.
+
+        Args:
+            request_hashes: The hashes of the requests.
+            pinned: Whether to pin or unpin the pairs.
+        """
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany("UPDATE entries SET pinned = ? WHERE hash = ?",
+                                             ((int(pinned), h) for h in request_hashes))
+
+    def evict(self) -> None:
+        """Evict the least recently used pairs that are not pinned until the cache is within its limits.
+
+        The eviction is a single transaction on the index, so that concurrent processes do not evict on the basis of
+        outdated sizes, and files are only removed once they are no longer in the index.
+        """
+        with self._lock:
+            self._flush_accesses()
+            if not self._exceeds_limits():
+                return
+            file_names = []
+            with self._transaction():
+                num_entries, num_bytes = self._get_stats()
+                if not self._exceeds_limits():
+                    return  # another process has evicted in the meantime
+                logger.warning(f"OpenAI cache is too large ({num_entries} pairs, {num_bytes} bytes) and will be "
+                               f"shrunk!")
+                while self._exceeds_limits():
+                    rows = self._connection.execute(
+                        "SELECT hash, file, segment, size FROM entries WHERE pinned = 0 ORDER BY last_access LIMIT ?",
+                        (_eviction_chunk_size,)).fetchall()
+                    if len(rows) == 0:
+                        logger.warning("OpenAI cache cannot be shrunk further since all remaining pairs are pinned!")
+                        break
+                    for request_hash, file_name, segment_id, size in rows:
+                        if not self._exceeds_limits():
+                            break
+                        self._remove_entry(request_hash, file_name, segment_id, size)
+                        if file_name is not None:
+                            file_names.append(file_name)
+            self._remove_files(file_names)
+
+    def rekey(self, compute_hash: Callable[[dict], str]) -> int:
+        """Store every pair under the hash that the given function computes for it, e.g., after the hashing scheme
+        has changed.
+
+        Pairs keep their creation time, last access, and pin. If a pair already exists under the new hash, the pair
+        under the old hash is dropped.
+
+        Args:
+            compute_hash: A function that computes the new hash of a pair.
+
+        Returns:
+            The number of pairs whose hash has changed.
+        """
+        with self._lock:
+            self._flush_accesses()
+            rows = self._connection.execute("SELECT hash FROM entries").fetchall()
+        num_rekeyed = 0
+        for request_hash, in rows:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT created, file, segment, offset, size, last_access, pinned FROM entries WHERE hash = ?",
+                    (request_hash,)).fetchone()
+                if row is None:
+                    continue
+                created, file_name, segment_id, offset, size, last_access, pinned = row
+                pair = self._load_pair(file_name, segment_id, offset, size)
+                new_hash = compute_hash(pair)
+                if new_hash == request_hash:
+                    continue
+                self.put(new_hash, pair, created=created)
+                with self._transaction():
+                    self._connection.execute(
+                        "UPDATE entries SET last_access = MAX(last_access, ?), pinned = MAX(pinned, ?) WHERE hash = ?",
+                        (last_access, pinned, new_hash))
+                    self._remove_entry(request_hash, file_name, segment_id, size)
+                if file_name is not None:
+                    self._remove_files([file_name])
+                num_rekeyed += 1
+        return num_rekeyed
+
+    def compact(self) -> None:
+        """Train a compression dictionary if there is none yet and rewrite segments with many dead records or with
+        records that were not compressed with the current dictionary.
+
+        Only segments that no process appends to are compacted. A segment is claimed in a short transaction, so that
+        concurrent compactions in other processes skip it, and its records are rewritten into a new segment without
+        holding the index. A second short transaction then moves the entries that still point to the old segment.
+        """
+        with self._lock:
+            self._flush_accesses()
+            self._load_dictionaries()  # another process may have trained a dictionary
+            if len(self._compressors) == 1:  # only the compressor without dictionary
+                self._train_dictionary()
+            dictionary_id = max(self._compressors.keys())
+            # segments without size are left behind by compactions of processes that died
+            candidates = [segment_id for segment_id, in self._connection.execute(
+                "SELECT id FROM segments WHERE owner IS NULL AND (dead >= size * ? OR EXISTS "
+                "(SELECT 1 FROM entries WHERE entries.segment = segments.id AND entries.dictionary != ?)) ORDER BY id",
+                (_compaction_dead_ratio, dictionary_id))]
+            if len(candidates) == 0:
+                return
+
+        logger.info(f"Compact {len(candidates)} segments of the OpenAI cache.")
+        # the compaction runs in the background and must not share the (not thread-safe) compressors of the cache
+        compressors, decompressors = self._read_dictionaries()
+        for segment_id in candidates:
+            self._compact_segment(segment_id, compressors, decompressors)
+
+    def start_compaction(self) -> None:
+        """Compact the cache in a background thread unless a compaction is already running."""
+        with self._lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+            self._compaction_thread.start()
+
+    def import_files(self, directory: pathlib.Path, *, remove: bool = False) -> int:
+        """Import pairs from a directory with the one-file-per-pair layout (e.g., an unpacked `openai_cache.zip`).
+
+        Args:
+            directory: The directory with the `<timestamp>-<hash>.json` files.
+            remove: Whether to remove the files after importing them.
+
+        Returns:
+            The number of imported pairs.
+        """
+        num_imported = 0
+        for file_name in sorted(os.listdir(directory)):
+            match = _cache_file_name_pattern.match(file_name)
+            if match is None:
+                continue
+            created, request_hash = match.groups()
+            with self._lock:
+                row = self._connection.execute("SELECT file FROM entries WHERE hash = ?", (request_hash,)).fetchone()
+                if row is not None and row[0] == file_name and directory.resolve() == self.path.resolve():
+                    # the file is part of this cache, so move the pair from the file into a segment
+                    with self._transaction():
+                        self._connection.execute("DELETE FROM entries WHERE hash = ?", (request_hash,))
+                    row = None
+                if row is None:
+                    with open(directory / file_name, "r", encoding="utf-8") as file:
+                        self.put(request_hash, json.load(file), created=created)
+                    num_imported += 1
+            if remove:
+                os.remove(directory / file_name)
+        with self._lock:
+            with self._transaction():
+                self._store_directory_mtime()
+        return num_imported
+
+    def export_files(self, directory: pathlib.Path) -> int:
+        """Export all pairs to a directory with the one-file-per-pair layout.
+
+        Args:
+            directory: The directory in which to create the `<timestamp>-<hash>.json` files.
+
+        Returns:
+            The number of exported pairs.
+        """
+        os.makedirs(directory, exist_ok=True)
+        num_exported = 0
+        with self._lock:
+            rows = self._connection.execute("SELECT hash, created FROM entries").fetchall()
+        for request_hash, created in rows:
+            pair = self.get(request_hash)
+            if pair is not None:
+                with open(directory / f"{created}-{request_hash}.json", "w", encoding="utf-8") as file:
+                    json.dump(pair, file)
+                num_exported += 1
+        return num_exported
+
+    def try_lease(self, request_hash: str, duration: float) -> bool:
+        """Try to acquire the lease for executing the request with the given hash.
+
+        The lease is a file that is created exclusively, so that at most one process holds it at a time. A lease that
+        has expired or whose process has died is broken.
+
+        Args:
+            request_hash: The hash of the request.
+            duration: The number of seconds after which the lease expires if it has not been released.
+
+        Returns:
+            Whether the lease has been acquired.
+        """
+        path = self._lease_path(request_hash)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._is_stale_lease(path):
+                    return False
+                logger.info(f"Break the stale lease for request '{request_hash}'.")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(), "expires": time.time() + duration}, file)
+            with self._lock:
+                self._leases.add(request_hash)
+            return True
+        return False
+
+    def release_lease(self, request_hash: str) -> None:
+        """Release the lease for executing the request with the given hash.
+
+        Args:
+            request_hash: The hash of the request.
+        """
+        with self._lock:
+            if request_hash in self._leases:
+                self._leases.remove(request_hash)
+                try:
+                    os.remove(self._lease_path(request_hash))
+                except FileNotFoundError:
+                    pass
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._get_stats()[0]
+
+    def __contains__(self, request_hash: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM entries WHERE hash = ?",
+                                            (request_hash,)).fetchone() is not None
+
+    def contains_many(self, request_hashes: Iterable[str]) -> set[str]:
+        """Determine which of the given request hashes are cached in one pass over the index.
+
+        Args:
+            request_hashes: The hashes of the requests.
+
+        Returns:
+            The hashes that are cached.
+        """
+        request_hashes = list(request_hashes)
+        cached_hashes = set()
+        with self._lock:
+            for start in range(0, len(request_hashes), _lookup_chunk_size):
+                chunk = request_hashes[start:start + _lookup_chunk_size]
+                rows = self._connection.execute(
+                    f"SELECT hash FROM entries WHERE hash IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+                cached_hashes.update(row[0] for row in rows)
+        return cached_hashes
+
+    def close(self) -> None:
+        """Wait for a running compaction, release all leases, persist the tracked accesses, and close the index and
+        segments."""
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        with self._lock:
+            for request_hash in list(self._leases):
+                self.release_lease(request_hash)
+            self._flush_accesses()
+            if self._segment_writer is not None:
+                with self._transaction():
+                    self._release_segment(self._segment_writer[0])
+                self._segment_writer[1].close()
+                self._segment_writer = None
+            for segment_id in list(self._segment_readers.keys()):
+                self._close_segment_reader(segment_id)
+            self._connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # take the write lock of the index right away, so that a concurrent writer waits for it (up to the busy timeout)
+        # instead of failing when it would have to upgrade a read lock
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def _get_stats(self) -> tuple[int, int]:
+        return self._connection.execute("SELECT num_entries, num_bytes FROM stats").fetchone()
+
+    def _exceeds_limits(self) -> bool:
+        num_entries, num_bytes = self._get_stats()
+        return (self.max_entries is not None and num_entries > self.max_entries) or (
+                self.max_bytes is not None and num_bytes > self.max_bytes)
+
+    def _flush_accesses(self) -> None:
+        if len(self._pending_accesses) > 0:
+            with self._transaction():
+                self._connection.executemany("UPDATE entries SET last_access = ? WHERE hash = ?",
+                                             ((t, h) for h, t in self._pending_accesses.items()))
+            self._pending_accesses = {}
+
+    def _remove_entry(self, request_hash: str, file_name: str | None, segment_id: int | None, size: int) -> None:
+        # must be called within a transaction, files must be removed after it, records in segments remain until the
+        # next compaction
+        if file_name is None:
+            self._connection.execute("UPDATE segments SET dead = dead + ? WHERE id = ?", (size, segment_id))
+        self._connection.execute("DELETE FROM entries WHERE hash = ?", (request_hash,))
+
+    def _remove_files(self, file_names: list[str]) -> None:
+        for file_name in file_names:
+            try:
+                os.remove(self.path / file_name)
+            except FileNotFoundError:
+                pass
+        if len(file_names) > 0:
+            with self._transaction():
+                self._store_directory_mtime()
+
+    def _load_pair(self, file_name: str | None, segment_id: int | None, offset: int | None, size: int) -> dict:
+        if file_name is not None:
+            with open(self.path / file_name, "r", encoding="utf-8") as file:
+                return json.load(file)
+        return self._read_record(segment_id, offset, size)[2]
+
+    def _lease_path(self, request_hash: str) -> pathlib.Path:
+        return self.path / _leases_dir_name / f"{request_hash}.lease"
+
+    @staticmethod
+    def _is_stale_lease(path: pathlib.Path) -> bool:
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                content = file.read()
+            if content == "":
+                # the owner may not have written the lease yet, unless it died right after creating the file
+                return time.time() - os.stat(path).st_mtime > _lease_write_timeout
+        except FileNotFoundError:
+            return True
+        try:
+            lease = json.loads(content)
+        except json.JSONDecodeError:
+            return False  # the owner is still writing the lease
+        if lease["expires"] < time.time():
+            return True
+        return ResponseCache._is_dead_process(lease["host"], lease["pid"])
+
+    @staticmethod
+    def _is_dead_process(host: str, pid: int) -> bool:
+        # processes on other hosts cannot be checked and are assumed to be alive
+        if host != socket.gethostname():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _segment_path(self, segment_id: int) -> pathlib.Path:
+        return self.path / _segments_dir_name / f"{segment_id:06d}.seg"
+
+    def _get_segment_reader(self, segment_id: int):
+        if segment_id not in self._segment_readers.keys():
+            self._segment_readers[segment_id] = open(self._segment_path(segment_id), "rb")
+        return self._segment_readers[segment_id]
+
+    def _close_segment_reader(self, segment_id: int) -> None:
+        if segment_id in self._segment_readers.keys():
+            self._segment_readers.pop(segment_id).close()
+
+    def _roll_segment(self) -> None:
+        # must be called within a transaction, segment IDs are never reused, since other processes may still have a
+        # compacted segment open
+        if self._segment_writer is not None:
+            self._release_segment(self._segment_writer[0])
+            self._segment_writer[1].close()
+            self._segment_writer = None
+        segment_id = self._allocate_segment()
+        self._segment_writer = (segment_id, open(self._segment_path(segment_id), "ab"))
+
+    def _allocate_segment(self) -> int:
+        # must be called within a transaction, the new segment is owned by this process
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'next_segment'").fetchone()
+        segment_id = self._connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM segments").fetchone()[0]
+        segment_id = max(segment_id, 1 if row is None else int(row[0]))
+        self._connection.execute("INSERT INTO segments (id, size, dead, owner) VALUES (?, 0, 0, ?)",
+                                 (segment_id, self._owner))
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_segment', ?)",
+                                 (str(segment_id + 1),))
+        return segment_id
+
+    def _release_segment(self, segment_id: int) -> None:
+        # must be called within a transaction, the segment can be compacted once no process appends to it
+        self._connection.execute("UPDATE segments SET owner = NULL WHERE id = ? AND owner = ?",
+                                 (segment_id, self._owner))
+
+    def _release_segments_of_dead_processes(self) -> None:
+        # must be called within a transaction
+        for segment_id, owner in self._connection.execute(
+                "SELECT id, owner FROM segments WHERE owner IS NOT NULL").fetchall():
+            host, pid = owner.rsplit(":", 1)
+            if self._is_dead_process(host, int(pid)):
+                self._connection.execute("UPDATE segments SET owner = NULL WHERE id = ?", (segment_id,))
+
+    def _append_record(self, request_hash: str, created: str, content: str) -> tuple[int, int, int, int]:
+        # must be called within a transaction, so that the record is complete before it is added to the index
+        dictionary_id = max(self._compressors.keys())
+        record = self._pack_record(request_hash, created, content, dictionary_id, self._compressors)
+
+        if self._segment_writer is None:
+            self._roll_segment()
+        segment_id, file = self._segment_writer
+        file.seek(0, os.SEEK_END)
+        if file.tell() >= _segment_max_bytes:
+            self._roll_segment()
+            segment_id, file = self._segment_writer
+        offset = file.tell()
+        file.write(record)
+        file.flush()
+        self._connection.execute("UPDATE segments SET size = size + ? WHERE id = ?", (len(record), segment_id))
+        return segment_id, offset, len(record), dictionary_id
+
+    def _read_record(self, segment_id: int, offset: int, size: int) -> tuple[str, str, dict]:
+        file = self._get_segment_reader(segment_id)
+        file.seek(offset)
+        record = file.read(size)
+        if _record_header.unpack_from(record)[3] not in self._decompressors.keys():
+            self._load_dictionaries()  # another process has trained a dictionary
+        request_hash, created, _, content = self._unpack_record(record, segment_id, offset, self._decompressors)
+        return request_hash, created, json.loads(content)
+
+    @staticmethod
+    def _pack_record(
+            request_hash: str,
+            created: str,
+            content: str,
+            dictionary_id: int,
+            compressors: dict[int, zstandard.ZstdCompressor]
+    ) -> bytes:
+        payload = compressors[dictionary_id].compress(bytes(content, "utf-8"))
+        header = _record_header.pack(_record_magic, bytes.fromhex(request_hash), bytes(created, "ascii"),
+                                     dictionary_id, len(payload))
+        return header + payload
+
+    @staticmethod
+    def _unpack_record(
+            record: bytes,
+            segment_id: int,
+            offset: int,
+            decompressors: dict[int, zstandard.ZstdDecompressor]
+    ) -> tuple[str, str, int, str]:
+        magic, raw_hash, created, dictionary_id, length = _record_header.unpack_from(record)
+        if magic != _record_magic or len(record) != _record_header.size + length:
+            raise AssertionError(f"Corrupt record at offset {offset} of segment {segment_id}!")
+        content = str(decompressors[dictionary_id].decompress(record[_record_header.size:]), "utf-8")
+        return raw_hash.hex(), created.rstrip(b"\0").decode("ascii"), dictionary_id, content
+
+    def _compact_segment(
+            self,
+            segment_id: int,
+            compressors: dict[int, zstandard.ZstdCompressor],
+            decompressors: dict[int, zstandard.ZstdDecompressor]
+    ) -> None:
+        # claim the segment and a new segment for its records
+        with self._lock:
+            with self._transaction():
+                if self._connection.execute("SELECT 1 FROM segments WHERE id = ? AND owner IS NULL",
+                                            (segment_id,)).fetchone() is None:
+                    return  # another process compacts the segment, has compacted it, or appends to it again
+                self._connection.execute("UPDATE segments SET owner = ? WHERE id = ?", (self._owner, segment_id))
+                rows = self._connection.execute("SELECT hash, offset, size FROM entries WHERE segment = ? "
+                                                "ORDER BY offset", (segment_id,)).fetchall()
+                if len(rows) == 0:
+                    self._connection.execute("DELETE FROM segments WHERE id = ?", (segment_id,))
+                else:
+                    new_segment_id = self._allocate_segment()
+            if len(rows) == 0:
+                self._close_segment_reader(segment_id)
+                os.remove(self._segment_path(segment_id))
+                return
+
+        # rewrite the records without holding the index, the claimed segments are not touched by other processes
+        dictionary_id = max(compressors.keys())
+        moved_records = []
+        new_size = 0
+        try:
+            with open(self._segment_path(segment_id), "rb") as reader, \
+                    open(self._segment_path(new_segment_id), "ab") as writer:
+                for request_hash, offset, size in rows:
+                    reader.seek(offset)
+                    record = reader.read(size)
+                    if _record_header.unpack_from(record)[3] not in decompressors.keys():
+                        decompressors.update(self._read_dictionaries()[1])  # another process has trained a dictionary
+                    _, created, _, content = self._unpack_record(record, segment_id, offset, decompressors)
+                    record = self._pack_record(request_hash, created, content, dictionary_id, compressors)
+                    writer.write(record)
+                    moved_records.append((request_hash, offset, new_size, len(record)))
+                    new_size += len(record)
+        except BaseException:
+            with self._lock:
+                with self._transaction():
+                    self._connection.execute("DELETE FROM segments WHERE id = ?", (new_segment_id,))
+                    self._release_segment(segment_id)
+            os.remove(self._segment_path(new_segment_id))
+            raise
+
+        # move the entries that still point to the old records, the others have been evicted in the meantime
+        with self._lock:
+            with self._transaction():
+                dead = 0
+                for request_hash, offset, new_offset, size in moved_records:
+                    cursor = self._connection.execute(
+                        "UPDATE entries SET segment = ?, offset = ?, size = ?, dictionary = ? "
+                        "WHERE hash = ? AND segment = ? AND offset = ?",
+                        (new_segment_id, new_offset, size, dictionary_id, request_hash, segment_id, offset))
+                    if cursor.rowcount == 0:
+                        dead += size
+                self._connection.execute("UPDATE segments SET size = ?, dead = ?, owner = NULL WHERE id = ?",
+                                         (new_size, dead, new_segment_id))
+                self._connection.execute("DELETE FROM segments WHERE id = ?", (segment_id,))
+            self._close_segment_reader(segment_id)
+        os.remove(self._segment_path(segment_id))
+
+    def _iter_segment(self, segment_id: int) -> Iterator[tuple[str, str, int, int, int]]:
+        with open(self._segment_path(segment_id), "rb") as file:
+            offset = 0
+            while True:
+                header = file.read(_record_header.size)
+                if len(header) < _record_header.size:
+                    break  # a partially written record at the end of the segment is ignored
+                magic, raw_hash, created, dictionary_id, length = _record_header.unpack(header)
+                if magic != _record_magic:
+                    logger.warning(f"Segment {segment_id} is corrupt after offset {offset}!")
+                    break
+                file.seek(length, os.SEEK_CUR)
+                size = _record_header.size + length
+                yield raw_hash.hex(), created.rstrip(b"\0").decode("ascii"), dictionary_id, offset, size
+                offset += size
+
+    def _load_dictionaries(self) -> None:
+        self._compressors, self._decompressors = self._read_dictionaries()
+
+    def _read_dictionaries(self) -> tuple[dict[int, zstandard.ZstdCompressor], dict[int, zstandard.ZstdDecompressor]]:
+        compressors = {0: zstandard.ZstdCompressor(level=_compression_level)}
+        decompressors = {0: zstandard.ZstdDecompressor()}
+        for file_name in os.listdir(self.path / _segments_dir_name):
+            match = _dictionary_file_name_pattern.match(file_name)
+            if match is not None:
+                with open(self.path / _segments_dir_name / file_name, "rb") as file:
+                    dictionary = zstandard.ZstdCompressionDict(file.read())
+                dictionary_id = int(match.group(1))
+                compressors[dictionary_id] = zstandard.ZstdCompressor(level=_compression_level, dict_data=dictionary)
+                decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return compressors, decompressors
+
+    def _train_dictionary(self) -> None:
+        rows = self._connection.execute("SELECT file, segment, offset, size FROM entries").fetchall()
+        if len(rows) < _dictionary_min_samples:
+            return
+        samples = []
+        for row in _dictionary_random.sample(rows, k=min(len(rows), _dictionary_max_samples)):
+            try:
+                samples.append(bytes(json.dumps(self._load_pair(*row)), "utf-8"))
+            except FileNotFoundError:
+                pass
+        try:
+            dictionary = zstandard.train_dictionary(_dictionary_size, samples)
+        except zstandard.ZstdError as e:
+            logger.warning(f"Training the compression dictionary failed: {e}")
+            return
+        dictionary_id = max(self._compressors.keys()) + 1
+        # publish the dictionary with a hard link, which fails instead of overwriting the dictionary of another process
+        path = self.path / _segments_dir_name / f"dict-{dictionary_id}.zstd"
+        temporary_path = self.path / _segments_dir_name / f".dict-{dictionary_id}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(dictionary.as_bytes())
+        try:
+            os.link(temporary_path, path)
+            logger.info(f"Trained compression dictionary {dictionary_id} on {len(samples)} pairs.")
+        except FileExistsError:
+            pass
+        os.remove(temporary_path)
+        self._load_dictionaries()
+
+    def _create_index(self) -> bool:
+        # must be called within a transaction, returns whether the index has been recreated
+        version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == _index_schema_version:
+            return False
+        # the index only contains information that can be recovered from the cache directory and segments, except for
+        # evictions from segments, whose records are simply evicted again once the cache is full
+        self._connection.execute("DROP TABLE IF EXISTS entries")
+        self._connection.execute("DROP TABLE IF EXISTS segments")
+        self._connection.execute("DROP TABLE IF EXISTS meta")
+        self._connection.execute("DROP TABLE IF EXISTS stats")
+        self._connection.execute("CREATE TABLE entries (hash TEXT PRIMARY KEY, "
+                                 "created TEXT NOT NULL, file TEXT, segment INTEGER, offset INTEGER, "
+                                 "dictionary INTEGER, size INTEGER NOT NULL, last_access REAL NOT NULL, "
+                                 "pinned INTEGER NOT NULL DEFAULT 0)")
+        self._connection.execute("CREATE INDEX entries_lru ON entries (pinned, last_access)")
+        self._connection.execute("CREATE INDEX entries_segment ON entries (segment)")
+        self._connection.execute("CREATE TABLE segments (id INTEGER PRIMARY KEY, size INTEGER NOT NULL, "
+                                 "dead INTEGER NOT NULL, owner TEXT)")
+        self._connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+        # the entry count and byte size are maintained by the index itself, so that all processes agree on them
+        self._connection.execute("CREATE TABLE stats (num_entries INTEGER NOT NULL, num_bytes INTEGER NOT NULL)")
+        self._connection.execute("INSERT INTO stats (num_entries, num_bytes) VALUES (0, 0)")
+        self._connection.execute("CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN "
+                                 "UPDATE stats SET num_entries = num_entries + 1, "
+                                 "num_bytes = num_bytes + new.size; END")
+        self._connection.execute("CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN "
+                                 "UPDATE stats SET num_entries = num_entries - 1, "
+                                 "num_bytes = num_bytes - old.size; END")
+        self._connection.execute("CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN "
+                                 "UPDATE stats SET num_bytes = num_bytes + new.size - old.size; END")
+        self._recount_stats()
+        self._connection.execute(f"PRAGMA user_version = {_index_schema_version}")
+        return True
+
+    def _recount_stats(self) -> None:
+        # must be called within a transaction, e.g., after `INSERT OR REPLACE`, which does not fire the delete trigger
+        self._connection.execute("UPDATE stats SET (num_entries, num_bytes) = "
+                                 "(SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries)")
+
+    def _scan_segments(self) -> None:
+        # must be called within a transaction
+        segment_ids = []
+        for file_name in os.listdir(self.path / _segments_dir_name):
+            match = _segment_file_name_pattern.match(file_name)
+            if match is not None:
+                segment_ids.append(int(match.group(1)))
+        if len(segment_ids) == 0:
+            return
+
+        logger.info("Rebuild the OpenAI cache index from the segments.")
+        for segment_id in sorted(segment_ids):
+            total_size = 0
+            # records are appended in order, so a later record for the same hash (written by a compaction) wins
+            for request_hash, created, dictionary_id, offset, size in self._iter_segment(segment_id):
+                total_size += size
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO entries (hash, created, segment, offset, dictionary, size, last_access)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (request_hash, created, segment_id, offset, dictionary_id, size, time.time()))
+            self._connection.execute("INSERT INTO segments (id, size, dead) VALUES (?, ?, 0)",
+                                     (segment_id, total_size))
+        self._connection.execute("UPDATE segments SET dead = size - (SELECT COALESCE(SUM(entries.size), 0) "
+                                 "FROM entries WHERE entries.segment = segments.id)")
+        self._recount_stats()
+
+    def _sync_index(self) -> None:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'directory_mtime'").fetchone()
+            if row is not None and int(row[0]) == os.stat(self.path).st_mtime_ns:
+                return
+
+            logger.info("Build the OpenAI cache index.")
+            files = {}
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    match = _cache_file_name_pattern.match(entry.name)
+                    if match is not None and entry.is_file():
+                        created, request_hash = match.groups()
+                        if request_hash not in files.keys() or entry.name < files[request_hash][1]:
+                            stat = entry.stat()
+                            files[request_hash] = (created, entry.name, stat.st_size, stat.st_mtime)
+
+            # keep the last accesses and pins of pairs that are still there and prefer pairs in segments
+            with self._transaction():
+                self._connection.execute("CREATE TEMPORARY TABLE scanned (hash TEXT PRIMARY KEY, created TEXT NOT NULL,"
+                                         " file TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL)")
+                self._connection.executemany(
+                    "INSERT INTO scanned (hash, created, file, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                    ((h, *f) for h, f in files.items()))
+                self._connection.execute(
+                    "DELETE FROM entries WHERE file IS NOT NULL AND hash NOT IN (SELECT hash FROM scanned)")
+                self._connection.execute(
+                    "INSERT INTO entries (hash, created, file, size, last_access) "
+                    "SELECT hash, created, file, size, mtime FROM scanned WHERE true ON CONFLICT (hash) DO UPDATE "
+                    "SET file = excluded.file, size = excluded.size WHERE entries.file IS NOT NULL")
+                self._connection.execute("DROP TABLE scanned")
+                self._store_directory_mtime()
+
+    def _store_directory_mtime(self) -> None:
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('directory_mtime', ?)",
+                                 (str(os.stat(self.path).st_mtime_ns),))
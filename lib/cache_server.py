@@ -0,0 +1,354 @@
+########################################################################################################################
+# Shared response cache for several nodes
+#
+# use the following methods:
+# ResponseCacheServer(...) ==> serve a response cache over HTTP, e.g., with scripts/openai_cache/serve.py
+# RemoteCache(...)         ==> client for the server
+# TieredCache(...)         ==> use the server as a remote tier in front of the local cache
+#
+# point the API helpers at the server by setting the environment variable `OPENAI_CACHE_URL` to its `url`
+########################################################################################################################
+
+import http.client
+import http.server
+import json
+import logging
+import pathlib
+import re
+import threading
+import urllib.parse
+from typing import Iterable
+
+from lib.cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+_pair_path_pattern = re.compile(r"^/pairs/([0-9a-f]{64})$")
+_batch_get_path = "/pairs/batch-get"
+_max_batch_size = 1_000  # maximum number of hashes per batch-get request
+_request_timeout = 60.0
+
+
+class ResponseCacheServer:
+    """Local HTTP server that serves a response cache to the API helpers of several nodes.
+
+    The server is backed by a `ResponseCache` in the usual on-disk format, so that the cache directory can also be used
+    (or zipped) directly. It offers the following endpoints:
+    - `GET /pairs/<hash>` returns the cached pair or status 404
+    - `PUT /pairs/<hash>` stores the pair in the request body, unless there already is a pair for the hash
+    - `POST /pairs/batch-get` with `{"hashes": [...]}` returns `{"pairs": {<hash>: <pair>}}` for the cached hashes
+
+    The server has no authentication, so it should only be reachable from the nodes that run the experiments.
+    """
+    path: pathlib.Path
+    host: str
+    port: int
+    num_requests: int
+
+    def __init__(
+            self,
+            path: pathlib.Path,
+            *,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            max_entries: int | None = None,
+            max_bytes: int | None = None,
+            storage: str = "segments"
+    ) -> None:
+        """Create the server.
+
+        Args:
+            path: The cache directory.
+            host: The host to bind to.
+            port: The port to bind to or 0 to choose a free port.
+            max_entries: The maximum number of cached pairs or None for no limit.
+            max_bytes: The maximum total size of the cached pairs in bytes or None for no limit.
+            storage: Either `segments` or `files`, see `ResponseCache`.
+        """
+        self.path = path
+        self.host = host
+        self.port = port
+        self.num_requests = 0
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._storage = storage
+        self._cache = None
+        self._server = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> None:
+        """Open the cache and start the server in a background thread."""
+        self._cache = ResponseCache(self.path, max_entries=self._max_entries, max_bytes=self._max_bytes,
+                                    storage=self._storage)
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), self._create_handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Response cache server with {len(self._cache)} pairs listens on {self.url}.")
+
+    def stop(self) -> None:
+        """Stop the server and close the cache."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._cache.close()
+            self._cache = None
+
+    def __enter__(self) -> "ResponseCacheServer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def _create_handler(self) -> type[http.server.BaseHTTPRequestHandler]:
+        server = self
+        cache = self._cache
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive, since each node sends many small requests
+
+            def do_GET(self) -> None:
+                server._count_request()
+                match = _pair_path_pattern.match(self.path)
+                if match is None:
+                    self._send(404, {"error": f"Unknown path '{self.path}'."})
+                    return
+                pair = cache.get(match.group(1))
+                if pair is None:
+                    self._send(404, {"error": "The pair is not cached."})
+                else:
+                    self._send(200, pair)
+
+            def do_PUT(self) -> None:
+                server._count_request()
+                match = _pair_path_pattern.match(self.path)
+                body = self._receive()
+                if match is None:
+                    self._send(404, {"error": f"Unknown path '{self.path}'."})
+                elif body is None or "request" not in body.keys() or "response" not in body.keys():
+                    self._send(400, {"error": "The body must be a pair with `request` and `response`."})
+                else:
+                    cache.put(match.group(1), body)
+                    self._send(200, {})
+
+            def do_POST(self) -> None:
+                server._count_request()
+                body = self._receive()
+                if self.path != _batch_get_path:
+                    self._send(404, {"error": f"Unknown path '{self.path}'."})
+                elif body is None or not isinstance(body.get("hashes"), list) or \
+                        len(body["hashes"]) > _max_batch_size:
+                    self._send(400, {"error": f"The body must contain at most {_max_batch_size} `hashes`."})
+                else:
+                    pairs = {}
+                    for request_hash in cache.contains_many(body["hashes"]):
+                        pair = cache.get(request_hash)
+                        if pair is not None:  # the pair may have been evicted in the meantime
+                            pairs[request_hash] = pair
+                    self._send(200, {"pairs": pairs})
+
+            def _receive(self) -> dict | None:
+                content = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    body = json.loads(content)
+                except json.JSONDecodeError:
+                    return None
+                return body if isinstance(body, dict) else None
+
+            def _send(self, status: int, body: dict) -> None:
+                content = bytes(json.dumps(body), "utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return Handler
+
+    def _count_request(self) -> None:
+        with self._lock:
+            self.num_requests += 1
+
+
+class RemoteCache:
+    """Client for a `ResponseCacheServer`.
+
+    Each thread keeps its own connection alive. Connection errors and unexpected responses raise `OSError` or
+    `http.client.HTTPException`.
+    """
+    url: str
+
+    def __init__(self, url: str) -> None:
+        """Create the client.
+
+        Args:
+            url: The URL of the server, e.g., `http://10.0.0.1:8100`.
+        """
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.scheme != "http" or parsed_url.hostname is None:
+            raise AssertionError(f"Invalid URL of the cache server '{url}'!")
+        self.url = url.rstrip("/")
+        self._host = parsed_url.hostname
+        self._port = parsed_url.port or 80
+        self._local = threading.local()
+
+    def get(self, request_hash: str) -> dict | None:
+        """Load the cached pair for the given request hash.
+
+        Args:
+            request_hash: The hash of the request.
+
+        Returns:
+            The cached pair or None if there is no cached pair.
+        """
+        status, body = self._send("GET", f"/pairs/{request_hash}", None)
+        return None if status == 404 else body
+
+    def put(self, request_hash: str, pair: dict) -> None:
+        """Store the pair for the given request hash unless there already is a pair for it.
+
+        Args:
+            request_hash: The hash of the request.
+            pair: A dictionary with `request` and `response`.
+        """
+        self._send("PUT", f"/pairs/{request_hash}", pair)
+
+    def get_many(self, request_hashes: Iterable[str]) -> dict[str, dict]:
+        """Load the cached pairs for the given request hashes in as few requests as possible.
+
+        Args:
+            request_hashes: The hashes of the requests.
+
+        Returns:
+            A dictionary from the hashes of the cached requests to their pairs.
+        """
+        request_hashes = list(request_hashes)
+        pairs = {}
+        for start in range(0, len(request_hashes), _max_batch_size):
+            _, body = self._send("POST", _batch_get_path, {"hashes": request_hashes[start:start + _max_batch_size]})
+            pairs.update(body["pairs"])
+        return pairs
+
+    def _send(self, method: str, path: str, body: dict | None) -> tuple[int, dict]:
+        content = None if body is None else bytes(json.dumps(body), "utf-8")
+        headers = {} if content is None else {"Content-Type": "application/json"}
+        for attempt in range(2):
+            if getattr(self._local, "connection", None) is None:
+                self._local.connection = http.client.HTTPConnection(self._host, self._port, timeout=_request_timeout)
+            try:
+                self._local.connection.request(method, path, body=content, headers=headers)
+                response = self._local.connection.getresponse()
+                status, result = response.status, json.loads(response.read())
+                break
+            except (OSError, http.client.HTTPException):
+                self._local.connection.close()
+                self._local.connection = None
+                if attempt == 1:
+                    raise  # the server closes idle connections, so only a fresh connection that fails is an error
+        if status not in (200, 404):
+            raise http.client.HTTPException(f"Cache server answered {method} {path} with status {status}: {result}")
+        return status, result
+
+
+class TieredCache:
+    """Response cache that uses a remote cache as a tier in front of the local cache.
+
+    Lookups try the local cache first and copy pairs that are only in the remote cache into the local cache, so that
+    nodes share hits immediately. New pairs are written to both caches. Leases, pins, eviction, and compaction only
+    concern the local cache. If the remote cache fails, a warning is logged and only the local cache is used from then
+    on, so that an unreachable server never fails a run.
+    """
+    local: ResponseCache
+    remote: RemoteCache
+
+    def __init__(self, local: ResponseCache, remote: RemoteCache) -> None:
+        """Create the tiered cache.
+
+        Args:
+            local: The local cache.
+            remote: The remote cache.
+        """
+        self.local = local
+        self.remote = remote
+        self._remote_failed = False
+
+    def get(self, request_hash: str) -> dict | None:
+        """Load the cached pair for the given request hash, see `ResponseCache.get`."""
+        return self.get_first([request_hash])
+
+    def get_first(self, request_hashes: list[str]) -> dict | None:
+        """Load the cached pair for the first of the given request hashes that is cached, asking the remote cache
+        for all hashes at once, see `ResponseCache.get_first`."""
+        pair = self.local.get_first(request_hashes)
+        if pair is not None or self._remote_failed:
+            return pair
+        try:
+            if len(request_hashes) == 1:
+                pairs = {request_hashes[0]: self.remote.get(request_hashes[0])}
+            else:
+                pairs = self.remote.get_many(request_hashes)
+        except (OSError, http.client.HTTPException) as e:
+            self._fail(e)
+            return None
+        for request_hash in request_hashes:
+            if pairs.get(request_hash) is not None:
+                self.local.put(request_hash, pairs[request_hash])
+                return pairs[request_hash]
+        return None
+
+    def put(self, request_hash: str, pair: dict) -> None:
+        """Cache the pair for the given request hash, see `ResponseCache.put`."""
+        self.local.put(request_hash, pair)
+        if not self._remote_failed:
+            try:
+                self.remote.put(request_hash, pair)
+            except (OSError, http.client.HTTPException) as e:
+                self._fail(e)
+
+    def contains_many(self, request_hashes: Iterable[str]) -> set[str]:
+        """Determine which of the given request hashes are cached and copy the pairs that are only in the remote cache
+        into the local cache, see `ResponseCache.contains_many`."""
+        request_hashes = list(request_hashes)
+        found_hashes = self.local.contains_many(request_hashes)
+        missing_hashes = [request_hash for request_hash in request_hashes if request_hash not in found_hashes]
+        if len(missing_hashes) > 0 and not self._remote_failed:
+            try:
+                pairs = self.remote.get_many(missing_hashes)
+            except (OSError, http.client.HTTPException) as e:
+                self._fail(e)
+                pairs = {}
+            for request_hash, pair in pairs.items():
+                self.local.put(request_hash, pair)
+                found_hashes.add(request_hash)
+        return found_hashes
+
+    def pin(self, request_hashes: Iterable[str], pinned: bool = True) -> None:
+        self.local.pin(request_hashes, pinned)
+
+    def evict(self) -> None:
+        self.local.evict()
+
+    def start_compaction(self) -> None:
+        self.local.start_compaction()
+
+    def try_lease(self, request_hash: str, duration: float) -> bool:
+        return self.local.try_lease(request_hash, duration)
+
+    def release_lease(self, request_hash: str) -> None:
+        self.local.release_lease(request_hash)
+
+    def close(self) -> None:
+        self.local.close()
+
+    def _fail(self, error: Exception) -> None:
+        self._remote_failed = True
+        logger.warning(f"Cache server {self.remote.url} failed and will not be used anymore: {error}")
@@ -127,6 +127,38 @@ def get_results_dir(task_name: str, dataset_name: str, exp_name: str, clear: boo
     return _prepare_directory(exp_name, "results", task_name, dataset_name, clear)
 
 
+def get_ledger_path(task_name: str, dataset_name: str, exp_name: str) -> pathlib.Path:
+    """Path of the JSONL **ledger** that records the cost and token usage of the executed requests.
+
+    Args:
+        task_name: The name of the task.
+        dataset_name: The name of the dataset.
+        exp_name: The name of the current experiment.
+
+    Returns:
+        A pathlib.Path to the file.
+    """
+    path = get_data_path() / task_name / dataset_name / "experiments" / exp_name
+    os.makedirs(path, exist_ok=True)
+    return path / "ledger.jsonl"
+
+
+def get_trace_path(task_name: str, dataset_name: str, exp_name: str) -> pathlib.Path:
+    """Path of the JSONL **trace** that records when each executed request was admitted, sent, and done.
+
+    Args:
+        task_name: The name of the task.
+        dataset_name: The name of the dataset.
+        exp_name: The name of the current experiment.
+
+    Returns:
+        A pathlib.Path to the file.
+    """
+    path = get_data_path() / task_name / dataset_name / "experiments" / exp_name
+    os.makedirs(path, exist_ok=True)
+    return path / "trace.jsonl"
+
+
 def load_json(path: pathlib.Path) -> dict | list:
     """Load the JSON object from the given file path.
 
@@ -140,15 +172,22 @@ def load_json(path: pathlib.Path) -> dict | list:
         return json.load(file)
 
 
-def dump_json(obj: dict | list, path: pathlib.Path) -> None:
+def dump_json(obj: dict | list, path: pathlib.Path, *, atomic: bool = False) -> None:
     """Dump the given JSON object to the given file path.
 
     Args:
         obj: The JSON object.
         path: The pathlib.Path to the JSON file.
+        atomic: Whether to write to a temporary file first and rename it, so that the file is never left incomplete.
     """
-    with open(path, "w", encoding="utf-8") as file:
-        json.dump(obj, file)
+    if not atomic:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(obj, file)
+    else:
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(obj, file)
+        os.replace(tmp_path, path)
 
 
 def load_str(path: pathlib.Path) -> str:
@@ -0,0 +1,94 @@
+import collections
+import json
+import logging
+import pathlib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Ledger:
+    """Append-only JSONL file that records the cost and the token usage of each executed request.
+
+    Each line is a JSON object with the `time`, the `model`, the request `hash`, the `mode` of execution, whether the
+    request `succeeded`, its `prompt_tokens` and `completion_tokens`, and its actual `cost` in dollars. Since the ledger
+    of an experiment is only ever appended to, it also covers interrupted and resumed runs.
+    """
+    path: pathlib.Path
+
+    def __init__(self, path: pathlib.Path) -> None:
+        """Open the ledger.
+
+        Args:
+            path: The path of the JSONL file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def record(self, model: str, request_hash: str, mode: str, response: dict, cost: float) -> None:
+        """Append an entry for an executed request.
+
+        Args:
+            model: The name of the model.
+            request_hash: The hash of the request.
+            mode: The mode of execution, e.g., `sync` or `batch`.
+            response: The API response.
+            cost: The actual cost of the request in dollars.
+        """
+        usage = response.get("usage") or {}
+        entry = {
+            "time": time.time(),
+            "model": model,
+            "hash": request_hash,
+            "mode": mode,
+            "succeeded": "choices" in response.keys(),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "cost": cost
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        """Close the ledger."""
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> "Ledger":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def summarize_ledger(path: pathlib.Path) -> dict:
+    """Aggregate the entries of a ledger.
+
+    Args:
+        path: The path of the JSONL file.
+
+    Returns:
+        A dictionary with the total number of requests, failed requests, prompt tokens, completion tokens, and cost, as
+        well as the same totals for each model under `models`.
+    """
+    def new_totals() -> dict:
+        return collections.Counter(num_requests=0, num_failed=0, prompt_tokens=0, completion_tokens=0, cost=0.0)
+
+    totals, model_totals = new_totals(), collections.defaultdict(new_totals)
+    if path.is_file():
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # the last line may be incomplete if a run was killed
+                for t in (totals, model_totals[entry["model"]]):
+                    t["num_requests"] += 1
+                    t["num_failed"] += not entry["succeeded"]
+                    t["prompt_tokens"] += entry["prompt_tokens"]
+                    t["completion_tokens"] += entry["completion_tokens"]
+                    t["cost"] += entry["cost"]
+    return {**totals, "models": {model: dict(t) for model, t in model_totals.items()}}
@@ -1,11 +1,13 @@
 import json
 import logging
-from typing import Literal, Any, Optional
+from typing import Literal, Any, Optional, Callable
 
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+_json_decoder = json.JSONDecoder()
+
 
 def linearize_table(
         table: pd.DataFrame,
@@ -129,3 +131,55 @@ def delinearize_list(
         return l
     else:
         raise AssertionError(f"Unknown list serialization mode '{mode}'!")
+
+
+def list_stop_detector(
+        num_items: int | None,
+        *,
+        mode: Literal["csv"] | Literal["json_list"],
+        sep: str,
+        strip: bool
+) -> Callable[[str], int | None]:
+    """Create a stop detector that tells when a partially generated string contains the complete list.
+
+    The detector returns the length of the prefix of the string that contains the list with the expected number of
+    items, which delinearizes like the list alone, or None if the generation must go on. It only stops the generation
+    early and never cuts a list short: a list with too many items is kept, so that the evaluation sees it. Since a CSV
+    list has no closing delimiter, it is only complete once the line that contains its items ends.
+
+    >>> detect = list_stop_detector(2, mode="json_list", sep=",", strip=True)
+    >>> detect('["a", "b'), detect('["a", "b"]'), detect(' ["a", "b"]\\nThe columns contain'), detect('["a"]')
+    (None, 10, 11, None)
+    >>> detect = list_stop_detector(2, mode="csv", sep=",", strip=True)
+    >>> detect("a, b"), detect("a, b, c"), detect("a, b\\nThe columns contain"), detect("a, b, c\\n"), detect("a\\nb")
+    (None, None, 4, 7, None)
+
+    Args:
+        num_items: The expected number of items or None to stop at any complete list.
+        mode: The linearization mode.
+        sep: The separator string.
+        strip: Whether to strip whitespaces when delinearizing.
+
+    Returns:
+        The stop detector.
+    """
+    if mode == "csv":
+        def detect(s: str) -> int | None:
+            start = len(s) - len(s.lstrip())
+            end = s.find("\n", start)
+            if end == -1 or (num_items is not None and s.count(sep, start, end) + 1 < num_items):
+                return None
+            return end
+    elif mode == "json_list":
+        def detect(s: str) -> int | None:
+            start = len(s) - len(s.lstrip())
+            try:
+                l, end = _json_decoder.raw_decode(s, start)
+            except json.JSONDecodeError:
+                return None
+            if isinstance(l, list) and (num_items is None or len(l) == num_items):
+                return end
+            return None
+    else:
+        raise AssertionError(f"Unknown list serialization mode '{mode}'!")
+    return detect
@@ -1,11 +1,72 @@
+import dataclasses
 import logging
+import pathlib
+import threading
+from typing import Callable, Hashable, Iterable, Iterator
 
-import tiktoken
+from omegaconf import OmegaConf
 
-from lib.openai import openai_execute
+from lib.data import get_data_path
+from lib.openai import Credential, openai_credentials, openai_execute, openai_execute_iter, openai_batch_execute, \
+    openai_register_model
+from lib.openai_batch import LocalBatchClient
+from lib.tokens import get_token_counter
 
 logger = logging.getLogger(__name__)
 
+_backends_path = pathlib.Path(__file__).resolve().parent.parent / "config" / "backends.yaml"
+
+
+@dataclasses.dataclass
+class Backend:
+    """OpenAI-compatible API whose requests are executed by the shared engine in `lib.openai`."""
+    name: str
+    credentials: str | list[dict]  # `openai`, `aicore`, or a list with the fields of `Credential`
+    batch: bool = False  # whether the backend offers the Batch API
+    models: dict[str, dict] = dataclasses.field(default_factory=dict)  # parameters like those in `_model_parameters`
+
+    def get_credentials(self) -> list[Credential]:
+        """Get the endpoints and API keys of the backend.
+
+        Returns:
+            The list of credentials.
+        """
+        if self.credentials == "openai":
+            return openai_credentials()
+        elif self.credentials == "aicore":
+            from lib.aicore import aicore_credentials
+            return aicore_credentials()
+        elif isinstance(self.credentials, list):
+            return [Credential(**credential) for credential in self.credentials]
+        else:
+            raise AssertionError(f"Invalid credentials '{self.credentials}' of backend '{self.name}'!")
+
+
+_backends: dict[str, Backend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(api_name: str) -> Backend:
+    """Get the backend with the given name from `config/backends.yaml` and register its models with the engine.
+
+    Args:
+        api_name: The name of the backend.
+
+    Returns:
+        The backend.
+    """
+    with _backends_lock:
+        if api_name not in _backends.keys():
+            config = OmegaConf.load(_backends_path)
+            if api_name not in config.keys():
+                raise AssertionError(f"Unknown API name '{api_name}'!")
+            # resolve only this backend, so that the environment variables of other backends need not be set
+            backend = Backend(name=api_name, **OmegaConf.to_container(config[api_name], resolve=True))
+            for model, parameters in backend.models.items():
+                openai_register_model(model, parameters)
+            _backends[api_name] = backend
+        return _backends[api_name]
+
 
 def get_num_tokens(
         text: str,
@@ -22,30 +83,97 @@ def get_num_tokens(
     Returns:
         The number of tokens in the text.
     """
-    if api_name == "openai" or api_name == "sapllmproxy" or api_name == "aicore":
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
-    else:
-        raise AssertionError(f"Unknown API name '{api_name}'!")
+    get_backend(api_name)  # registers the tokenizers of the models that tiktoken does not know
+    return get_token_counter().count(text, model)
 
 
 def execute_requests_against_api(
         requests: list[dict],
-        api_name: str
+        api_name: str,
+        *,
+        mode: str = "sync",
+        on_response: Callable[[int, dict], None] | None = None,
+        pin: bool = False,
+        budget: float | None = None,
+        ledger_path: pathlib.Path | None = None,
+        trace_path: pathlib.Path | None = None,
+        order: str = "longest_first",
+        stop_detector: Callable[[int, str], int | None] | None = None,
+        hedge_percentile: float | None = None,
+        offline: bool = False
 ) -> list[dict]:
     """Execute a list of requests against one of the APIs.
 
     Args:
         requests: A list of API requests.
-        api_name: The name of the API.
+        api_name: The name of the API, i.e., of a backend in `config/backends.yaml`.
+        mode: Either `sync` to execute the requests one by one, `batch` to execute them through the Batch API, or
+            `local_batch` to execute them through a local stand-in for the Batch API (for testing, its canned responses
+            are not cached).
+        on_response: An optional callback that is called with the index of the request and the response as soon as
+            the response is available.
+        pin: Whether to pin the cached responses so that they are never evicted from the cache.
+        budget: An optional limit on the cost of the run in dollars.
+        ledger_path: An optional JSONL file to which the cost and token usage of each executed request is appended.
+        trace_path: An optional JSONL file to which the trace of each executed request is appended (not supported by
+            the Batch API modes).
+        order: The order in which the requests are executed, either `longest_first`, `prefix` to group requests that
+            share a prompt prefix, or `packed` to fill the token limits with shorter requests while longer requests
+            wait (not supported by the Batch API modes).
+        stop_detector: An optional function that is called with the index of the request and the text generated so far
+            and returns the length of the text to keep once the generation can stop, in which case the responses are
+            streamed (not supported by the Batch API modes).
+        hedge_percentile: An optional latency percentile (e.g., 0.95) after which a slow request is sent a second time
+            (not supported by the Batch API modes).
+        offline: Whether to only replay the cached responses, which fails if a request is not cached. Since all APIs
+            and execution modes share the cache, neither the API nor the execution mode is used then.
 
     Returns:
         A list of API responses.
     """
-    if api_name == "openai":
-        return openai_execute(requests, force=0.000000001)
-    elif api_name == "aicore":
-        from lib.aicore import aicore_execute
-        return aicore_execute(requests, force=0.000000001)
+    backend = get_backend(api_name)
+    if offline:
+        return openai_execute(requests, force=0.000000001, on_response=on_response, pin=pin, offline=True)
+    if mode == "sync":
+        return openai_execute(requests, force=0.000000001, on_response=on_response, pin=pin,
+                              credentials=backend.get_credentials, budget=budget, ledger_path=ledger_path,
+                              trace_path=trace_path, order=order, stop_detector=stop_detector,
+                              hedge_percentile=hedge_percentile)
+    elif mode == "batch":
+        if not backend.batch:
+            raise AssertionError(f"The API '{api_name}' does not offer the Batch API!")
+        return openai_batch_execute(requests, credentials=backend.get_credentials, force=0.000000001,
+                                    on_response=on_response, pin=pin, budget=budget, ledger_path=ledger_path)
+    elif mode == "local_batch":
+        client = LocalBatchClient(get_data_path() / "openai_batches_local", processing_time=1.0)
+        return openai_batch_execute(requests, client=client, force=0.000000001, on_response=on_response, pin=pin,
+                                    budget=budget, ledger_path=ledger_path)
     else:
-        raise AssertionError(f"Unknown API name '{api_name}'!")
+        raise AssertionError(f"Unknown execution mode '{mode}'!")
+
+
+def stream_requests_against_api(
+        requests: Iterable[tuple[Hashable, dict]],
+        api_name: str,
+        *,
+        budget: float | None = None,
+        ledger_path: pathlib.Path | None = None,
+        trace_path: pathlib.Path | None = None
+) -> Iterator[tuple[Hashable, dict]]:
+    """Execute a lazy stream of requests against one of the APIs with bounded memory.
+
+    The requests are executed in the order in which they arrive, and the responses are yielded as they complete. Once
+    the budget is exhausted, the remaining requests are not consumed.
+
+    Args:
+        requests: Pairs of an ID (e.g., the name of the request file) and an API request.
+        api_name: The name of the API, i.e., of a backend in `config/backends.yaml`.
+        budget: An optional limit on the cost of the run in dollars.
+        ledger_path: An optional JSONL file to which the cost and token usage of each executed request is appended.
+        trace_path: An optional JSONL file to which the trace of each executed request is appended.
+
+    Returns:
+        An iterator over pairs of the ID of a request and its API response.
+    """
+    return openai_execute_iter(requests, credentials=get_backend(api_name).get_credentials, budget=budget,
+                               ledger_path=ledger_path, trace_path=trace_path)
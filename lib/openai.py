@@ -2,38 +2,86 @@
 # OpenAI API helpers version: 2024-04-18
 #
 # use the following methods:
-# openai_model(...)    ==> get information about the models
-# openai_execute(...)  ==> execute API requests
+# openai_model(...)          ==> get information about the models
+# openai_register_model(...) ==> add a model, e.g., one that is served by an OpenAI-compatible API
+# openai_execute(...)        ==> execute API requests
+# openai_execute_iter(...)   ==> execute a stream of API requests with bounded memory (or `openai_execute_stream`)
+# openai_batch_execute(...)  ==> execute API requests through the Batch API
+# openai_rate_limits()       ==> monitor the state of the rate limiters
+# openai_credentials()       ==> get the endpoints and API keys that are used by default
+# openai_execution_stats()   ==> get statistics about the last execution, e.g., for load tests
+# openai_metrics()           ==> get the metrics of the executor, e.g., to export them
 ########################################################################################################################
 
+import asyncio
+import atexit
 import dataclasses
-import datetime
+import functools
 import hashlib
 import json
 import logging
 import os
+import pathlib
 import threading
 import time
+from typing import AsyncIterator, Callable, Hashable, Iterable, Iterator, Mapping
 
-import requests
-import tiktoken
+import aiohttp
 import tqdm
 
-from lib.data import get_data_path
+from lib.cache import ResponseCache
+from lib.cache_server import RemoteCache, TieredCache
+from lib.data import get_data_path, load_json, dump_json
+from lib.ledger import Ledger
+from lib.openai_batch import OpenAIBatchClient, LocalBatchClient, is_terminal_batch_status
+from lib.ratelimit import AdaptiveConcurrency, RateLimiter
+from lib.retry import LatencyPercentile, RetryBudget, RetryPolicy, is_retryable
+from lib.scheduling import LookaheadQueue, order_by_prefix
+from lib.tokens import get_token_counter
+from lib.tracing import Metrics, RequestTrace, Tracer
 
 logger = logging.getLogger(__name__)
 
-_completion_url = "https://api.openai.com/v1/completions"
-_chat_url = "https://api.openai.com/v1/chat/completions"
+_base_url = "https://api.openai.com/v1"  # can be overridden with the environment variable `OPENAI_BASE_URL`
+_credentials_path_variable = "OPENAI_CREDENTIALS_PATH"  # JSON file with a list of credentials to use instead
+_completion_url_path = "/completions"
+_chat_url_path = "/chat/completions"
+_initial_in_flight = 32
+_max_in_flight = 512
+_min_headroom = 0.05  # share of the API limits below which the requests in flight are reduced
+_max_connections = 64
+_keepalive_timeout = 60.0
+_request_timeout = 600.0
+_lease_poll_interval = 1.0
+_retry_policy = RetryPolicy(max_attempts=6, base_delay=1.0, max_delay=60.0, jitter=0.5)
+_retry_budget_ratio = 0.2  # share of the requests in a run that may be retried
+_min_retry_budget = 100
+_hedge_budget_factor = 2.0  # hedges per request that is expected to be slower than the hedging percentile
+_min_hedge_budget = 10
+_stream_window = 1_024  # number of requests that are held at once when executing a stream of requests
+_hedge_window = 1_000  # number of recent latencies from which the hedging threshold is estimated
+_hedge_min_samples = 20
 _additional_tokens_per_message = 10
+_min_cached_prefix_tokens = 1024  # prompts below this length are not cached by the provider
+_lookahead_window = 64  # number of requests that may overtake a request that does not fit into the token limits yet
+_max_lookahead_skips = 64  # number of times a request may be overtaken before the executor waits for it
 _cost_for_failed_requests = 0.0
 _usage_for_failed_requests = 0
-_wait_window = 70.0
-_wait_before_retry = 0.1
-_wait_before_try = 0.001
 _api_share = 0.3
 _cache_path = get_data_path() / "openai_cache"
 _cache_size = 100_000
+_cache_max_bytes = 10_000_000_000
+_cache_storage = "segments"  # use "files" to store one JSON file per pair like `openai_cache.zip`
+_cache_url_variable = "OPENAI_CACHE_URL"  # URL of a cache server that several nodes share, see lib/cache_server.py
+_batch_path = get_data_path() / "openai_batches"
+_batch_max_requests = 50_000
+_batch_max_bytes = 100_000_000
+_batch_completion_window = "24h"
+_batch_poll_interval = 30.0
+_batch_discount = 0.5
+_metrics_path_variable = "OPENAI_METRICS_PATH"  # file to which the metrics are written in the Prometheus text format
+_metrics_port_variable = "OPENAI_METRICS_PORT"  # port on which the metrics are served in the Prometheus text format
+_metrics_interval = 5.0
 
 # pricing: https://openai.com/pricing
 # context: https://platform.openai.com/docs/models
@@ -59,6 +107,172 @@ _model_parameters = {
     }
 }
 
+_required_model_parameters = ("chat_or_completion", "max_rpm", "max_tpm", "cost_per_1k_input_tokens",
+                              "cost_per_1k_output_tokens", "max_context", "max_output_tokens")
+
+_cache: ResponseCache | TieredCache | None = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache() -> ResponseCache | TieredCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            os.makedirs(_cache_path, exist_ok=True)
+            _cache = ResponseCache(_cache_path, max_entries=_cache_size, max_bytes=_cache_max_bytes,
+                                   storage=_cache_storage)
+            if _cache_url_variable in os.environ.keys():
+                _cache = TieredCache(_cache, RemoteCache(os.environ[_cache_url_variable]))
+                logger.info(f"Use the cache server {_cache.remote.url} in front of the local cache.")
+            atexit.register(_cache.close)
+        return _cache
+
+
+_metrics = Metrics()
+_metrics.describe("openai_requests_total", "counter", "Requests by model, cache outcome, and final HTTP status.")
+_metrics.describe("openai_retries_total", "counter", "Retried attempts by model.")
+_metrics.describe("openai_hedges_total", "counter", "Duplicates of slow requests by model and winning request.")
+_metrics.describe("openai_tokens_total", "counter", "Tokens used by executed requests by model.")
+_metrics.describe("openai_cached_tokens_total", "counter", "Prompt tokens served from the provider's prompt cache.")
+_metrics.describe("openai_blocked_seconds_total", "counter", "Time requests waited for each limiter.")
+_metrics.describe("openai_cache_seconds_total", "counter", "Time spent in cache lookups and writes by operation.")
+_metrics.describe("openai_cost_dollars_total", "counter", "Actual cost of executed requests by model.")
+_metrics.describe("openai_in_flight", "gauge", "Requests in flight.")
+_metrics.describe("openai_in_flight_limit", "gauge", "Limit of requests in flight.")
+_metrics.describe("openai_queue_seconds", "histogram", "Time from the start of the run until a request is admitted.")
+_metrics.describe("openai_request_seconds", "histogram", "Time from sending a request until it is done.")
+_metrics.describe("openai_first_byte_seconds", "histogram", "Time from sending a request until the headers arrive.")
+
+
+async def _put_cached_pair(request_hash: str, pair: dict) -> None:
+    cache = _get_cache()
+    if isinstance(cache, TieredCache):
+        # the remote tier blocks on the network, so keep it off the event loop
+        await asyncio.to_thread(cache.put, request_hash, pair)
+    else:
+        cache.put(request_hash, pair)
+
+
+def _export_metrics() -> None:
+    if _metrics_port_variable in os.environ.keys():
+        _metrics.serve("127.0.0.1", int(os.environ[_metrics_port_variable]))
+    if _metrics_path_variable in os.environ.keys():
+        _metrics.write(pathlib.Path(os.environ[_metrics_path_variable]))
+
+
+def _observe_cache_time(trace: RequestTrace | None, operation: str, seconds: float) -> None:
+    _metrics.inc("openai_cache_seconds_total", seconds, operation=operation)
+    if trace is not None:
+        trace.cache_seconds += seconds
+
+
+def _trace_cache(trace: RequestTrace | None, outcome: str) -> None:
+    if trace is not None:
+        trace.cache = outcome
+
+
+@dataclasses.dataclass
+class Credential:
+    """Endpoint and API key for an OpenAI-compatible API, each of which has its own rate limits."""
+    base_url: str
+    api_key: str
+    name: str = ""
+    headers: dict[str, str] = dataclasses.field(default_factory=dict)  # e.g., for gateways that need more headers
+    params: dict[str, str] = dataclasses.field(default_factory=dict)  # URL query parameters, e.g., `api-version`
+    models: list[str] | None = None  # the models that are served by this endpoint or None for all models
+    share: float | None = None  # the share of the API limits that may be used, defaults to `_api_share`
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return self.base_url, self.api_key
+
+    @property
+    def display_name(self) -> str:
+        return self.name if self.name != "" else self.base_url
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+
+_rate_limiters: dict[tuple[str, str], RateLimiter] = {}
+_rate_limiter_credentials: dict[tuple[str, str], Credential] = {}
+
+
+def _get_rate_limiter(credential: Credential) -> RateLimiter:
+    # the rate limiters outlive the runs, so that consecutive runs do not exceed the limits
+    if credential.key not in _rate_limiters.keys():
+        share = _api_share if credential.share is None else credential.share
+        _rate_limiters[credential.key] = RateLimiter(_model_parameters, share)
+        _rate_limiter_credentials[credential.key] = credential
+    return _rate_limiters[credential.key]
+
+
+def _is_credential_failure(status: int | None, response: "_Response") -> bool:
+    # invalid keys and exhausted quotas do not recover within a run
+    error = response.response.get("error")
+    is_quota_exhausted = isinstance(error, dict) and error.get("code") == "insufficient_quota"
+    return status in (401, 403) or (status == 429 and is_quota_exhausted)
+
+
+class _CredentialPool:
+    """Credentials of one run, to which requests are distributed according to their rate limiters."""
+    credentials: list[Credential]
+
+    def __init__(self, credentials: list[Credential]) -> None:
+        self.credentials = credentials
+        self._disabled = set()  # (credential key, model)
+        self._next = 0
+
+    async def acquire(self, model: str, tokens: int, trace: RequestTrace | None = None) -> Credential:
+        while True:
+            credential, wait_times = self._try_acquire(model, tokens)
+            if credential is not None:
+                return credential
+            wait_time, blocker = min(wait_times, key=lambda w: w[0])
+            logger.debug(f"Sleep {wait_time:.3f} seconds to abide the limits of model '{model}'.")
+            start_time = time.monotonic()
+            await asyncio.sleep(wait_time)
+            if trace is not None:
+                trace.add_blocked(blocker, time.monotonic() - start_time)
+
+    def try_acquire(self, model: str, tokens: int, wait_times: list[tuple[float, str | None]]) -> Credential | None:
+        # if no credential admits the request, add how long to wait for the soonest one and the limit that blocks
+        credential, credential_wait_times = self._try_acquire(model, tokens)
+        if credential is None:
+            wait_times.append(min(credential_wait_times, key=lambda w: w[0]))
+        return credential
+
+    def _try_acquire(self, model: str, tokens: int) -> tuple[Credential | None, list[tuple[float, str | None]]]:
+        # go round-robin through the credentials and take the first one whose rate limiter admits the request
+        wait_times = []  # [(wait time, limit that blocks), ...]
+        for offset in range(len(self.credentials)):
+            credential = self.credentials[(self._next + offset) % len(self.credentials)]
+            if not credential.serves(model) or (credential.key, model) in self._disabled:
+                continue
+            rate_limiter = _get_rate_limiter(credential)
+            wait_time = rate_limiter.try_acquire(model, tokens)
+            if wait_time == 0:
+                self._next = (self._next + offset + 1) % len(self.credentials)
+                return credential, []
+            wait_times.append((wait_time, rate_limiter.blocker(model)))
+        if len(wait_times) == 0:
+            raise AssertionError(f"No credential can be used for model '{model}'!")
+        return None, wait_times
+
+    def disable(self, credential: Credential, model: str, response: "_Response") -> bool:
+        # keep the last credential, so that the failures are reported instead of an error about missing credentials
+        remaining = [c for c in self.credentials if c.serves(model) and (c.key, model) not in self._disabled]
+        if credential not in remaining:
+            return len(remaining) > 0  # another request has already disabled the credential
+        if len(remaining) == 1:
+            return False
+        logger.warning(f"Stop using '{credential.display_name}' for model '{model}': {json.dumps(response.response)}")
+        self._disabled.add((credential.key, model))
+        return True
+
+
+_execution_stats: dict | None = None
+
 
 def _get_model_params(model: str) -> dict:
     if model not in _model_parameters.keys():
@@ -72,6 +286,9 @@ class _Request:
 
     def __init__(self, request: dict) -> None:
         self.request = request
+        self._input_tokens = None
+        self._hash = None
+        self.is_known_missing = False  # whether all cache tiers missed, so that only the local cache is asked again
 
     @property
     def model(self) -> str:
@@ -95,17 +312,40 @@ class _Request:
         return _get_model_params(self.model)[
             "chat_or_completion"]  # use `model` to determine if request is for chat or completion
 
-    def estimate_input_tokens(self) -> int:
-        encoding = tiktoken.encoding_for_model(self.model)
-
+    def texts_to_encode(self) -> list[str]:
         if self.is_chat_or_completion() == "chat":
-            extra_tokens = _additional_tokens_per_message
-            return sum(len(encoding.encode(message["content"])) + extra_tokens for message in self.messages)
+            return [message["content"] for message in self.messages]
         elif self.is_chat_or_completion() == "completion":
-            return len(encoding.encode(self.prompt))
+            return [self.prompt]
         else:
             raise AssertionError(f"Invalid parameter `chat_or_completion` for model '{self.model}'!")
 
+    def estimate_input_tokens(self) -> int:
+        if self._input_tokens is None:
+            num_tokens = get_token_counter().count_many(self.texts_to_encode(), self.model)
+            if self.is_chat_or_completion() == "chat":
+                self._input_tokens = sum(num_tokens) + len(num_tokens) * _additional_tokens_per_message
+            else:
+                self._input_tokens = sum(num_tokens)
+        return self._input_tokens
+
+    def prefix_segments(self) -> list[str]:
+        # the provider caches prompt prefixes, so requests that share their first segments share a cached prefix
+        if self.is_chat_or_completion() == "chat":
+            segments = [json.dumps(message, sort_keys=True) for message in self.messages]
+        else:
+            segments = self.prompt.splitlines(keepends=True)
+        return [hashlib.sha256(bytes(segment, "utf-8")).hexdigest() for segment in segments]
+
+    def estimate_first_segment_tokens(self) -> int:
+        if self.is_chat_or_completion() == "chat":
+            if len(self.messages) == 0:
+                return 0
+            return get_token_counter().count(self.messages[0]["content"], self.model) + _additional_tokens_per_message
+        else:
+            lines = self.prompt.splitlines(keepends=True)
+            return 0 if len(lines) == 0 else get_token_counter().count(lines[0], self.model)
+
     def estimate_max_output_tokens(self) -> int:
         if "max_tokens" in self.request.keys() and self.request["max_tokens"] is not None:
             return self.request["max_tokens"]
@@ -174,49 +414,305 @@ class _Request:
             logger.warning("The request's field `temperature` is not set to 0, which is required for reproducibility!")
 
     def compute_hash(self) -> str:
+        if self._hash is None:
+            self._hash = _hash_request(self.request)
+        return self._hash
+
+    def compute_legacy_hash(self) -> str:
+        # pairs that were cached before the hashing became canonical are keyed by the request as it was serialized
         return hashlib.sha256(bytes(json.dumps(self.request), "utf-8")).hexdigest()
 
-    def load_cached_response(self):  # -> Response | None
-        matching_file_paths = list(sorted(_cache_path.glob(f"*-{self.compute_hash()}.json")))
-        if len(matching_file_paths) > 0:
-            matching_file_path = matching_file_paths[0]
-            with open(matching_file_path, "r", encoding="utf-8") as file:
-                cached_pair = json.load(file)
-                cached_request = _Request(cached_pair["request"])
-                cached_response = _Response(cached_pair["response"])
-                if self.request == cached_request.request:
-                    return cached_response
+    def load_cached_response(self, remote: bool = True):  # -> Response | None
+        cache = _get_cache()
+        if not remote and isinstance(cache, TieredCache):
+            cache = cache.local
+        # a single lookup, so that a remote cache tier answers both hashes in one round trip
+        cached_pair = cache.get_first([self.compute_hash(), self.compute_legacy_hash()])
+        if cached_pair is not None:
+            cached_request = _Request(cached_pair["request"])
+            cached_response = _Response(cached_pair["response"])
+            if self.request == cached_request.request:
+                return cached_response
         return None
 
-    def execute(self) -> tuple["_Response", bool]:
-        response = self.load_cached_response()
-        if response is not None:
-            return response, True
-
+    async def send(
+            self,
+            session: aiohttp.ClientSession,
+            credential: Credential,
+            trace: RequestTrace | None = None,
+            stop: Callable[[str], int | None] | None = None
+    ) -> tuple["_Response", int | None, Mapping[str, str]]:
         if self.is_chat_or_completion() == "chat":
-            url = _chat_url
+            url = credential.base_url + _chat_url_path
         elif self.is_chat_or_completion() == "completion":
-            url = _completion_url
+            url = credential.base_url + _completion_url_path
         else:
             raise AssertionError(f"Invalid parameter `chat_or_completion` for model '{self.model}'!")
 
-        http_response = requests.post(
-            url=url,
-            json=self.request,
-            headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"}
-        )
-        response = _Response(http_response.json())
+        # only responses with a single choice are streamed, since the stop detector sees one generated text
+        stream = stop is not None and self.request.get("n", 1) == 1
+        body = {**self.request, "stream": True, "stream_options": {"include_usage": True}} if stream else self.request
+        try:
+            async with session.post(
+                    url=url,
+                    params=credential.params,
+                    json=body,
+                    headers={"Content-Type": "application/json", "Authorization": f"Bearer {credential.api_key}",
+                             **credential.headers}
+            ) as http_response:
+                status = http_response.status
+                headers = http_response.headers
+                if trace is not None:
+                    trace.first_byte = time.monotonic()
+                if stream and status == 200:
+                    return _Response(await self._read_stream(http_response, stop)), status, headers
+                content = await http_response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return _Response({"error": {"message": repr(e), "type": "connection_error"}}), None, {}
+
+        try:
+            response = _Response(json.loads(content))
+        except json.JSONDecodeError:
+            response = _Response({"error": {"message": content, "type": "invalid_response"}})
+        return response, status, headers
+
+    async def _read_stream(
+            self,
+            http_response: aiohttp.ClientResponse,
+            stop: Callable[[str], int | None]
+    ) -> dict:
+        # assemble the chunks of the server-sent events into a response and close the stream once the output is complete
+        response = {"object": "chat.completion" if self.is_chat_or_completion() == "chat" else "text_completion"}
+        finish_reason, end = None, None
+        text = ""
+        async for line in http_response.content:
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:"):].strip()
+            if data == b"[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                return {"error": {"message": data.decode("utf-8", "replace"), "type": "invalid_response"}}
+            if "error" in chunk.keys():
+                return chunk
+            for key in ("id", "created", "model", "system_fingerprint"):
+                if key in chunk.keys():
+                    response[key] = chunk[key]
+            if chunk.get("usage") is not None:
+                response["usage"] = chunk["usage"]
+            for choice in chunk.get("choices", []):
+                text += choice.get("delta", {}).get("content") or choice.get("text") or ""
+                finish_reason = choice.get("finish_reason") or finish_reason
+
+            end = stop(text)
+            if end is not None:
+                break
+
+        if "usage" not in response.keys():
+            # the usage is only sent at the end of the stream (if the server supports `stream_options` at all), so
+            # estimate it from the generated text
+            completion_tokens = get_token_counter().count(text, self.model)
+            response["usage"] = {"prompt_tokens": self.estimate_input_tokens(),
+                                 "completion_tokens": completion_tokens,
+                                 "total_tokens": self.estimate_input_tokens() + completion_tokens}
+        if end is not None:
+            text, finish_reason = text[:end], "stop"
 
-        if http_response.status_code != 200:
-            logger.warning(f"Request failed: {http_response.content}")
+        if self.is_chat_or_completion() == "chat":
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}
         else:
-            request_hash = self.compute_hash()
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
-            cache_file_path = _cache_path / f"{timestamp}-{request_hash}.json"
-            with open(cache_file_path, "w", encoding="utf-8") as cache_file:
-                json.dump({"request": self.request, "response": response.response}, cache_file)
+            choice = {"index": 0, "text": text, "finish_reason": finish_reason}
+        return {**response, "choices": [choice]}
+
+    async def execute(
+            self,
+            session: aiohttp.ClientSession,
+            credential: Credential,
+            pool: "_CredentialPool",
+            *,
+            retry_budget: RetryBudget | None = None,
+            concurrency: AdaptiveConcurrency | None = None,
+            trace: RequestTrace | None = None,
+            stop: Callable[[str], int | None] | None = None,
+            hedging: "_Hedging | None" = None
+    ) -> tuple["_Response", bool, Credential]:
+        response = await self._load_cached_response_timed(trace, remote=not self.is_known_missing)
+        if response is not None:
+            _trace_cache(trace, "hit")
+            return response, True, credential
+
+        # coalesce with other processes that execute the same request by waiting for their response to be cached,
+        # the leases are held in the local cache, so the leaseholder's response shows up there
+        request_hash = self.compute_hash()
+        while not _get_cache().try_lease(request_hash, _request_timeout * _retry_policy.max_attempts):
+            await asyncio.sleep(_lease_poll_interval)
+            response = await self._load_cached_response_timed(trace, remote=False)
+            if response is not None:
+                _trace_cache(trace, "coalesced")
+                return response, True, credential
+        try:
+            response = await self._load_cached_response_timed(trace, remote=False)
+            if response is not None:
+                _trace_cache(trace, "coalesced")
+                return response, True, credential
+            _trace_cache(trace, "miss")
+            return await self._send_with_retries(session, credential, pool, retry_budget, concurrency, trace, stop,
+                                                 hedging)
+        finally:
+            _get_cache().release_lease(request_hash)
+
+    async def _load_cached_response_timed(self, trace: RequestTrace | None, remote: bool):  # -> Response | None
+        start_time = time.monotonic()
+        if remote and isinstance(_get_cache(), TieredCache):
+            # the remote tier blocks on the network, so keep it off the event loop
+            response = await asyncio.to_thread(self.load_cached_response)
+        else:
+            response = self.load_cached_response(remote=False)
+        _observe_cache_time(trace, "get", time.monotonic() - start_time)
+        return response
+
+    async def _send_with_retries(
+            self,
+            session: aiohttp.ClientSession,
+            credential: Credential,
+            pool: "_CredentialPool",
+            retry_budget: RetryBudget | None,
+            concurrency: AdaptiveConcurrency | None,
+            trace: RequestTrace | None,
+            stop: Callable[[str], int | None] | None,
+            hedging: "_Hedging | None"
+    ) -> tuple["_Response", bool, Credential]:
+        usage = self.estimate_max_total_usage()
+        attempt = 0
+        while True:
+            if trace is not None:
+                if trace.sent is None:
+                    trace.sent = time.monotonic()
+                trace.attempts += 1
+            if hedging is None:
+                response, status, headers = await self.send(session, credential, trace, stop)
+            else:
+                response, status, headers, credential = await self._send_hedged(
+                    session, credential, pool, trace, stop, hedging)
+            if trace is not None:
+                trace.status = status
+            rate_limiter = _get_rate_limiter(credential)
+            headroom = rate_limiter.observe(self.model, headers)
+            if concurrency is not None:
+                if status == 429 or (headroom is not None and headroom < _min_headroom):
+                    concurrency.on_overload()
+                elif status == 200:
+                    concurrency.on_success()
+            if status == 200:
+                start_time = time.monotonic()
+                await _put_cached_pair(self.compute_hash(), {"request": self.request, "response": response.response})
+                _observe_cache_time(trace, "put", time.monotonic() - start_time)
+                return response, False, credential
+
+            if _is_credential_failure(status, response) and pool.disable(credential, self.model, response):
+                # fail over to the remaining credentials without waiting
+                rate_limiter.reconcile(self.model, usage, 0)
+                credential = await pool.acquire(self.model, usage, trace)
+                continue
+
+            if not is_retryable(status) or attempt + 1 >= _retry_policy.max_attempts or (
+                    retry_budget is not None and not retry_budget.try_spend()):
+                logger.warning(f"Request failed: {json.dumps(response.response)}")
+                return response, False, credential
+
+            delay = _retry_policy.compute_delay(attempt, headers, status)
+            if status == 429:
+                # slow down the admission of all requests for this model instead of hammering the API
+                rate_limiter.pause(self.model, delay)
+            logger.info(f"Request failed with status {status}, retry in {delay:.2f} seconds.")
+
+            # the failed attempt did not use tokens, but the retry must be admitted like a new request, which may go
+            # to another credential that is not paused
+            rate_limiter.reconcile(self.model, usage, 0)
+            start_time = time.monotonic()
+            await asyncio.sleep(delay)
+            if trace is not None:
+                trace.add_blocked("retry", time.monotonic() - start_time)
+            credential = await pool.acquire(self.model, usage, trace)
+            attempt += 1
+
+    async def _send_hedged(
+            self,
+            session: aiohttp.ClientSession,
+            credential: Credential,
+            pool: "_CredentialPool",
+            trace: RequestTrace | None,
+            stop: Callable[[str], int | None] | None,
+            hedging: "_Hedging"
+    ) -> tuple["_Response", int | None, Mapping[str, str], Credential]:
+        start_time = time.monotonic()
+        primary = asyncio.create_task(self.send(session, credential, trace, stop))
+        await asyncio.wait([primary], timeout=hedging.latency.estimate())
+        max_cost = None if primary.done() else hedging.try_reserve(self)
+        if max_cost is not None:
+            hedge_credential = await pool.acquire(self.model, self.estimate_max_total_usage(), trace)
+            if primary.done():
+                hedging.settle(self, hedge_credential, None, max_cost)
+                max_cost = None
+        if max_cost is None:
+            response, status, headers = await primary
+            if status == 200:
+                hedging.latency.observe(time.monotonic() - start_time)
+            return response, status, headers, credential
+
+        # send a duplicate, take the first successful response, and cancel the other request
+        if trace is not None:
+            trace.hedges += 1
+        credentials = {primary: credential,
+                       asyncio.create_task(self.send(session, hedge_credential, None, stop)): hedge_credential}
+        pending = set(credentials.keys())
+        winner = None
+        while winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            successful = [task for task in done if task.result()[1] == 200]
+            if len(successful) > 0:
+                winner = successful[0]
+            elif len(pending) == 0:
+                winner = primary
+        (loser,) = set(credentials.keys()) - {winner}
+        if not loser.done():
+            loser.cancel()
+        response, status, headers = winner.result()
+
+        # the provider charges a cancelled request like the one that has finished, since it is the same request
+        loser_response = response if loser.cancelled() or not loser.done() else loser.result()[0]
+        hedging.settle(self, credentials[loser], loser_response, max_cost, won=winner is not primary)
+        if status == 200:
+            hedging.latency.observe(time.monotonic() - start_time)
+        return response, status, headers, credentials[winner]
+
+
+def _hash_request(request: dict) -> str:
+    """Compute the canonical hash of a request, which does not depend on the order of the keys or on how numbers are
+    written.
+
+    >>> _hash_request({"model": "gpt-4", "temperature": 0}) == _hash_request({"temperature": 0.0, "model": "gpt-4"})
+    True
+    """
+    return hashlib.sha256(bytes(json.dumps(_canonicalize(request), sort_keys=True, separators=(",", ":")),
+                                "utf-8")).hexdigest()
+
 
-        return response, False
+def _canonicalize(value):
+    """Normalize the numbers in a JSON value, i.e., floats without a fractional part become integers.
+
+    >>> _canonicalize({"temperature": 1.0, "top_p": 0.50, "logit_bias": {"50256": -100.0}, "n": 1, "stream": False})
+    {'temperature': 1, 'top_p': 0.5, 'logit_bias': {'50256': -100}, 'n': 1, 'stream': False}
+    """
+    if isinstance(value, dict):
+        return {key: _canonicalize(v) for key, v in value.items()}
+    elif isinstance(value, list):
+        return [_canonicalize(v) for v in value]
+    elif isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
 
 
 class _Response:
@@ -246,12 +742,23 @@ class _Response:
         else:
             return _usage_for_failed_requests
 
+    def compute_cached_prompt_tokens(self) -> int:
+        # prompt tokens that the provider has served from its prompt cache
+        if self.was_successful():
+            return (self.usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return 0
+
     def compute_total_cost(self) -> float:
         if self.was_successful():
             model_params = _get_model_params(self.model)
             total_cost = 0
             if "prompt_tokens" in self.usage.keys():
-                total_cost += self.usage["prompt_tokens"] * (model_params["cost_per_1k_input_tokens"] / 1000)
+                cached_tokens = self.compute_cached_prompt_tokens()
+                cost_per_1k_cached_tokens = model_params.get("cost_per_1k_cached_input_tokens",
+                                                             model_params["cost_per_1k_input_tokens"])
+                total_cost += (self.usage["prompt_tokens"] - cached_tokens) * (
+                        model_params["cost_per_1k_input_tokens"] / 1000)
+                total_cost += cached_tokens * (cost_per_1k_cached_tokens / 1000)
             if "completion_tokens" in self.usage.keys():
                 total_cost += self.usage["completion_tokens"] * (model_params["cost_per_1k_output_tokens"] / 1000)
             return total_cost
@@ -273,54 +780,867 @@ def openai_model(
     return _get_model_params(model)
 
 
-@dataclasses.dataclass
+def openai_register_model(
+        model: str,
+        parameters: dict
+) -> None:
+    """Register a model (or replace the parameters of a model), e.g., one that is served by an OpenAI-compatible API.
+
+    Args:
+        model: The name of the model.
+        parameters: The parameters of the model like those in `_model_parameters`, i.e., `chat_or_completion`,
+            `max_rpm`, `max_tpm`, `cost_per_1k_input_tokens`, `cost_per_1k_output_tokens`, `max_context`, and
+            `max_output_tokens`, and optionally `cost_per_1k_cached_input_tokens` and `tokenizer` (the name of the
+            tiktoken encoding for models that tiktoken does not know).
+    """
+    missing = [key for key in _required_model_parameters if key not in parameters.keys()]
+    if len(missing) > 0:
+        raise AssertionError(f"The parameters of model '{model}' are missing {', '.join(missing)}!")
+    if parameters["chat_or_completion"] not in ("chat", "completion"):
+        raise AssertionError(f"Invalid parameter `chat_or_completion` for model '{model}'!")
+    _model_parameters[model] = dict(parameters)
+    if parameters.get("tokenizer") is not None:
+        get_token_counter().register_encoding(model, parameters["tokenizer"])
+
+
+def openai_rate_limits() -> dict:
+    """Get the current state of the rate limiters.
+
+    Returns:
+        A dictionary that maps the name of each credential that has been used to the state of the requests and tokens
+        buckets for each model that has been used with it.
+    """
+    return {_rate_limiter_credentials[key].display_name: _rate_limiters[key].state() for key in _rate_limiters.keys()}
+
+
+def openai_credentials() -> list[Credential]:
+    """Get the endpoints and API keys that are used by default.
+
+    These are the credentials in the JSON file at the path given by the environment variable `OPENAI_CREDENTIALS_PATH`
+    (a list of objects with the fields of `Credential`) or otherwise the endpoint given by `OPENAI_BASE_URL` (or the
+    OpenAI API) with the key given by `OPENAI_API_KEY`.
+
+    Returns:
+        The list of credentials.
+    """
+    if _credentials_path_variable in os.environ.keys():
+        credentials = load_json(pathlib.Path(os.environ[_credentials_path_variable]))
+        return [Credential(**credential) for credential in credentials]
+    return [Credential(os.environ.get("OPENAI_BASE_URL", _base_url), os.environ["OPENAI_API_KEY"])]
+
+
+def _resolve_credentials(credentials: list[Credential] | Callable[[], list[Credential]] | None) -> list[Credential]:
+    if credentials is None:
+        return openai_credentials()
+    elif callable(credentials):
+        return credentials()
+    else:
+        return credentials
+
+
+def openai_metrics() -> Metrics:
+    """Get the metrics of the executor, which are accumulated over all executions in this process.
+
+    Returns:
+        The metrics, which can be rendered in the Prometheus text format.
+    """
+    return _metrics
+
+
+def openai_execution_stats() -> dict | None:
+    """Get statistics about the last execution of `openai_execute`.
+
+    Returns:
+        None if nothing has been executed yet, otherwise a dictionary with the number of executed requests, retries, and
+        duplicates of slow requests, the wall-clock time and the CPU time of the scheduler (i.e., the event loop that
+        admits, sends, and processes the requests) in seconds, the numbers of prompt, cached prompt, and completion
+        tokens, the latencies of the requests (including retries) in seconds, and the final limit of requests in flight.
+    """
+    return _execution_stats
+
+
+@dataclasses.dataclass(slots=True)
 class _Pair:
     request: _Request
+    index: int
     response: _Response | None = None
     was_cached: bool = False
     usage: int | None = None
-    finished_time: float | None = None
-    thread: threading.Thread | None = None
+    task: asyncio.Task | None = None
+    duplicates: list["_Pair"] = dataclasses.field(default_factory=list)
+    trace: RequestTrace | None = None
+    leader: "_Pair | None" = None  # pair whose prompt prefix must be cached by the provider before this one is sent
+
+    def fan_out(self, on_response: Callable[[int, dict], None] | None) -> None:
+        # duplicates share the response of the pair that has actually been executed
+        for duplicate in self.duplicates:
+            duplicate.response = self.response
+            duplicate.was_cached = True
+            if on_response is not None:
+                on_response(duplicate.index, duplicate.response.response)
+
+
+class _Spending:
+    """Actual cost of a run and maximum cost of the requests in flight, which must not exceed the budget together."""
+    budget: float | None
+    spent: float
+    reserved: float
+
+    def __init__(self, budget: float | None, num_requests: int) -> None:
+        self.budget = budget
+        self.spent = 0.0
+        self.reserved = 0.0
+        self._num_reserved = 0
+        self._num_requests = num_requests
+        self._num_settled = 0
+        self._start_time = time.monotonic()
+        self._settled = asyncio.Event()
+
+    async def reserve(self, max_cost: float) -> bool:
+        # wait for requests in flight to settle, since they usually cost much less than their maximum cost
+        while not self.try_reserve(max_cost):
+            if self._num_reserved == 0:
+                return False
+            self._settled.clear()
+            await self._settled.wait()
+        return True
+
+    def try_reserve(self, max_cost: float) -> bool:
+        if self.budget is not None and self.spent + self.reserved + max_cost > self.budget:
+            return False
+        self.reserved += max_cost
+        self._num_reserved += 1
+        return True
+
+    def settle(self, max_cost: float, cost: float) -> None:
+        self.reserved = 0.0 if self._num_reserved == 1 else self.reserved - max_cost
+        self._num_reserved -= 1
+        self.spent += cost
+        self._num_settled += 1
+        self._settled.set()
+
+    def describe(self) -> str:
+        minutes = (time.monotonic() - self._start_time) / 60
+        projected = self.spent / max(self._num_settled, 1) * self._num_requests
+        return f"${self.spent:.2f} spent, ${self.spent / max(minutes, 1e-9):.2f}/min, ~${projected:.2f} projected"
+
+
+class _Hedging:
+    """Duplicates of slow requests, which are charged to the rate limiters, the budget, and the ledger like any other
+    request."""
+    latency: LatencyPercentile
+    num_hedges: int
+    num_won: int
+
+    def __init__(self, percentile: float, max_hedges: int, spending: _Spending, ledger: Ledger | None) -> None:
+        self.latency = LatencyPercentile(percentile, window=_hedge_window, min_samples=_hedge_min_samples)
+        self.num_hedges = 0
+        self.num_won = 0
+        self._budget = RetryBudget(max_hedges)
+        self._spending = spending
+        self._ledger = ledger
+
+    def try_reserve(self, request: _Request) -> float | None:
+        # hedge only if the duplicate fits into the budget right away, since the request is already in flight
+        max_cost = request.estimate_max_cost()
+        if not self._budget.try_spend() or not self._spending.try_reserve(max_cost):
+            return None
+        return max_cost
+
+    def settle(self, request: _Request, credential: Credential, response: _Response | None, max_cost: float, *,
+               won: bool = False) -> None:
+        # settle the request that has lost the race (or the reservation for a duplicate that was not sent after all)
+        actual_usage = 0 if response is None else response.compute_total_usage()
+        _get_rate_limiter(credential).reconcile(request.model, request.estimate_max_total_usage(), actual_usage)
+        cost = 0.0 if response is None else response.compute_total_cost()
+        self._spending.settle(max_cost, cost)
+        if response is None:
+            return
+        self.num_hedges += 1
+        self.num_won += won
+        if self._ledger is not None:
+            self._ledger.record(request.model, request.compute_hash(), "hedge", response.response, cost)
+        _metrics.inc("openai_hedges_total", model=request.model, winner="hedge" if won else "primary")
+
+
+async def _execute_pairs(
+        pairs_to_execute: list[_Pair],
+        pool: _CredentialPool | None,
+        progress_bar: tqdm.tqdm,
+        on_response: Callable[[int, dict], None] | None,
+        spending: _Spending,
+        ledger: Ledger | None,
+        tracer: Tracer,
+        stop_detector: Callable[[int, str], int | None] | None,
+        hedge_percentile: float | None,
+        lookahead: int
+) -> None:
+    connector = aiohttp.TCPConnector(limit=_max_connections, keepalive_timeout=_keepalive_timeout)
+    timeout = aiohttp.ClientTimeout(total=_request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        in_flight = AdaptiveConcurrency(_initial_in_flight, maximum=_max_in_flight)
+        retry_budget = RetryBudget(max(_min_retry_budget, int(len(pairs_to_execute) * _retry_budget_ratio)))
+        hedging = None
+        if hedge_percentile is not None:
+            max_hedges = int(len(pairs_to_execute) * (1 - hedge_percentile) * _hedge_budget_factor)
+            max_hedges = max(_min_hedge_budget, max_hedges)
+            hedging = _Hedging(hedge_percentile, max_hedges, spending, ledger)
+        latencies = []
+        start_time, start_cpu_time = time.monotonic(), time.thread_time()
+        for pair in pairs_to_execute:
+            pair.trace = RequestTrace(pair.index, pair.request.model, pair.request.compute_hash(), pair.usage,
+                                      tracer.start_time)
+
+        async def export_metrics() -> None:
+            while True:
+                _metrics.set("openai_in_flight", in_flight.in_flight)
+                _metrics.set("openai_in_flight_limit", in_flight.limit)
+                _export_metrics()
+                await asyncio.sleep(_metrics_interval)
+
+        async def execute(p: _Pair, credential: Credential, max_cost: float) -> None:
+            try:
+                request_start_time = time.monotonic()
+                stop = None if stop_detector is None else functools.partial(stop_detector, p.index)
+                p.response, p.was_cached, credential = await p.request.execute(
+                    session, credential, pool, retry_budget=retry_budget, concurrency=in_flight, trace=p.trace,
+                    stop=stop, hedging=hedging)
+                latencies.append(time.monotonic() - request_start_time)
+                _settle_pair(p, credential, max_cost, spending, ledger, tracer)
+                if on_response is not None:
+                    on_response(p.index, p.response.response)
+                p.fan_out(on_response)
+                progress_bar.update(1 + len(p.duplicates))
+                progress_bar.set_postfix_str(spending.describe(), refresh=False)
+            finally:
+                in_flight.release()
+
+        exporter = asyncio.create_task(export_metrics())
+        pairs_to_skip = []
+        queue = LookaheadQueue(pairs_to_execute, window=lookahead, max_skips=_max_lookahead_skips)
+        while len(queue) > 0:
+            leader = queue.head().leader
+            if leader is not None and leader.task is not None and not leader.task.done():
+                # the provider caches the prompt prefix of a request only once it has processed it
+                wait_start_time = time.monotonic()
+                await asyncio.wait([leader.task])
+                queue.head().trace.add_blocked("prefix", time.monotonic() - wait_start_time)
+
+            # charge the rate limiter only once the request can be sent right away
+            wait_start_time = time.monotonic()
+            await in_flight.acquire()
+            concurrency_wait_time = time.monotonic() - wait_start_time
+            # let a later request that fits into the rate limits overtake the head if the head does not fit yet
+            while True:
+                wait_times = []
+                admitted = queue.pop_first(lambda p: pool.try_acquire(p.request.model, p.usage, wait_times))
+                if admitted is not None:
+                    break
+                wait_time, blocker = min(wait_times, key=lambda w: w[0])
+                logger.debug(f"Sleep {wait_time:.3f} seconds to abide the limits.")
+                wait_start_time = time.monotonic()
+                await asyncio.sleep(wait_time)
+                queue.head().trace.add_blocked(blocker, time.monotonic() - wait_start_time)
+            pair, credential = admitted
+            pair.trace.add_blocked("concurrency", concurrency_wait_time)
+            max_cost = pair.request.estimate_max_cost()
+            wait_start_time = time.monotonic()
+            if not await spending.reserve(max_cost):
+                in_flight.release()
+                _get_rate_limiter(credential).reconcile(pair.request.model, pair.usage, 0)
+                pairs_to_skip = [pair] + queue.remaining()
+                break
+            pair.trace.add_blocked("budget", time.monotonic() - wait_start_time)
+            pair.trace.admitted = time.monotonic()
+            pair.task = asyncio.create_task(execute(pair, credential, max_cost))
+
+        await asyncio.gather(*(pair.task for pair in pairs_to_execute if pair.task is not None))
+        exporter.cancel()
+        _metrics.set("openai_in_flight", 0)
+        _metrics.set("openai_in_flight_limit", in_flight.limit)
+
+        _skip_pairs(pairs_to_skip, spending.budget)
+
+        if retry_budget.num_retries > 0:
+            logger.info(f"Used {retry_budget.num_retries} of {retry_budget.max_retries} retries.")
+        if hedging is not None and hedging.num_hedges > 0:
+            logger.info(f"Sent {hedging.num_hedges} duplicates of slow requests, "
+                        f"{hedging.num_won} of which were faster.")
+
+        # the event loop runs in this thread, so its CPU time is the overhead of scheduling and sending the requests
+        global _execution_stats
+        usages = [pair.response.usage for pair in pairs_to_execute if pair.response.was_successful()]
+        _execution_stats = {
+            "num_requests": len(pairs_to_execute),
+            "num_failed": sum(not pair.response.was_successful() for pair in pairs_to_execute),
+            "num_retries": retry_budget.num_retries,
+            "num_hedges": 0 if hedging is None else hedging.num_hedges,
+            "wall_time": time.monotonic() - start_time,
+            "cpu_time": time.thread_time() - start_cpu_time,
+            "prompt_tokens": sum(usage.get("prompt_tokens", 0) for usage in usages),
+            "completion_tokens": sum(usage.get("completion_tokens", 0) for usage in usages),
+            "cached_prompt_tokens": sum(pair.response.compute_cached_prompt_tokens() for pair in pairs_to_execute),
+            "latencies": latencies,
+            "cost": spending.spent,
+            "in_flight_limit": in_flight.limit
+        }
+
+
+def _settle_pair(
+        pair: _Pair,
+        credential: Credential,
+        max_cost: float,
+        spending: _Spending,
+        ledger: Ledger | None,
+        tracer: Tracer
+) -> None:
+    # correct the rate limiter and the budget with the actual usage and cost, and record them
+    actual_usage = 0 if pair.was_cached else pair.response.compute_total_usage()
+    _get_rate_limiter(credential).reconcile(pair.request.model, pair.usage, actual_usage)
+    cost = 0.0 if pair.was_cached else pair.response.compute_total_cost()
+    spending.settle(max_cost, cost)
+    if ledger is not None and not pair.was_cached:
+        ledger.record(pair.request.model, pair.request.compute_hash(), "sync", pair.response.response, cost)
+    pair.trace.credential = credential.display_name
+    pair.trace.actual_tokens = actual_usage
+    pair.trace.cached_tokens = 0 if pair.was_cached else pair.response.compute_cached_prompt_tokens()
+    _metrics.inc("openai_cached_tokens_total", pair.trace.cached_tokens, model=pair.request.model)
+    if pair.was_cached:
+        pair.trace.status = 200
+    _metrics.inc("openai_cost_dollars_total", cost, model=pair.request.model)
+    tracer.finish(pair.trace)
 
 
 def openai_execute(
         requests: list[dict],
         *,
         force: float | None = None,
-        silent: bool = False
+        silent: bool = False,
+        on_response: Callable[[int, dict], None] | None = None,
+        pin: bool = False,
+        credentials: list[Credential] | Callable[[], list[Credential]] | None = None,
+        budget: float | None = None,
+        ledger_path: pathlib.Path | None = None,
+        trace_path: pathlib.Path | None = None,
+        order: str = "longest_first",
+        stop_detector: Callable[[int, str], int | None] | None = None,
+        hedge_percentile: float | None = None,
+        offline: bool = False
 ) -> list[dict]:
     """Execute a list of requests against the OpenAI API.
 
     This method also computes the maximum cost incurred by the requests, caches requests and responses, and waits
-    between requests to abide the API limits.
+    between requests to abide the API limits. The requests are distributed over the given credentials, each of which
+    has its own rate limits, and fail over to the other credentials when one of them is rejected or exhausted.
+
+    If a budget is given, a request is only sent if its maximum cost fits into the budget together with the actual
+    cost so far and the maximum cost of the requests in flight. Once the budget is exhausted, the remaining requests
+    fail with an error of type `budget_exceeded` and are not passed to `on_response`, so that a later run (e.g., with a
+    higher budget) can resume them.
+
+    The requests are executed either longest first (`longest_first`) or grouped by their prompt prefix (`prefix`), which
+    executes requests that share their first message one after the other, so that the provider can serve the shared
+    prefix from its prompt cache. In the latter mode, the first request of each group with a long enough prefix is
+    executed alone, since the provider caches the prefix only once it has processed a request. The order `packed`
+    executes the requests longest first as well, but lets a shorter request among the next ones overtake a request for
+    which the token limits have not refilled yet, so that the remaining tokens of the rolling window are not wasted.
+
+    If a stop detector is given, the responses are streamed and the detector is called with the index of the request
+    and the text generated so far whenever a new chunk arrives. Once it returns the length of the text to keep (e.g.,
+    because a complete answer has arrived), the stream is closed and the response is cached with the text cut to that
+    length, the finish reason `stop`, and an estimated usage (since the usage is only sent at the end of the stream, if
+    at all).
+
+    If a hedging percentile is given, a request that is still in flight after that percentile of the latencies so far
+    is sent a second time (if the budget permits), the first successful response is used, and the other request is
+    cancelled. Since the provider charges the cancelled request as well, the duplicate is charged to the rate limiter,
+    the budget, and the ledger (with mode `hedge`) like the request itself.
+
+    The cached responses are looked up before anything else, so that the requests are only tokenized, checked, and
+    estimated if they are not cached. If offline, the responses are only replayed from the cache, which fails right
+    away if any request is not cached and needs neither credentials nor a confirmation of the cost.
+
+    The executor updates the metrics returned by `openai_metrics()`. They are written to the file given by the
+    environment variable `OPENAI_METRICS_PATH` and served on the port given by `OPENAI_METRICS_PORT` if set.
 
     Args:
         requests: A list of API requests.
         force: An optional float specifying the cost below which no confirmation should be required.
         silent: Whether to display log messages and progress bars.
+        on_response: An optional callback that is called with the index of the request and the response as soon as
+            the response is available, e.g., to persist it before all other requests are finished.
+        pin: Whether to pin the cached responses so that they are never evicted from the cache.
+        credentials: The endpoints and API keys to use or a function that gets them once requests have to be sent
+            (e.g., to avoid authenticating if all requests are cached), which default to `openai_credentials()`.
+        budget: An optional limit on the actual cost of the run in dollars.
+        ledger_path: An optional JSONL file to which the cost and token usage of each executed request is appended.
+        trace_path: An optional JSONL file to which the trace of each executed request is appended, i.e., when it was
+            admitted, sent, and done, and how long it waited for which limiter.
+        order: The order in which the requests are executed, either `longest_first`, `prefix`, or `packed`.
+        stop_detector: An optional function that decides when to stop the generation of a response.
+        hedge_percentile: An optional latency percentile (e.g., 0.95) after which a slow request is sent again.
+        offline: Whether to only replay the cached responses without sending any requests.
 
     Returns:
         A list of API responses.
     """
-    pairs = [_Pair(_Request(request)) for request in requests]
+    pairs, pairs_to_execute = _prepare_pairs(requests, on_response, offline)
+    if offline:
+        if pin:
+            _get_cache().pin(pair.request.compute_hash() for pair in pairs)
+        _describe_output(pairs, pairs_to_execute, silent)
+        return [pair.response.response for pair in pairs]
+
+    unique_pairs = _deduplicate(pairs_to_execute, silent)
+
+    # the credentials are only needed if requests have to be sent
+    pool = None
+    if len(unique_pairs) > 0:
+        pool = _CredentialPool(_resolve_credentials(credentials))
+        for model in set(pair.request.model for pair in unique_pairs):
+            if not any(credential.serves(model) for credential in pool.credentials):
+                raise AssertionError(f"No credential can be used for model '{model}'!")
 
-    # check requests
-    for pair in pairs:
-        pair.request.check()
+    # compute maximum cost
+    total_max_cost = sum(pair.request.estimate_max_cost() for pair in unique_pairs)
+    _confirm_cost(total_max_cost, force, silent)
+
+    for pair in unique_pairs:
+        pair.usage = pair.request.estimate_max_total_usage()
+    if order == "longest_first":
+        unique_pairs.sort(key=lambda p: p.usage, reverse=True)
+    elif order == "prefix":
+        unique_pairs = _order_by_prefix(unique_pairs, silent)
+    elif order == "packed":
+        unique_pairs.sort(key=lambda p: p.usage, reverse=True)
+    else:
+        raise AssertionError(f"Unknown execution order '{order}'!")
+
+    # execute requests
+    with tqdm.tqdm(total=len(pairs), initial=len(pairs) - len(pairs_to_execute), desc="execute requests",
+                   disable=silent) as progress_bar:
+        spending = _Spending(budget, len(unique_pairs))
+        ledger = None if ledger_path is None else Ledger(ledger_path)
+        tracer = Tracer(_metrics, trace_path)
+        try:
+            asyncio.run(_execute_pairs(unique_pairs, pool, progress_bar, on_response, spending, ledger, tracer,
+                                       stop_detector, hedge_percentile, _lookahead_window if order == "packed" else 1))
+        finally:
+            tracer.close()
+            if ledger is not None:
+                ledger.close()
+            _export_metrics()
+
+    # shrink cache
+    if pin:
+        _get_cache().pin(pair.request.compute_hash() for pair in pairs if pair.response.was_successful())
+    _get_cache().evict()
+    _get_cache().start_compaction()
+
+    _describe_output(pairs, pairs_to_execute, silent)
+    return [pair.response.response for pair in pairs]
+
+
+async def openai_execute_stream(
+        requests: Iterable[tuple[Hashable, dict]],
+        *,
+        credentials: list[Credential] | Callable[[], list[Credential]] | None = None,
+        budget: float | None = None,
+        ledger_path: pathlib.Path | None = None,
+        trace_path: pathlib.Path | None = None,
+        window: int = _stream_window
+) -> AsyncIterator[tuple[Hashable, dict]]:
+    """Execute a stream of requests against the OpenAI API and yield the responses as they complete.
+
+    Unlike `openai_execute`, the requests are consumed lazily and in order, and at most `window` requests are held at
+    once (including responses that have not been consumed yet), so that the memory does not grow with the number of
+    requests. Therefore, the requests are neither sorted nor deduplicated up front (identical requests still coalesce
+    via the cache), and there is no confirmation of the total cost, which is unknown in advance. Use the budget to
+    limit the cost instead: once a request does not fit into the budget, the stream stops consuming requests and ends
+    after the requests in flight.
+
+    Args:
+        requests: Pairs of an ID (e.g., the name of the request file) and an API request.
+        credentials: The endpoints and API keys to use or a function that gets them once requests have to be sent
+            (e.g., to avoid authenticating if all requests are cached), which default to `openai_credentials()`.
+        budget: An optional limit on the actual cost of the run in dollars.
+        ledger_path: An optional JSONL file to which the cost and token usage of each executed request is appended.
+        trace_path: An optional JSONL file to which the trace of each executed request is appended.
+        window: The maximum number of requests that are held at once.
+
+    Yields:
+        Pairs of the ID of a request and its API response in the order in which they complete.
+    """
+    pool = None  # the credentials are only needed once a request is not cached
+    spending = _Spending(budget, 0)
+    ledger = None if ledger_path is None else Ledger(ledger_path)
+    tracer = Tracer(_metrics, trace_path)
+    slots = asyncio.Semaphore(window)
+    results = asyncio.Queue()
+    tasks = set()
+    end = object()
+
+    connector = aiohttp.TCPConnector(limit=_max_connections, keepalive_timeout=_keepalive_timeout)
+    timeout = aiohttp.ClientTimeout(total=_request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        in_flight = AdaptiveConcurrency(_initial_in_flight, maximum=_max_in_flight)
+        retry_budget = RetryBudget(_min_retry_budget)
+
+        async def execute(request_id: Hashable, pair: _Pair, credential: Credential, max_cost: float) -> None:
+            try:
+                pair.response, pair.was_cached, credential = await pair.request.execute(
+                    session, credential, pool, retry_budget=retry_budget, concurrency=in_flight, trace=pair.trace)
+                _settle_pair(pair, credential, max_cost, spending, ledger, tracer)
+                results.put_nowait((request_id, pair.response.response))
+            finally:
+                in_flight.release()
+
+        async def admit() -> None:
+            nonlocal pool
+            try:
+                for num_requests, (request_id, request) in enumerate(requests, start=1):
+                    await slots.acquire()
+                    pair = _Pair(_Request(request), num_requests - 1)
+                    pair.response = await pair.request._load_cached_response_timed(None, remote=True)
+                    if pair.response is not None:
+                        _metrics.inc("openai_requests_total", model=pair.request.model, cache="hit", status="200")
+                        results.put_nowait((request_id, pair.response.response))
+                        continue
+                    pair.request.is_known_missing = True
+
+                    pair.request.check()
+                    pair.usage = pair.request.estimate_max_total_usage()
+                    pair.trace = RequestTrace(pair.index, pair.request.model, pair.request.compute_hash(), pair.usage,
+                                              tracer.start_time)
+                    retry_budget.max_retries = max(_min_retry_budget, int(num_requests * _retry_budget_ratio))
+                    await in_flight.acquire()
+                    max_cost = pair.request.estimate_max_cost()
+                    if not await spending.reserve(max_cost):
+                        in_flight.release()
+                        logger.warning(f"Stopped because of the budget of ${budget:.2f}, the requests from "
+                                       f"'{request_id}' on were not executed.")
+                        break
+                    if pool is None:
+                        pool = _CredentialPool(_resolve_credentials(credentials))
+                    credential = await pool.acquire(pair.request.model, pair.usage, pair.trace)
+                    pair.trace.admitted = time.monotonic()
+                    task = asyncio.create_task(execute(request_id, pair, credential, max_cost))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.gather(*tasks)
+            finally:
+                results.put_nowait(end)
+
+        admission = asyncio.create_task(admit())
+        try:
+            while (result := await results.get()) is not end:
+                slots.release()
+                yield result
+            await admission
+        finally:
+            admission.cancel()
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(admission, *tasks, return_exceptions=True)
+            tracer.close()
+            if ledger is not None:
+                ledger.close()
+            _export_metrics()
+
+
+def openai_execute_iter(
+        requests: Iterable[tuple[Hashable, dict]],
+        **kwargs
+) -> Iterator[tuple[Hashable, dict]]:
+    """Execute a stream of requests against the OpenAI API and iterate over the responses as they complete.
+
+    This is the synchronous version of `openai_execute_stream`, which takes the same arguments. The requests are only
+    executed while the iterator is advanced.
+
+    Args:
+        requests: Pairs of an ID (e.g., the name of the request file) and an API request.
+        **kwargs: The keyword arguments of `openai_execute_stream`.
+
+    Yields:
+        Pairs of the ID of a request and its API response in the order in which they complete.
+    """
+    loop = asyncio.new_event_loop()
+    stream = openai_execute_stream(requests, **kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(anext(stream))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(stream.aclose())
+        loop.close()
+
+
+def openai_batch_execute(
+        requests: list[dict],
+        *,
+        client: OpenAIBatchClient | LocalBatchClient | None = None,
+        credentials: list[Credential] | Callable[[], list[Credential]] | None = None,
+        force: float | None = None,
+        silent: bool = False,
+        on_response: Callable[[int, dict], None] | None = None,
+        pin: bool = False,
+        budget: float | None = None,
+        ledger_path: pathlib.Path | None = None
+) -> list[dict]:
+    """Execute a list of requests through the OpenAI Batch API.
+
+    The requests that are not cached are packed into JSONL batch files, submitted, and polled until the batches are
+    finished. The results are stored in the cache like those of `openai_execute`. The batch of each submitted request
+    is remembered by the request hash, so that an interrupted run (even with a changed list of requests) continues to
+    poll the batches of its requests instead of submitting them again.
+
+    Since submitted batches cannot be stopped, a budget limits the maximum cost of the submitted requests. The other
+    requests fail with an error of type `budget_exceeded` like in `openai_execute`.
+
+    The canned responses of a LocalBatchClient are neither cached nor recorded in the ledger, since they are not answers
+    of the requested models, and its submitted batches are remembered in its own directory.
+
+    Args:
+        requests: A list of API requests.
+        client: The batch client, which defaults to an OpenAIBatchClient for the first of the credentials.
+        credentials: The endpoints and API keys to use if no client is given or a function that gets them once
+            requests have to be sent, which default to `openai_credentials()`.
+        force: An optional float specifying the cost below which no confirmation should be required.
+        silent: Whether to display log messages and progress bars.
+        on_response: An optional callback that is called with the index of the request and the response as soon as
+            the response is available.
+        pin: Whether to pin the cached responses so that they are never evicted from the cache.
+        budget: An optional limit on the maximum cost of the submitted requests in dollars.
+        ledger_path: An optional JSONL file to which the cost and token usage of each executed request is appended.
+
+    Returns:
+        A list of API responses.
+    """
+    is_stand_in = isinstance(client, LocalBatchClient)
+
+    pairs, pairs_to_execute = _prepare_pairs(requests, on_response)
+    unique_pairs = _deduplicate(pairs_to_execute, silent)
+
+    # the credentials are only needed if requests have to be sent
+    if client is None and len(unique_pairs) > 0:
+        credential = _resolve_credentials(credentials)[0]
+        client = OpenAIBatchClient(credential.base_url, credential.api_key)
+
+    # compute maximum cost
+    pairs_to_skip = []
+    if budget is not None:
+        max_cost = 0.0
+        for i, pair in enumerate(unique_pairs):
+            max_cost += pair.request.estimate_max_cost() * _batch_discount
+            if max_cost > budget:
+                unique_pairs, pairs_to_skip = unique_pairs[:i], unique_pairs[i:]
+                break
+    total_max_cost = sum(pair.request.estimate_max_cost() for pair in unique_pairs) * _batch_discount
+    _confirm_cost(total_max_cost, force, silent)
+
+    # continue with the batches to which requests have already been submitted, the custom IDs are the request hashes
+    os.makedirs(_batch_path, exist_ok=True)
+    submitted_path = (client.path if is_stand_in else _batch_path) / "submitted.json"
+    submitted = load_json(submitted_path) if submitted_path.is_file() else {}  # {request hash: batch id}
+    batches = {}  # {batch id: pairs by custom id}
+    statuses = {}
+    pairs_to_submit = []
+    for pair in unique_pairs:
+        batch_id = submitted.get(pair.request.compute_hash())
+        if batch_id is not None and batch_id not in statuses.keys():
+            statuses[batch_id] = client.retrieve(batch_id)["status"]
+        if batch_id is not None and statuses[batch_id] not in ("failed", "expired", "cancelled"):
+            batches.setdefault(batch_id, {})[pair.request.compute_hash()] = pair
+        else:
+            pairs_to_submit.append(pair)
+    if len(batches) > 0 and not silent:
+        logger.info(f"Continue with {len(batches)} previously submitted batches.")
+
+    # pack and submit batches
+    for batch_file_path, batch_pairs in _pack_batches(pairs_to_submit):
+        input_file_id = client.upload(batch_file_path)
+        batch_id = client.create(input_file_id, _batch_endpoint(batch_pairs[0]), _batch_completion_window)["id"]
+        os.remove(batch_file_path)
+        batches[batch_id] = {pair.request.compute_hash(): pair for pair in batch_pairs}
+        submitted.update((pair.request.compute_hash(), batch_id) for pair in batch_pairs)
+        dump_json(submitted, submitted_path, atomic=True)
+
+    # poll batches and fan out the results
+    ledger = None if ledger_path is None else Ledger(ledger_path)
+    try:
+        with tqdm.tqdm(total=len(pairs), initial=len(pairs) - len(pairs_to_execute), desc="execute batches",
+                       disable=silent) as progress_bar:
+            remaining = list(batches.items())
+            while len(remaining) > 0:
+                still_remaining = []
+                for batch_id, batch_pairs in remaining:
+                    batch = client.retrieve(batch_id)
+                    if not is_terminal_batch_status(batch["status"]):
+                        still_remaining.append((batch_id, batch_pairs))
+                        continue
+
+                    for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                        if file_id is None:
+                            continue
+                        for line in client.download(file_id).splitlines():
+                            if line.strip() == "":
+                                continue
+                            result = json.loads(line)
+                            pair = batch_pairs.get(result["custom_id"])
+                            if pair is None:
+                                continue  # a request of an earlier run that is not part of this run
+                            if result.get("response") is not None and result["response"]["status_code"] == 200:
+                                pair.response = _Response(result["response"]["body"])
+                                if not is_stand_in:
+                                    _get_cache().put(pair.request.compute_hash(), {"request": pair.request.request,
+                                                                                   "response": pair.response.response})
+                            elif result.get("response") is not None:
+                                pair.response = _Response(result["response"]["body"])
+                            else:
+                                pair.response = _Response({"error": result["error"]})
+
+                    for pair in batch_pairs.values():
+                        if pair.response is None:
+                            pair.response = _Response({"error": {
+                                "message": f"Batch '{batch_id}' finished with status '{batch['status']}'.",
+                                "type": "batch_error"
+                            }})
+                        if ledger is not None and not is_stand_in:
+                            ledger.record(pair.request.model, pair.request.compute_hash(), "batch",
+                                          pair.response.response, pair.response.compute_total_cost() * _batch_discount)
+                        if on_response is not None:
+                            on_response(pair.index, pair.response.response)
+                        pair.fan_out(on_response)
+                    progress_bar.update(sum(1 + len(pair.duplicates) for pair in batch_pairs.values()))
+
+                    # the results are cached now (or canned), so the requests do not have to be continued, but the
+                    # requests of earlier runs that are not part of this run can still get their results from the batch
+                    for request_hash in batch_pairs.keys():
+                        del submitted[request_hash]
+                    dump_json(submitted, submitted_path, atomic=True)
+
+                remaining = still_remaining
+                if len(remaining) > 0:
+                    time.sleep(_batch_poll_interval)
+    finally:
+        if ledger is not None:
+            ledger.close()
+    _skip_pairs(pairs_to_skip, budget)
+
+    # shrink cache
+    if pin:
+        _get_cache().pin(pair.request.compute_hash() for pair in pairs
+                         if pair.response.was_successful() and (pair.was_cached or not is_stand_in))
+    _get_cache().evict()
+    _get_cache().start_compaction()
+
+    _describe_output(pairs, pairs_to_execute, silent, cost_factor=_batch_discount)
+    return [pair.response.response for pair in pairs]
 
-    # create cache directory
-    os.makedirs(_cache_path, exist_ok=True)
+
+def _prepare_pairs(
+        requests: list[dict],
+        on_response: Callable[[int, dict], None] | None,
+        offline: bool = False
+) -> tuple[list[_Pair], list[_Pair]]:
+    pairs = [_Pair(_Request(request), index) for index, request in enumerate(requests)]
+
+    # resolve the cached pairs in one pass over the index, so that replaying a cached run does not tokenize anything
+    cached_hashes = _get_cache().contains_many(pair.request.compute_hash() for pair in pairs)
+    uncached_pairs = [pair for pair in pairs if pair.request.compute_hash() not in cached_hashes]
+    legacy_hashes = [pair.request.compute_legacy_hash() for pair in uncached_pairs]
+    cached_legacy_hashes = _get_cache().contains_many(legacy_hashes)
+    uncached_pairs = [pair for pair, h in zip(uncached_pairs, legacy_hashes) if h not in cached_legacy_hashes]
+    for pair in uncached_pairs:
+        pair.request.is_known_missing = True
+    if offline:
+        _fail_offline(uncached_pairs)
 
     # load cached pairs
+    uncached_indices = set(pair.index for pair in uncached_pairs)
     for pair in pairs:
-        pair.response = pair.request.load_cached_response()
+        if pair.index not in uncached_indices:
+            pair.response = pair.request.load_cached_response()
         if pair.response is not None:
             pair.was_cached = True
+            _metrics.inc("openai_requests_total", model=pair.request.model, cache="hit", status="200")
+            if on_response is not None:
+                on_response(pair.index, pair.response.response)
 
     pairs_to_execute = [pair for pair in pairs if not pair.was_cached]
+    if offline:
+        _fail_offline(pairs_to_execute)
 
-    # compute maximum cost
-    total_max_cost = sum(pair.request.estimate_max_cost() for pair in pairs_to_execute)
+    # count tokens in parallel, texts that occur in many requests are encoded only once
+    token_counter = get_token_counter()
+    texts_by_model = {}
+    for pair in pairs_to_execute:
+        texts_by_model.setdefault(pair.request.model, []).extend(pair.request.texts_to_encode())
+    for model, texts in texts_by_model.items():
+        token_counter.count_many(texts, model)
+    token_counter.save()
+
+    # check requests
+    for pair in pairs_to_execute:
+        pair.request.check()
+
+    return pairs, pairs_to_execute
+
+
+def _fail_offline(pairs_to_execute: list[_Pair]) -> None:
+    if len(pairs_to_execute) > 0:
+        raise AssertionError(f"{len(pairs_to_execute)} requests are not cached, but the execution is offline! The "
+                             f"first one is {json.dumps(pairs_to_execute[0].request.request)[:200]}")
+
+
+def _deduplicate(pairs_to_execute: list[_Pair], silent: bool) -> list[_Pair]:
+    unique_pairs = {}
+    for pair in pairs_to_execute:
+        request_hash = pair.request.compute_hash()
+        if request_hash in unique_pairs.keys():
+            unique_pairs[request_hash].duplicates.append(pair)
+        else:
+            unique_pairs[request_hash] = pair
+
+    num_duplicates = len(pairs_to_execute) - len(unique_pairs)
+    if num_duplicates > 0 and not silent:
+        logger.info(f"Send {len(unique_pairs)} unique requests for {len(pairs_to_execute)} requests "
+                    f"({num_duplicates} duplicates).")
+    return list(unique_pairs.values())
+
+
+def _order_by_prefix(pairs_to_execute: list[_Pair], silent: bool) -> list[_Pair]:
+    groups = order_by_prefix([pair.request.prefix_segments() for pair in pairs_to_execute],
+                             [pair.usage for pair in pairs_to_execute])
+    ordered_pairs = []
+    for group in groups:
+        leader = pairs_to_execute[group[0]]
+        if leader.request.estimate_first_segment_tokens() >= _min_cached_prefix_tokens:
+            for i in group[1:]:
+                pairs_to_execute[i].leader = leader
+        ordered_pairs += [pairs_to_execute[i] for i in group]
+
+    if not silent:
+        logger.info(f"Execute {len(pairs_to_execute)} requests in {len(groups)} groups with a shared prefix.")
+    return ordered_pairs
+
+
+def _skip_pairs(pairs_to_skip: list[_Pair], budget: float) -> None:
+    # skipped requests are neither cached nor passed to `on_response`, so that a later run executes them
+    for pair in pairs_to_skip:
+        for p in [pair] + pair.duplicates:
+            p.response = _Response({"error": {
+                "message": f"The budget of ${budget:.2f} would have been exceeded.",
+                "type": "budget_exceeded"
+            }})
+    if len(pairs_to_skip) > 0:
+        logger.warning(f"Stopped because of the budget of ${budget:.2f}, "
+                       f"{sum(1 + len(pair.duplicates) for pair in pairs_to_skip)} requests were not executed.")
+
+
+def _confirm_cost(total_max_cost: float, force: float | None, silent: bool) -> None:
     if force is None or total_max_cost >= force:
         logger.info(f"Press enter to continue and spend up to around ${total_max_cost:.2f}.")
         input(f"Press enter to continue and spend up to around ${total_max_cost:.2f}.")
@@ -329,64 +1649,60 @@ def openai_execute(
     elif not silent:
         logger.info(f"Spending up to around ${total_max_cost:.2f}.")
 
-    # sort to execute longest requests first
-    for pair in pairs_to_execute:
-        pair.usage = pair.request.estimate_max_total_usage()
-    pairs_to_execute.sort(key=lambda p: p.usage, reverse=True)
-
-    # execute requests
-    with tqdm.tqdm(total=len(pairs), desc="execute requests", disable=silent) as progress_bar:
-        for pair in pairs_to_execute:
-            model_params = _get_model_params(pair.request.model)
-
-            while True:
-                # pairs are relevant if they already started, were not cached, and the finished time is within the last
-                # minute
-                relevant_pairs = [p for p in pairs_to_execute if p.thread is not None and not p.was_cached and (
-                        p.finished_time is None or time.time() - p.finished_time <= _wait_window)]
-                total_requests = len(relevant_pairs)
-                total_usage = sum(p.usage for p in relevant_pairs)
-                if total_requests > model_params["max_rpm"] * _api_share:
-                    logger.debug("Sleep to abide the model's `max_rpm` parameter.")
-                    time.sleep(_wait_before_retry)
-                elif total_usage > model_params["max_tpm"] * _api_share:
-                    logger.debug("Sleep to abide the model's `max_tpm` parameter.")
-                    time.sleep(_wait_before_retry)
-                else:
-                    time.sleep(_wait_before_try)
-
-                    def execute(p, pb):
-                        p.response, p.was_cached = p.request.execute()
-                        p.finished_time = time.time()
-                        p.usage = p.response.compute_total_usage()
-                        pb.update()
-
-                    pair.thread = threading.Thread(target=execute, args=(pair, progress_bar))
-                    pair.thread.start()
-                    break
-
-        for pair in pairs_to_execute:
-            if pair.thread is not None:
-                pair.thread.join()
-
-    # shrink cache
-    cache_file_paths = list(sorted(_cache_path.glob("*.json")))
-    if len(cache_file_paths) > _cache_size:
-        logger.warning(f"OpenAI cache is too large ({len(cache_file_paths)} > {_cache_size}) and will be shrunk!")
-        for cache_file_path in cache_file_paths[:-_cache_size]:
-            os.remove(cache_file_path)
 
-    # describe output
+def _describe_output(pairs: list[_Pair], pairs_to_execute: list[_Pair], silent: bool, cost_factor: float = 1.0) -> None:
     num_failed_requests = sum(not pair.response.was_successful() for pair in pairs)
     if num_failed_requests > 0:
         logger.warning(f"{num_failed_requests} requests failed!")
 
     total_cost = sum(pair.response.compute_total_cost() for pair in pairs_to_execute if not pair.was_cached)
+    total_cost *= cost_factor
     if not silent:
         message = f"Spent ${total_cost:.2f}."
         was_cached = sum(pair.was_cached for pair in pairs)
         if was_cached > 0:
             message += f" ({was_cached} responses were already cached)"
         logger.info(message)
+        executed = [pair for pair in pairs_to_execute if not pair.was_cached and pair.response.was_successful()]
+        prompt_tokens = sum(pair.response.usage.get("prompt_tokens", 0) for pair in executed)
+        cached_tokens = sum(pair.response.compute_cached_prompt_tokens() for pair in executed)
+        if cached_tokens > 0:
+            logger.info(f"{cached_tokens} of {prompt_tokens} prompt tokens ({cached_tokens / prompt_tokens:.1%}) "
+                        f"were served from the provider's prompt cache.")
+
+
+def _batch_endpoint(pair: _Pair) -> str:
+    if pair.request.is_chat_or_completion() == "chat":
+        return "/v1" + _chat_url_path
+    elif pair.request.is_chat_or_completion() == "completion":
+        return "/v1" + _completion_url_path
+    else:
+        raise AssertionError(f"Invalid parameter `chat_or_completion` for model '{pair.request.model}'!")
 
-    return [pair.response.response for pair in pairs]
+
+def _pack_batches(pairs_to_execute: list[_Pair]) -> list[tuple[pathlib.Path, list[_Pair]]]:
+    pairs_by_endpoint = {}
+    for pair in pairs_to_execute:
+        pairs_by_endpoint.setdefault(_batch_endpoint(pair), []).append(pair)
+
+    batch_files = []
+    for endpoint, endpoint_pairs in pairs_by_endpoint.items():
+        lines, line_pairs, num_bytes = [], [], 0
+        for pair in endpoint_pairs + [None]:
+            if pair is not None:
+                line = json.dumps({"custom_id": pair.request.compute_hash(), "method": "POST", "url": endpoint,
+                                   "body": pair.request.request}) + "\n"
+                line_bytes = len(bytes(line, "utf-8"))
+            if len(lines) > 0 and (pair is None or len(lines) >= _batch_max_requests
+                                   or num_bytes + line_bytes > _batch_max_bytes):
+                content = "".join(lines)
+                path = _batch_path / f"{hashlib.sha256(bytes(content, 'utf-8')).hexdigest()}.jsonl"
+                with open(path, "w", encoding="utf-8") as file:
+                    file.write(content)
+                batch_files.append((path, line_pairs))
+                lines, line_pairs, num_bytes = [], [], 0
+            if pair is not None:
+                lines.append(line)
+                line_pairs.append(pair)
+                num_bytes += line_bytes
+    return batch_files
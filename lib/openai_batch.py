@@ -0,0 +1,227 @@
+########################################################################################################################
+# Clients for the OpenAI Batch API
+#
+# use the following classes:
+# OpenAIBatchClient(...)  ==> submit batches to the OpenAI Batch API
+# LocalBatchClient(...)   ==> file-based local stand-in for the OpenAI Batch API
+#
+# both clients are used by openai_batch_execute(...) in lib/openai.py
+########################################################################################################################
+
+import json
+import logging
+import os
+import pathlib
+import time
+import uuid
+
+import requests
+
+from lib.openai_mock import create_chat_completion
+
+logger = logging.getLogger(__name__)
+
+_terminal_batch_statuses = {"completed", "failed", "expired", "cancelled"}
+
+
+def is_terminal_batch_status(status: str) -> bool:
+    """Determine whether a batch with the given status will not change anymore.
+
+    Args:
+        status: The status of the batch.
+
+    Returns:
+        Whether the status is terminal.
+
+    >>> is_terminal_batch_status("in_progress"), is_terminal_batch_status("completed")
+    (False, True)
+    """
+    return status in _terminal_batch_statuses
+
+
+class OpenAIBatchClient:
+    """Client for the files and batches endpoints of the OpenAI API."""
+    base_url: str
+
+    def __init__(self, base_url: str, api_key: str) -> None:
+        """Create the client.
+
+        Args:
+            base_url: The base URL of the API, e.g., `https://api.openai.com/v1`.
+            api_key: The API key.
+        """
+        self.base_url = base_url
+        self._session = requests.Session()
+        self._session.headers.update({"Authorization": f"Bearer {api_key}"})
+
+    def upload(self, path: pathlib.Path) -> str:
+        """Upload a JSONL batch input file.
+
+        Args:
+            path: The path of the file.
+
+        Returns:
+            The ID of the uploaded file.
+        """
+        with open(path, "rb") as file:
+            http_response = self._session.post(f"{self.base_url}/files", data={"purpose": "batch"},
+                                               files={"file": (path.name, file)})
+        http_response.raise_for_status()
+        return http_response.json()["id"]
+
+    def create(self, input_file_id: str, endpoint: str, completion_window: str) -> dict:
+        """Create a batch for the given input file.
+
+        Args:
+            input_file_id: The ID of the uploaded input file.
+            endpoint: The endpoint for all requests in the batch, e.g., `/v1/chat/completions`.
+            completion_window: The time frame within which the batch should be processed.
+
+        Returns:
+            The batch object.
+        """
+        http_response = self._session.post(f"{self.base_url}/batches", json={
+            "input_file_id": input_file_id,
+            "endpoint": endpoint,
+            "completion_window": completion_window
+        })
+        http_response.raise_for_status()
+        return http_response.json()
+
+    def retrieve(self, batch_id: str) -> dict:
+        """Retrieve the current state of the batch.
+
+        Args:
+            batch_id: The ID of the batch.
+
+        Returns:
+            The batch object.
+        """
+        http_response = self._session.get(f"{self.base_url}/batches/{batch_id}")
+        http_response.raise_for_status()
+        return http_response.json()
+
+    def download(self, file_id: str) -> str:
+        """Download the content of an output or error file.
+
+        Args:
+            file_id: The ID of the file.
+
+        Returns:
+            The content of the file.
+        """
+        http_response = self._session.get(f"{self.base_url}/files/{file_id}/content")
+        http_response.raise_for_status()
+        return http_response.text
+
+
+class LocalBatchClient:
+    """File-based stand-in for the OpenAI Batch API.
+
+    Uploaded files and batches are stored in the given directory. A batch is processed once it has been retrieved after
+    the given processing time, answering each request like the local mock server does.
+    """
+    path: pathlib.Path
+    processing_time: float
+    content: str
+
+    def __init__(self, path: pathlib.Path, *, processing_time: float = 0.0, content: str = "[]") -> None:
+        """Create the client.
+
+        Args:
+            path: The directory in which to store the files and batches.
+            processing_time: The number of seconds it takes to process a batch.
+            content: The content of the generated messages.
+        """
+        self.path = path
+        self.processing_time = processing_time
+        self.content = content
+        os.makedirs(self.path / "files", exist_ok=True)
+        os.makedirs(self.path / "batches", exist_ok=True)
+
+    def upload(self, path: pathlib.Path) -> str:
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(path, "r", encoding="utf-8") as src, open(self._file_path(file_id), "w", encoding="utf-8") as dst:
+            dst.write(src.read())
+        return file_id
+
+    def create(self, input_file_id: str, endpoint: str, completion_window: str) -> dict:
+        if not self._file_path(input_file_id).is_file():
+            raise AssertionError(f"Unknown input file '{input_file_id}'!")
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}
+        }
+        self._dump_batch(batch)
+        return batch
+
+    def retrieve(self, batch_id: str) -> dict:
+        with open(self._batch_path(batch_id), "r", encoding="utf-8") as file:
+            batch = json.load(file)
+        if not is_terminal_batch_status(batch["status"]) and time.time() - batch["created_at"] >= self.processing_time:
+            batch = self._process(batch)
+        return batch
+
+    def download(self, file_id: str) -> str:
+        with open(self._file_path(file_id), "r", encoding="utf-8") as file:
+            return file.read()
+
+    def _process(self, batch: dict) -> dict:
+        output_lines, error_lines = [], []
+        with open(self._file_path(batch["input_file_id"]), "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip() == "":
+                    continue
+                batch_request = json.loads(line)
+                if batch_request["url"] != batch["endpoint"] or batch["endpoint"] != "/v1/chat/completions":
+                    error_lines.append(json.dumps({
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": batch_request["custom_id"],
+                        "response": None,
+                        "error": {"code": "invalid_url", "message": f"Unsupported URL '{batch_request['url']}'."}
+                    }))
+                else:
+                    output_lines.append(json.dumps({
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": batch_request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "request_id": uuid.uuid4().hex,
+                            "body": create_chat_completion(batch_request["body"], self.content)
+                        },
+                        "error": None
+                    }))
+
+        for lines, key in ((output_lines, "output_file_id"), (error_lines, "error_file_id")):
+            if len(lines) > 0:
+                file_id = f"file-{uuid.uuid4().hex}"
+                with open(self._file_path(file_id), "w", encoding="utf-8") as file:
+                    file.write("\n".join(lines) + "\n")
+                batch[key] = file_id
+
+        batch["status"] = "completed"
+        batch["request_counts"] = {
+            "total": len(output_lines) + len(error_lines),
+            "completed": len(output_lines),
+            "failed": len(error_lines)
+        }
+        self._dump_batch(batch)
+        return batch
+
+    def _file_path(self, file_id: str) -> pathlib.Path:
+        return self.path / "files" / f"{file_id}.jsonl"
+
+    def _batch_path(self, batch_id: str) -> pathlib.Path:
+        return self.path / "batches" / f"{batch_id}.json"
+
+    def _dump_batch(self, batch: dict) -> None:
+        with open(self._batch_path(batch["id"]), "w", encoding="utf-8") as file:
+            json.dump(batch, file)
@@ -0,0 +1,359 @@
+########################################################################################################################
+# Local stand-in for the OpenAI API
+#
+# use the following methods:
+# MockOpenAIServer(...)  ==> run a local server that implements the `/v1/chat/completions` endpoint
+#
+# point the API helpers at the server by setting the environment variable `OPENAI_BASE_URL` to its `base_url`
+########################################################################################################################
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from typing import Callable
+
+from aiohttp import web
+
+from lib.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+_default_content = "[]"
+_latency_distributions = ("constant", "uniform", "exponential", "lognormal", "pareto")
+_lognormal_sigma = 0.5
+_pareto_shape = 1.5  # heavy tail with a finite mean but an infinite variance
+_default_max_tokens = 16
+_cached_prompt_latency_reduction = 0.5  # reduction of the latency of a request whose prompt is completely cached
+
+
+class MockOpenAIServer:
+    """Local HTTP server that answers chat completion requests like the OpenAI API.
+
+    The server runs its own event loop in a background thread and counts the requests and client connections it
+    receives, which allows benchmarking the request executor without spending money. It can inject
+    `429 Too Many Requests` (with a `Retry-After` header) and `500 Internal Server Error` responses to test the retry
+    behavior. The latency of each request is drawn from the given distribution with the given mean, and the generated
+    messages are canned, so that the same request always gets the same response. Each generated word takes the given
+    token latency, and requests with `stream` are answered with server-sent events word by word.
+
+    If requests-per-minute or tokens-per-minute limits are given, the server enforces them like the OpenAI API: it
+    charges each request its prompt tokens plus `max_tokens`, rejects requests that exceed the limits with status 429,
+    and reports the limits and the remaining capacity in `x-ratelimit-*` headers.
+
+    If a minimum prompt length for prompt caching is given, the server caches prompt prefixes like the OpenAI API: once
+    it has answered a request, each prefix of its messages that is long enough is cached, later requests with the same
+    prefix report the cached tokens in `usage.prompt_tokens_details.cached_tokens`, and their latency is reduced.
+    """
+    host: str
+    port: int
+    latency: float
+    latency_distribution: str
+    rate_limit_error_rate: float
+    server_error_rate: float
+    retry_after: float | None
+    content: str | Callable[[dict], str]
+    max_rpm: int | None
+    max_tpm: int | None
+    api_key: str | None
+    prompt_cache_min_tokens: int | None
+    token_latency: float
+    num_requests: int
+    num_errors: int
+    num_generated_tokens: int
+
+    def __init__(
+            self,
+            *,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            latency: float = 0.0,
+            latency_distribution: str = "constant",
+            rate_limit_error_rate: float = 0.0,
+            server_error_rate: float = 0.0,
+            retry_after: float | None = 1.0,
+            content: str | Callable[[dict], str] = _default_content,
+            max_rpm: int | None = None,
+            max_tpm: int | None = None,
+            api_key: str | None = None,
+            prompt_cache_min_tokens: int | None = None,
+            token_latency: float = 0.0,
+            seed: int = 742508314
+    ) -> None:
+        """Create the server.
+
+        Args:
+            host: The host to bind to.
+            port: The port to bind to or 0 to choose a free port.
+            latency: The mean number of seconds to wait before answering a request.
+            latency_distribution: The distribution of the latency, which is `constant`, `uniform` (between 0 and twice
+                the mean), `exponential`, `lognormal`, or `pareto` (heavy-tailed).
+            rate_limit_error_rate: The fraction of requests that fail with status 429.
+            server_error_rate: The fraction of requests that fail with status 500.
+            retry_after: The value of the `Retry-After` header of 429 responses or None to omit it.
+            content: The content of the generated messages or a function that computes it from the request.
+            max_rpm: The maximum number of requests per minute or None for no limit.
+            max_tpm: The maximum number of tokens per minute or None for no limit.
+            api_key: The API key that requests must present or None to accept any key.
+            prompt_cache_min_tokens: The minimum length of a cached prompt prefix or None to disable prompt caching.
+            token_latency: The number of seconds it takes to generate a word.
+            seed: The seed for deciding which requests fail and for drawing the latencies.
+        """
+        if latency_distribution not in _latency_distributions:
+            raise AssertionError(f"Unknown latency distribution '{latency_distribution}'!")
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after = retry_after
+        self.content = content
+        self.max_rpm = max_rpm
+        self.max_tpm = max_tpm
+        self.api_key = api_key
+        self.prompt_cache_min_tokens = prompt_cache_min_tokens
+        self.token_latency = token_latency
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_generated_tokens = 0
+        self._random = random.Random(seed)
+        self._peers = set()
+        self._buckets = None
+        self._prompt_cache = set()
+        self._loop = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    @property
+    def num_connections(self) -> int:
+        return len(self._peers)
+
+    def start(self) -> None:
+        """Start the server in a background thread."""
+        started = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            runner = web.AppRunner(self._create_app(), access_log=None)
+            self._loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, self.host, self.port)
+            self._loop.run_until_complete(site.start())
+            self.port = runner.addresses[0][1]
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.info(f"Mock OpenAI server listens on {self.base_url}.")
+
+    def stop(self) -> None:
+        """Stop the server."""
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "MockOpenAIServer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def _create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle_chat_completion)
+        return app
+
+    async def _handle_chat_completion(self, http_request: web.Request) -> web.StreamResponse:
+        self.num_requests += 1
+        self._peers.add(http_request.transport.get_extra_info("peername"))
+        request = await http_request.json()
+        if self.api_key is not None and http_request.headers.get("Authorization") != f"Bearer {self.api_key}":
+            self.num_errors += 1
+            error = _create_error("Incorrect API key provided.", "invalid_request_error")
+            error["error"]["code"] = "invalid_api_key"
+            return web.json_response(error, status=401)
+
+        exceeded, headers = self._charge_limits(request)
+        if exceeded is not None:
+            self.num_errors += 1
+            return web.json_response(_create_error(f"Rate limit reached for {exceeded}.", exceeded), status=429,
+                                     headers=headers)
+
+        prefixes = self._prompt_prefixes(request)
+        cached_tokens = max((num_tokens for key, num_tokens in prefixes if key in self._prompt_cache), default=0)
+        latency = self._draw_latency()
+        if cached_tokens > 0:
+            prompt_tokens = prefixes[-1][1]
+            latency *= 1 - _cached_prompt_latency_reduction * cached_tokens / prompt_tokens
+        if latency > 0:
+            await asyncio.sleep(latency)
+        self._prompt_cache.update(key for key, num_tokens in prefixes if num_tokens >= self.prompt_cache_min_tokens)
+
+        x = self._random.random()
+        if x < self.rate_limit_error_rate:
+            self.num_errors += 1
+            if self.retry_after is not None:
+                headers["Retry-After"] = str(self.retry_after)
+            return web.json_response(_create_error("Rate limit reached.", "requests"), status=429, headers=headers)
+        if x < self.rate_limit_error_rate + self.server_error_rate:
+            self.num_errors += 1
+            return web.json_response(_create_error("The server had an error.", "server_error"), status=500,
+                                     headers=headers)
+
+        content = self.content if isinstance(self.content, str) else self.content(request)
+        completion = create_chat_completion(request, content, cached_tokens)
+        if request.get("stream", False):
+            return await self._stream_chat_completion(http_request, request, completion, headers)
+        num_tokens = completion["usage"]["completion_tokens"]
+        if self.token_latency > 0:
+            await asyncio.sleep(self.token_latency * num_tokens)
+        self.num_generated_tokens += num_tokens
+        return web.json_response(completion, headers=headers)
+
+    async def _stream_chat_completion(
+            self,
+            http_request: web.Request,
+            request: dict,
+            completion: dict,
+            headers: dict[str, str]
+    ) -> web.StreamResponse:
+        # send the generated message word by word until the client closes the stream
+        response = web.StreamResponse(headers={**headers, "Content-Type": "text/event-stream"})
+        await response.prepare(http_request)
+        chunk = {key: completion[key] for key in ("id", "created", "model")} | {"object": "chat.completion.chunk"}
+        content = completion["choices"][0]["message"]["content"]
+        words = re.findall(r"\s*\S+", content)
+        deltas = [{"role": "assistant", "content": ""}] + [{"content": word} for word in words]
+        try:
+            for i, delta in enumerate(deltas):
+                if i > 0 and self.token_latency > 0:
+                    await asyncio.sleep(self.token_latency)
+                self.num_generated_tokens += int(i > 0)
+                finish_reason = completion["choices"][0]["finish_reason"] if i == len(deltas) - 1 else None
+                await _send_event(response, {**chunk, "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}]})
+            if (request.get("stream_options") or {}).get("include_usage", False):
+                await _send_event(response, {**chunk, "choices": [], "usage": completion["usage"]})
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass
+        return response
+
+    def _prompt_prefixes(self, request: dict) -> list[tuple[str, int]]:
+        # hash and length of each prefix of the messages
+        if self.prompt_cache_min_tokens is None:
+            return []
+        prefixes = []
+        prefix_hash = hashlib.sha256()
+        num_tokens = 0
+        for message in request["messages"]:
+            prefix_hash.update(bytes(json.dumps(message, sort_keys=True), "utf-8"))
+            num_tokens += len(message["content"].split())
+            prefixes.append((prefix_hash.hexdigest(), num_tokens))
+        return prefixes
+
+    def _charge_limits(self, request: dict) -> tuple[str | None, dict[str, str]]:
+        if self.max_rpm is None and self.max_tpm is None:
+            return None, {}
+        now = time.monotonic()
+        if self._buckets is None:
+            self._buckets = {
+                kind: TokenBucket(limit, limit / 60, now=now)
+                for kind, limit in (("requests", self.max_rpm), ("tokens", self.max_tpm)) if limit is not None
+            }
+        amounts = {
+            "requests": 1,
+            "tokens": (sum(len(message["content"].split()) for message in request["messages"])
+                       + (request.get("max_tokens") or _default_max_tokens))
+        }
+
+        exceeded, wait_time = None, 0.0
+        for kind, bucket in self._buckets.items():
+            if bucket.wait_time(amounts[kind], now) > wait_time:
+                exceeded, wait_time = kind, bucket.wait_time(amounts[kind], now)
+        if exceeded is None:
+            for kind, bucket in self._buckets.items():
+                bucket.consume(amounts[kind], now)
+
+        headers = {} if exceeded is None else {"retry-after-ms": str(int(wait_time * 1000) + 1)}
+        for kind, bucket in self._buckets.items():
+            remaining = max(0, int(bucket.available))
+            headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+            headers[f"x-ratelimit-remaining-{kind}"] = str(remaining)
+            headers[f"x-ratelimit-reset-{kind}"] = f"{(bucket.capacity - remaining) / bucket.rate:.3f}s"
+        return exceeded, headers
+
+    def _draw_latency(self) -> float:
+        if self.latency <= 0 or self.latency_distribution == "constant":
+            return self.latency
+        elif self.latency_distribution == "uniform":
+            return self._random.uniform(0, 2 * self.latency)
+        elif self.latency_distribution == "exponential":
+            return self._random.expovariate(1 / self.latency)
+        elif self.latency_distribution == "pareto":
+            # choose the scale so that the mean of the distribution is the given latency
+            return self.latency * (_pareto_shape - 1) / _pareto_shape * self._random.paretovariate(_pareto_shape)
+        else:
+            # choose mu so that the mean of the distribution is the given latency
+            return self._random.lognormvariate(math.log(self.latency) - _lognormal_sigma ** 2 / 2, _lognormal_sigma)
+
+
+def create_chat_completion(request: dict, content: str, cached_tokens: int = 0) -> dict:
+    """Create a chat completion response for the given request.
+
+    Tokens are approximated by whitespace-separated words. The ID of the response is derived from the request, so that
+    the same request always gets the same response.
+
+    Args:
+        request: The chat completion request.
+        content: The content of the generated message.
+        cached_tokens: The number of prompt tokens that were served from the prompt cache.
+
+    Returns:
+        The chat completion response.
+    """
+    prompt_tokens = sum(len(message["content"].split()) for message in request["messages"])
+    completion_tokens = len(content.split())
+    return {
+        "id": f"chatcmpl-mock-{hashlib.sha256(bytes(json.dumps(request), 'utf-8')).hexdigest()[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}
+        }
+    }
+
+
+async def _send_event(response: web.StreamResponse, data: dict) -> None:
+    await response.write(bytes(f"data: {json.dumps(data)}\n\n", "utf-8"))
+
+
+def _create_error(message: str, error_type: str) -> dict:
+    return {"error": {"message": message, "type": error_type, "param": None, "code": None}}
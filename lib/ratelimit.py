@@ -0,0 +1,380 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+from typing import Mapping
+
+logger = logging.getLogger(__name__)
+
+_rate_limit_kinds = ("requests", "tokens")
+
+
+def parse_rate_limit_headers(headers: Mapping[str, str]) -> dict[str, float]:
+    """Parse OpenAI's `x-ratelimit-limit-*` and `x-ratelimit-remaining-*` headers.
+
+    Args:
+        headers: The HTTP response headers (with case-insensitive keys).
+
+    Returns:
+        A dictionary with the entries `limit_requests`, `limit_tokens`, `remaining_requests`, and `remaining_tokens`
+        that are present in the headers.
+
+    >>> parse_rate_limit_headers({"x-ratelimit-limit-tokens": "2000000", "x-ratelimit-remaining-tokens": "1999500",
+    ...                           "x-ratelimit-remaining-requests": "n/a"})
+    {'limit_tokens': 2000000.0, 'remaining_tokens': 1999500.0}
+    """
+    headers = {key.lower(): value for key, value in headers.items()}
+    limits = {}
+    for field in ("limit", "remaining"):
+        for kind in _rate_limit_kinds:
+            if f"x-ratelimit-{field}-{kind}" in headers.keys():
+                try:
+                    limits[f"{field}_{kind}"] = float(headers[f"x-ratelimit-{field}-{kind}"])
+                except ValueError:
+                    pass
+    return limits
+
+
+class TokenBucket:
+    """Token bucket that refills continuously at a fixed rate up to its capacity.
+
+    The bucket may go into debt when an amount larger than its capacity is consumed, so that requests that are larger
+    than the capacity are still admitted once the bucket is full.
+    """
+    capacity: float
+    rate: float
+    available: float
+
+    def __init__(self, capacity: float, rate: float, *, now: float | None = None) -> None:
+        """Create a full token bucket.
+
+        Args:
+            capacity: The maximum number of tokens in the bucket.
+            rate: The number of tokens that are added per second.
+            now: The current time in seconds.
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.available = capacity
+        self._updated = time.monotonic() if now is None else now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Compute the number of seconds until the given amount can be consumed.
+
+        Args:
+            amount: The amount to consume.
+            now: The current time in seconds.
+
+        Returns:
+            The number of seconds to wait, which is 0 if the amount can be consumed right away.
+        """
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.available
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def consume(self, amount: float, now: float) -> None:
+        """Consume the given amount from the bucket.
+
+        Args:
+            amount: The amount to consume.
+            now: The current time in seconds.
+        """
+        self._refill(now)
+        self.available -= amount
+
+    def refund(self, amount: float, now: float) -> None:
+        """Return the given amount to the bucket.
+
+        Args:
+            amount: The amount to return.
+            now: The current time in seconds.
+        """
+        self._refill(now)
+        self.available = min(self.capacity, self.available + amount)
+
+    def resize(self, capacity: float, now: float) -> None:
+        """Change the capacity and the refill rate of the bucket, which refills its capacity once per minute.
+
+        Args:
+            capacity: The new capacity.
+            now: The current time in seconds.
+        """
+        self._refill(now)
+        self.rate = self.rate * capacity / self.capacity
+        self.capacity = capacity
+        self.available = min(self.capacity, self.available)
+
+    def clamp(self, amount: float, now: float) -> None:
+        """Reduce the available amount to at most the given amount.
+
+        Args:
+            amount: The maximum available amount.
+            now: The current time in seconds.
+        """
+        self._refill(now)
+        self.available = min(self.available, amount)
+
+    def state(self, now: float) -> dict:
+        """Describe the current state of the bucket.
+
+        Args:
+            now: The current time in seconds.
+
+        Returns:
+            A dictionary with the capacity, the available amount, and the refill rate per second.
+        """
+        self._refill(now)
+        return {"capacity": self.capacity, "available": self.available, "rate_per_second": self.rate}
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self.available = min(self.capacity, self.available + (now - self._updated) * self.rate)
+            self._updated = now
+
+
+class RateLimiter:
+    """Rate limiter that admits requests according to per-model requests-per-minute and tokens-per-minute limits.
+
+    Each model has one token bucket for requests and one for tokens, which are created from the model parameters
+    (`max_rpm` and `max_tpm`) scaled by the given share of the API limits. Admission is O(1) and callers are told
+    exactly how long to wait instead of polling.
+
+    Once the API reports the actual limits and the remaining capacity in its `x-ratelimit-*` headers, the buckets are
+    resized to the actual limits and never hold more than the remaining capacity. Since the remaining capacity also
+    reflects the usage of everyone else who shares the API key, the share is no longer needed then.
+    """
+    share: float
+
+    def __init__(self, model_parameters: dict[str, dict], share: float) -> None:
+        """Create the rate limiter.
+
+        Args:
+            model_parameters: The model parameters with `max_rpm` and `max_tpm` for each model.
+            share: The share of the API limits that may be used.
+        """
+        self.share = share
+        self._model_parameters = model_parameters
+        self._buckets = {}
+        self._paused_until = {}
+        self._blockers = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, model: str, tokens: int, *, now: float | None = None) -> float:
+        """Try to admit a request with the given number of tokens.
+
+        Args:
+            model: The name of the model.
+            tokens: The (estimated) number of tokens of the request.
+            now: The current time in seconds.
+
+        Returns:
+            0 if the request has been admitted, otherwise the number of seconds to wait before trying again.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            requests_bucket, tokens_bucket = self._get_buckets(model, now)
+            wait_times = {
+                "requests": requests_bucket.wait_time(1, now),
+                "tokens": tokens_bucket.wait_time(tokens, now),
+                "paused": self._paused_until.get(model, now) - now
+            }
+            wait_time = max(wait_times.values())
+            if wait_time <= 0:
+                requests_bucket.consume(1, now)
+                tokens_bucket.consume(tokens, now)
+                return 0.0
+            self._blockers[model] = max(wait_times.keys(), key=wait_times.get)
+            return wait_time
+
+    def blocker(self, model: str) -> str | None:
+        """Name the limit that blocked the last request for the given model that was not admitted.
+
+        Args:
+            model: The name of the model.
+
+        Returns:
+            `requests`, `tokens`, or `paused`, or None if no request has been blocked yet.
+        """
+        with self._lock:
+            return self._blockers.get(model)
+
+    async def acquire(self, model: str, tokens: int) -> None:
+        """Wait until a request with the given number of tokens is admitted.
+
+        Args:
+            model: The name of the model.
+            tokens: The (estimated) number of tokens of the request.
+        """
+        while (wait_time := self.try_acquire(model, tokens)) > 0:
+            logger.debug(f"Sleep {wait_time:.3f} seconds to abide the limits of model '{model}'.")
+            await asyncio.sleep(wait_time)
+
+    def reconcile(self, model: str, estimated_tokens: int, actual_tokens: int, *, now: float | None = None) -> None:
+        """Correct the number of tokens charged for a request once its actual usage is known.
+
+        Args:
+            model: The name of the model.
+            estimated_tokens: The number of tokens that was charged when admitting the request.
+            actual_tokens: The number of tokens that the request actually used.
+            now: The current time in seconds.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            _, tokens_bucket = self._get_buckets(model, now)
+            if actual_tokens < estimated_tokens:
+                tokens_bucket.refund(estimated_tokens - actual_tokens, now)
+            else:
+                tokens_bucket.consume(actual_tokens - estimated_tokens, now)
+
+    def observe(self, model: str, headers: Mapping[str, str], *, now: float | None = None) -> float | None:
+        """Adapt the buckets to the limits and remaining capacity reported by the API.
+
+        Args:
+            model: The name of the model.
+            headers: The HTTP response headers of a request for the model.
+            now: The current time in seconds.
+
+        Returns:
+            The smallest fraction of the requests and tokens limits that remains or None if the headers do not say.
+        """
+        limits = parse_rate_limit_headers(headers)
+        if len(limits) == 0:
+            return None
+        now = time.monotonic() if now is None else now
+        headroom = None
+        with self._lock:
+            for kind, bucket in zip(_rate_limit_kinds, self._get_buckets(model, now)):
+                if f"limit_{kind}" in limits.keys() and limits[f"limit_{kind}"] > 0:
+                    if limits[f"limit_{kind}"] != bucket.capacity:
+                        logger.debug(f"Adapt the {kind} limit of model '{model}' to {limits[f'limit_{kind}']:.0f}.")
+                        bucket.resize(limits[f"limit_{kind}"], now)
+                if f"remaining_{kind}" in limits.keys():
+                    bucket.clamp(limits[f"remaining_{kind}"], now)
+                    fraction = limits[f"remaining_{kind}"] / bucket.capacity
+                    headroom = fraction if headroom is None else min(headroom, fraction)
+        return headroom
+
+    def pause(self, model: str, seconds: float, *, now: float | None = None) -> None:
+        """Stop admitting requests for the given model, e.g., because the API responded with `429 Too Many Requests`.
+
+        Args:
+            model: The name of the model.
+            seconds: The number of seconds for which no requests should be admitted.
+            now: The current time in seconds.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._paused_until[model] = max(self._paused_until.get(model, now), now + seconds)
+
+    def state(self) -> dict:
+        """Describe the current state of the rate limiter for monitoring.
+
+        Returns:
+            A dictionary that maps each model to the states of its `requests` and `tokens` buckets and the number of
+            seconds for which admission is paused.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    "requests": requests_bucket.state(now),
+                    "tokens": tokens_bucket.state(now),
+                    "paused_for": max(0.0, self._paused_until.get(model, now) - now)
+                }
+                for model, (requests_bucket, tokens_bucket) in self._buckets.items()
+            }
+
+    def _get_buckets(self, model: str, now: float) -> tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets.keys():
+            model_params = self._model_parameters[model]
+            max_requests = model_params["max_rpm"] * self.share
+            max_tokens = model_params["max_tpm"] * self.share
+            self._buckets[model] = (
+                TokenBucket(max_requests, max_requests / 60, now=now),
+                TokenBucket(max_tokens, max_tokens / 60, now=now)
+            )
+        return self._buckets[model]
+
+
+class AdaptiveConcurrency:
+    """Limits the number of requests in flight with a limit that adapts to the API like TCP congestion control.
+
+    The limit grows additively by about one request per round trip while requests succeed and shrinks
+    multiplicatively when the API signals overload (e.g., `429 Too Many Requests` or little remaining capacity). Only
+    one decrease happens per cooldown period, since a burst of overload signals usually has a single cause.
+
+    The controller must be used from a single event loop.
+    """
+    limit: float
+    minimum: int
+    maximum: int
+    in_flight: int
+
+    def __init__(
+            self,
+            initial: int,
+            *,
+            minimum: int = 1,
+            maximum: int,
+            increase: float = 1.0,
+            decrease: float = 0.5,
+            cooldown: float = 1.0
+    ) -> None:
+        """Create the controller.
+
+        Args:
+            initial: The initial limit.
+            minimum: The smallest limit.
+            maximum: The largest limit.
+            increase: The increase of the limit per round trip of successful requests.
+            decrease: The factor by which the limit is multiplied on overload.
+            cooldown: The minimum number of seconds between two decreases.
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._increase = increase
+        self._decrease = decrease
+        self._cooldown = cooldown
+        self._last_decrease = None
+        self._waiters = collections.deque()
+
+    async def acquire(self) -> None:
+        """Wait until another request may be in flight."""
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def release(self) -> None:
+        """Mark a request as no longer in flight."""
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def on_success(self) -> None:
+        """Increase the limit after a successful request."""
+        self.limit = min(self.maximum, self.limit + self._increase / self.limit)
+        self._wake_waiters()
+
+    def on_overload(self, *, now: float | None = None) -> None:
+        """Decrease the limit after a signal of overload.
+
+        Args:
+            now: The current time in seconds.
+        """
+        now = time.monotonic() if now is None else now
+        if self._last_decrease is None or now - self._last_decrease >= self._cooldown:
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self._decrease)
+            logger.debug(f"Decrease the number of requests in flight to {int(self.limit)}.")
+
+    def _wake_waiters(self) -> None:
+        for _ in range(int(self.limit) - self.in_flight):
+            while len(self._waiters) > 0 and self._waiters[0].done():
+                self._waiters.popleft()
+            if len(self._waiters) == 0:
+                break
+            self._waiters.popleft().set_result(None)
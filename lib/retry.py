@@ -0,0 +1,221 @@
+import bisect
+import collections
+import dataclasses
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+from typing import Mapping
+
+logger = logging.getLogger(__name__)
+
+_retryable_status_codes = {408, 409, 429, 500, 502, 503, 504}
+_duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_duration_units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+_retry_random = random.Random(510316772)
+
+
+def is_retryable(status: int | None) -> bool:
+    """Determine whether a failed request should be retried.
+
+    Args:
+        status: The HTTP status code or None if the request failed without a response.
+
+    Returns:
+        Whether the request should be retried.
+
+    >>> is_retryable(429), is_retryable(400), is_retryable(None)
+    (True, False, True)
+    """
+    return status is None or status in _retryable_status_codes
+
+
+def parse_duration(s: str) -> float | None:
+    """Parse a duration like the ones in OpenAI's `x-ratelimit-reset-*` headers.
+
+    Args:
+        s: The duration string.
+
+    Returns:
+        The duration in seconds or None if the string cannot be parsed.
+
+    >>> parse_duration("6m0s"), parse_duration("20ms"), parse_duration("1.5"), parse_duration("soon")
+    (360.0, 0.02, 1.5, None)
+    """
+    s = s.strip()
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    matches = _duration_pattern.findall(s)
+    if len(matches) == 0 or "".join(value + unit for value, unit in matches) != s:
+        return None
+    return sum(float(value) * _duration_units[unit] for value, unit in matches)
+
+
+def parse_retry_after(headers: Mapping[str, str], status: int | None = None) -> float | None:
+    """Determine how long the server asks to wait before retrying.
+
+    Considers `retry-after-ms`, `Retry-After` (seconds or HTTP date), and, for `429 Too Many Requests` responses,
+    OpenAI's `x-ratelimit-reset-requests` and `x-ratelimit-reset-tokens` of the exhausted limits. OpenAI sends the reset
+    headers with every response, so they do not say anything about other failures or about limits that are not
+    exhausted.
+
+    Args:
+        headers: The HTTP response headers (with case-insensitive keys).
+        status: The HTTP status code of the response, if any.
+
+    Returns:
+        The number of seconds to wait or None if the headers do not say.
+
+    >>> parse_retry_after({"retry-after": "3"})
+    3.0
+    >>> headers = {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "2s",
+    ...            "x-ratelimit-remaining-requests": "9", "x-ratelimit-reset-requests": "20ms"}
+    >>> parse_retry_after(headers, 429), parse_retry_after(headers, 500)
+    (2.0, None)
+    """
+    headers = {key.lower(): value for key, value in headers.items()}
+
+    if "retry-after-ms" in headers.keys():
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    if "retry-after" in headers.keys():
+        delay = parse_duration(headers["retry-after"])
+        if delay is not None:
+            return delay
+        try:
+            date = email.utils.parsedate_to_datetime(headers["retry-after"])
+            return max(0.0, date.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    if status != 429:
+        return None
+    exhausted_resets = []
+    for kind in ("requests", "tokens"):
+        if f"x-ratelimit-reset-{kind}" in headers.keys() and headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = parse_duration(headers[f"x-ratelimit-reset-{kind}"])
+            if reset is not None:
+                exhausted_resets.append(reset)
+    if len(exhausted_resets) > 0:
+        return max(exhausted_resets)
+    return None
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    """Exponential backoff with jitter that respects the server's retry headers."""
+    max_attempts: int = 6
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    jitter: float = 0.5
+
+    def compute_delay(self, attempt: int, headers: Mapping[str, str] | None = None, status: int | None = None) -> float:
+        """Compute the number of seconds to wait before the next attempt.
+
+        Args:
+            attempt: The number of the failed attempt, starting at 0.
+            headers: The HTTP response headers of the failed attempt, if any.
+            status: The HTTP status code of the failed attempt, if any.
+
+        Returns:
+            The number of seconds to wait.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay *= 1 - self.jitter * _retry_random.random()
+        if headers is not None:
+            retry_after = parse_retry_after(headers, status)
+            if retry_after is not None:
+                # the server knows best, but spread out the retries a little
+                delay = min(self.max_delay, retry_after) * (1 + 0.1 * _retry_random.random())
+        return delay
+
+
+class RetryBudget:
+    """Limits the total number of retries within a run, so that a persistent outage does not multiply the load."""
+    max_retries: int
+    num_retries: int
+
+    def __init__(self, max_retries: int) -> None:
+        """Create the retry budget.
+
+        Args:
+            max_retries: The maximum number of retries.
+        """
+        self.max_retries = max_retries
+        self.num_retries = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        """Try to spend one retry from the budget.
+
+        Returns:
+            Whether the budget permitted the retry.
+        """
+        with self._lock:
+            if self.num_retries >= self.max_retries:
+                return False
+            self.num_retries += 1
+            return True
+
+
+class LatencyPercentile:
+    """Online estimate of a latency percentile over a sliding window of the most recent observations.
+
+    >>> latency = LatencyPercentile(0.9, window=100, min_samples=10)
+    >>> latency.estimate() is None
+    True
+    >>> for i in range(200):
+    ...     latency.observe(i / 100)
+    >>> latency.estimate()
+    1.89
+    """
+    percentile: float
+    window: int
+    min_samples: int
+
+    def __init__(self, percentile: float, *, window: int = 1_000, min_samples: int = 20) -> None:
+        """Create the estimate.
+
+        Args:
+            percentile: The percentile to estimate as a fraction between 0 and 1.
+            window: The number of most recent observations to consider.
+            min_samples: The number of observations below which there is no estimate yet.
+        """
+        if not 0 < percentile < 1:
+            raise AssertionError(f"Invalid percentile {percentile}, must be between 0 and 1!")
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self._recent = collections.deque()
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Add an observed latency.
+
+        Args:
+            seconds: The latency in seconds.
+        """
+        with self._lock:
+            self._recent.append(seconds)
+            bisect.insort(self._sorted, seconds)
+            if len(self._recent) > self.window:
+                del self._sorted[bisect.bisect_left(self._sorted, self._recent.popleft())]
+
+    def estimate(self) -> float | None:
+        """Estimate the percentile.
+
+        Returns:
+            The latency in seconds or None if there are not enough observations yet.
+        """
+        with self._lock:
+            if len(self._sorted) < self.min_samples:
+                return None
+            return self._sorted[int(self.percentile * (len(self._sorted) - 1))]
@@ -0,0 +1,198 @@
+import collections
+import heapq
+import itertools
+from typing import Callable, Generic, Hashable, Iterable, Sequence, TypeVar
+
+from lib.ratelimit import TokenBucket
+
+_T = TypeVar("_T")
+_V = TypeVar("_V")
+
+_simulation_tolerance = 1e-9  # seconds of waiting that are ignored to absorb the rounding errors of the token buckets
+
+
+def order_by_prefix(segments: list[Sequence[Hashable]], sizes: list[int]) -> list[list[int]]:
+    """Group items by their first segment and order them so that items that share a prefix are adjacent.
+
+    Each item is a sequence of segments (e.g., the hashes of the messages of a request). Items with the same first
+    segment form a group, and the items of a group are ordered by their segments, so that items that share a longer
+    prefix of segments are next to each other. The groups are ordered by their total size, largest first.
+
+    >>> order_by_prefix([["a", "x"], ["b", "y"], ["a", "y"], ["a", "x"], []], [1, 5, 1, 1, 2])
+    [[1], [0, 3, 2], [4]]
+
+    Args:
+        segments: The segments of each item.
+        sizes: The size of each item (e.g., its maximum number of tokens).
+
+    Returns:
+        The groups as lists of item indices in execution order.
+    """
+    groups = {}
+    for index, item_segments in enumerate(segments):
+        groups.setdefault(item_segments[0] if len(item_segments) > 0 else None, []).append(index)
+    ordered_groups = []
+    for group in groups.values():
+        ordered_groups.append(sorted(group, key=lambda i: tuple(segments[i])))
+    ordered_groups.sort(key=lambda group: sum(sizes[i] for i in group), reverse=True)
+    return ordered_groups
+
+
+class LookaheadQueue(Generic[_T]):
+    """Queue whose first items may overtake each other when the rate limits admit them, but the head not.
+
+    Items are admitted in order, except that an item within the lookahead window may overtake the items before it if
+    they do not fit into the current rate limits but it does. This packs smaller requests into the tokens that remain
+    while a larger request waits for the token window to refill. To keep large requests from starving, the head of
+    the queue may be overtaken only a limited number of times, after which it is the only candidate.
+
+    >>> queue = LookaheadQueue([5, 3, 1, 2], window=3, max_skips=1)
+    >>> queue.pop_first(lambda size: True if size <= 3 else None)
+    (3, True)
+    >>> queue.candidates()
+    [5]
+    >>> queue.pop_first(lambda size: True if size <= 3 else None) is None
+    True
+    >>> queue.pop_head(), queue.candidates()
+    (5, [1, 2])
+    """
+    window: int
+    max_skips: int
+
+    def __init__(self, items: Iterable[_T], *, window: int, max_skips: int) -> None:
+        """Create the queue.
+
+        Args:
+            items: The items in the order in which they should be admitted.
+            window: The number of items at the front of the queue that are candidates for admission.
+            max_skips: The number of times the head of the queue may be overtaken.
+        """
+        if window < 1:
+            raise AssertionError(f"Invalid lookahead window {window}, must be at least 1!")
+        self.window = window
+        self.max_skips = max_skips
+        self._items = collections.deque(items)
+        self._num_skips = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def head(self) -> _T:
+        """Return the item at the front of the queue without removing it."""
+        return self._items[0]
+
+    def candidates(self) -> list[_T]:
+        """Return the items that may be admitted next, head first."""
+        if self._num_skips >= self.max_skips:
+            return [self._items[0]] if len(self._items) > 0 else []
+        return list(itertools.islice(self._items, self.window))
+
+    def pop_first(self, try_admit: Callable[[_T], _V | None]) -> tuple[_T, _V] | None:
+        """Remove and return the first candidate that can be admitted right away.
+
+        Args:
+            try_admit: Tries to admit an item without waiting and returns None if it cannot be admitted.
+
+        Returns:
+            The admitted item and the result of `try_admit` or None if no candidate can be admitted right away.
+        """
+        for position, item in enumerate(self.candidates()):
+            result = try_admit(item)
+            if result is not None:
+                del self._items[position]
+                self._num_skips = 0 if position == 0 else self._num_skips + 1
+                return item, result
+        return None
+
+    def pop_head(self) -> _T:
+        """Remove and return the item at the front of the queue (e.g., once it has waited to be admitted)."""
+        self._num_skips = 0
+        return self._items.popleft()
+
+    def remaining(self) -> list[_T]:
+        """Return the items that have not been admitted."""
+        return list(self._items)
+
+
+def simulate_makespan(
+        items: list[tuple[str, int, int]],
+        limits: dict[str, tuple[float, float]],
+        *,
+        latency: float,
+        max_in_flight: int,
+        window: int = 1,
+        max_skips: int = 0
+) -> dict:
+    """Simulate the admission of requests against per-model rate limits to project how long their execution takes.
+
+    The simulation admits the requests like the executor: each request is charged one request and its estimated
+    tokens, takes the given latency, and is then charged its actual tokens instead. With a window of 1, the requests are
+    admitted strictly in order.
+
+    >>> items = [("m", 60, 30), ("m", 60, 30), ("m", 10, 5), ("m", 10, 5)]
+    >>> simulate_makespan(items, {"m": (60, 100)}, latency=1.0, max_in_flight=8)["makespan"]
+    3.0
+    >>> simulate_makespan(items, {"m": (60, 100)}, latency=1.0, max_in_flight=8, window=4, max_skips=4)["makespan"]
+    2.0
+
+    Args:
+        items: The model, the estimated tokens, and the actual tokens of each request in execution order.
+        limits: The requests per minute and tokens per minute of each model.
+        latency: The number of seconds that each request takes.
+        max_in_flight: The maximum number of requests in flight.
+        window: The lookahead window of the admission (see `LookaheadQueue`).
+        max_skips: The number of times the head of the queue may be overtaken.
+
+    Returns:
+        The makespan in seconds, the tokens per minute, and the mean time that the requests waited for admission.
+    """
+    buckets = {}
+    for model, (max_requests, max_tokens) in limits.items():
+        buckets[model] = (TokenBucket(max_requests, max_requests / 60, now=0.0),
+                          TokenBucket(max_tokens, max_tokens / 60, now=0.0))
+    queue = LookaheadQueue(range(len(items)), window=window, max_skips=max_skips)
+    in_flight = []  # heap of (done time, index)
+    now, total_wait_time, makespan = 0.0, 0.0, 0.0
+
+    def wait_time(index: int) -> float:
+        model, estimated_tokens, _ = items[index]
+        requests_bucket, tokens_bucket = buckets[model]
+        return max(requests_bucket.wait_time(1, now), tokens_bucket.wait_time(estimated_tokens, now))
+
+    def try_admit(index: int) -> bool | None:
+        if wait_time(index) > _simulation_tolerance:
+            return None
+        model, estimated_tokens, _ = items[index]
+        requests_bucket, tokens_bucket = buckets[model]
+        requests_bucket.consume(1, now)
+        tokens_bucket.consume(estimated_tokens, now)
+        return True
+
+    while True:
+        while len(in_flight) > 0 and in_flight[0][0] <= now:
+            done, index = heapq.heappop(in_flight)
+            model, estimated_tokens, actual_tokens = items[index]
+            buckets[model][1].refund(estimated_tokens - actual_tokens, now)
+            makespan = max(makespan, done)
+        if len(queue) == 0 and len(in_flight) == 0:
+            break
+
+        if len(queue) > 0 and len(in_flight) < max_in_flight:
+            admitted = queue.pop_first(try_admit)
+            if admitted is not None:
+                total_wait_time += now
+                heapq.heappush(in_flight, (now + latency, admitted[0]))
+                continue
+
+        # advance to the next time at which a request is done or a candidate fits into the limits
+        next_times = [in_flight[0][0]] if len(in_flight) > 0 else []
+        if len(queue) > 0 and len(in_flight) < max_in_flight:
+            next_times.append(now + min(wait_time(index) for index in queue.candidates()))
+        now = min(next_times)
+
+    total_tokens = sum(actual_tokens for _, _, actual_tokens in items)
+    return {
+        "makespan": makespan,
+        "tokens_per_minute": total_tokens / makespan * 60 if makespan > 0 else 0.0,
+        "mean_wait_time": total_wait_time / len(items) if len(items) > 0 else 0.0
+    }
@@ -0,0 +1,183 @@
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+import tiktoken
+
+from lib.data import get_data_path
+
+logger = logging.getLogger(__name__)
+
+_token_counts_path = get_data_path() / "token_counts.sqlite3"
+_num_threads = 8
+_max_memoized_counts = 100_000  # the memo is bounded, so that executing a stream of requests uses bounded memory
+_max_unsaved_counts = 10_000  # number of new counts after which they are persisted without waiting for `save()`
+_lookup_chunk_size = 500
+
+
+class TokenCounter:
+    """Counts tokens with tiktoken and memoizes the counts.
+
+    The encoders are created once per model and the counts are memoized by the hash of the encoded text, so that texts
+    that occur in many requests (like the instruction with all column types) are only encoded once. The memo keeps the
+    most recently used counts, and the counts can be persisted to disk to reuse them in later runs, which are looked up
+    on demand.
+    """
+    path: pathlib.Path | None
+
+    def __init__(self, path: pathlib.Path | None = None) -> None:
+        """Create the token counter.
+
+        Args:
+            path: An optional path of the SQLite file in which to persist the counts.
+        """
+        self.path = path
+        self._encodings = {}
+        self._encoding_names = {}
+        self._counts = collections.OrderedDict()  # least recently used first
+        self._new_counts = {}  # counts that have not been persisted yet
+        self._connection = None  # read-only connection for looking up persisted counts, opened once the file exists
+        self._lock = threading.Lock()
+
+    def get_encoding(self, model: str) -> tiktoken.Encoding:
+        """Get the encoding for the given model.
+
+        Args:
+            model: The name of the model.
+
+        Returns:
+            The tiktoken encoding.
+        """
+        with self._lock:
+            if model not in self._encodings.keys():
+                if model in self._encoding_names.keys():
+                    self._encodings[model] = tiktoken.get_encoding(self._encoding_names[model])
+                else:
+                    self._encodings[model] = tiktoken.encoding_for_model(model)
+            return self._encodings[model]
+
+    def register_encoding(self, model: str, encoding_name: str) -> None:
+        """Use the given encoding for a model that tiktoken does not know (e.g., one that is served locally).
+
+        Args:
+            model: The name of the model.
+            encoding_name: The name of the tiktoken encoding (e.g., `cl100k_base`).
+        """
+        with self._lock:
+            if self._encoding_names.get(model) != encoding_name:
+                self._encoding_names[model] = encoding_name
+                self._encodings.pop(model, None)
+
+    def count(self, text: str, model: str) -> int:
+        """Count the tokens of the given text.
+
+        Args:
+            text: The text.
+            model: The name of the model.
+
+        Returns:
+            The number of tokens.
+        """
+        return self.count_many([text], model)[0]
+
+    def count_many(self, texts: list[str], model: str, *, num_threads: int = _num_threads) -> list[int]:
+        """Count the tokens of the given texts, encoding the texts that have not been counted before in parallel.
+
+        Args:
+            texts: The texts.
+            model: The name of the model.
+            num_threads: The number of threads used to encode the texts.
+
+        Returns:
+            The numbers of tokens.
+        """
+        encoding = self.get_encoding(model)
+        keys = [f"{encoding.name}:{hashlib.sha256(bytes(text, 'utf-8')).hexdigest()}" for text in texts]
+
+        counts = {}
+        with self._lock:
+            for key in keys:
+                if key in self._counts.keys():
+                    self._counts.move_to_end(key)
+                    counts[key] = self._counts[key]
+                elif key in self._new_counts.keys():
+                    counts[key] = self._new_counts[key]
+        missing = {key: text for key, text in zip(keys, texts) if key not in counts.keys()}
+
+        if len(missing) > 0:
+            counts.update(self._load_counts(list(missing.keys())))
+            missing = {key: text for key, text in missing.items() if key not in counts.keys()}
+        if len(missing) > 0:
+            if len(missing) == 1:
+                new_counts = [len(encoding.encode(text)) for text in missing.values()]
+            else:
+                new_counts = [len(tokens) for tokens in encoding.encode_batch(list(missing.values()),
+                                                                              num_threads=num_threads)]
+            counts.update(zip(missing.keys(), new_counts))
+            if self.path is not None:
+                with self._lock:
+                    self._new_counts.update(zip(missing.keys(), new_counts))
+
+        with self._lock:
+            for key, count in counts.items():
+                self._counts[key] = count
+                self._counts.move_to_end(key)
+            while len(self._counts) > _max_memoized_counts:
+                self._counts.popitem(last=False)
+            num_unsaved_counts = len(self._new_counts)
+        if num_unsaved_counts >= _max_unsaved_counts:
+            self.save()
+        return [counts[key] for key in keys]
+
+    def save(self) -> None:
+        """Persist the counts that have been computed since the last save."""
+        if self.path is None:
+            return
+        with self._lock:
+            new_counts = list(self._new_counts.items())
+            self._new_counts = {}
+        if len(new_counts) > 0:
+            os.makedirs(self.path.parent, exist_ok=True)
+            with contextlib.closing(sqlite3.connect(self.path)) as connection, connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS token_counts (key TEXT PRIMARY KEY, count INTEGER)")
+                connection.executemany("INSERT OR REPLACE INTO token_counts (key, count) VALUES (?, ?)", new_counts)
+            logger.debug(f"Persisted {len(new_counts)} token counts.")
+
+    def _load_counts(self, keys: list[str]) -> dict[str, int]:
+        counts = {}
+        with self._lock:
+            if self._connection is None:
+                if self.path is None or not self.path.is_file():
+                    return counts
+                self._connection = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True,
+                                                   check_same_thread=False)
+            try:
+                for start in range(0, len(keys), _lookup_chunk_size):
+                    chunk = keys[start:start + _lookup_chunk_size]
+                    counts.update(self._connection.execute(
+                        f"SELECT key, count FROM token_counts WHERE key IN ({', '.join('?' * len(chunk))})", chunk))
+            except sqlite3.OperationalError:
+                return {}  # no counts have been persisted yet
+        return counts
+
+
+_token_counter: TokenCounter | None = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter() -> TokenCounter:
+    """Get the token counter that is shared by all API helpers.
+
+    Returns:
+        The shared TokenCounter, which persists its counts in the data directory.
+    """
+    global _token_counter
+    with _token_counter_lock:
+        if _token_counter is None:
+            _token_counter = TokenCounter(_token_counts_path)
+        return _token_counter
@@ -0,0 +1,267 @@
+import bisect
+import dataclasses
+import http.server
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_trace_times = ("enqueued", "admitted", "sent", "first_byte", "done")
+_default_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0, 300.0)
+
+
+@dataclasses.dataclass(slots=True)
+class RequestTrace:
+    """Trace of one request through the executor.
+
+    All times are readings of `time.monotonic()`, which the tracer converts to seconds since the start of the run. A
+    request is enqueued when the run starts, admitted once the concurrency limit, the budget, and the rate limiter let
+    it pass, sent when its first attempt starts (after the cache lookup), and done once its response has been
+    processed. `first_byte` is the time at which the headers of the last attempt arrived. `blocked` holds the time
+    spent waiting for each limiter.
+    """
+    index: int
+    model: str
+    hash: str
+    estimated_tokens: int
+    enqueued: float
+    admitted: float | None = None
+    sent: float | None = None
+    first_byte: float | None = None
+    done: float | None = None
+    credential: str | None = None
+    cache: str | None = None  # `hit`, `miss`, or `coalesced` (with another process)
+    status: int | None = None
+    attempts: int = 0
+    hedges: int = 0  # duplicates sent because the request was slow
+    actual_tokens: int | None = None
+    cached_tokens: int | None = None  # prompt tokens served from the provider's prompt cache
+    cache_seconds: float = 0.0
+    blocked: dict[str, float] = dataclasses.field(default_factory=dict)
+
+    def add_blocked(self, limiter: str, seconds: float) -> None:
+        self.blocked[limiter] = self.blocked.get(limiter, 0.0) + seconds
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Process-wide counters, gauges, and histograms that are exported in the Prometheus text format.
+
+    Metrics are created on first use and identified by their name and labels. The text can be written to a file (e.g.,
+    for the textfile collector of the node exporter) or served over HTTP.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = {}  # name -> {labels: value or _Histogram}
+        self._server = None
+
+    def describe(self, name: str, metric_type: str, help_text: str) -> None:
+        """Declare the type (`counter`, `gauge`, or `histogram`) and the help text of a metric.
+
+        Args:
+            name: The name of the metric.
+            metric_type: The type of the metric.
+            help_text: The help text.
+        """
+        with self._lock:
+            self._types[name] = metric_type
+            self._help[name] = help_text
+            self._values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        """Increase a counter.
+
+        Args:
+            name: The name of the counter.
+            value: The amount by which to increase the counter.
+            **labels: The labels of the counter.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set a gauge.
+
+        Args:
+            name: The name of the gauge.
+            value: The value of the gauge.
+            **labels: The labels of the gauge.
+        """
+        with self._lock:
+            self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Add an observation to a histogram.
+
+        Args:
+            name: The name of the histogram.
+            value: The observed value.
+            **labels: The labels of the histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            if key not in values.keys():
+                values[key] = _Histogram(_default_buckets)
+            values[key].observe(value)
+
+    def samples(self, name: str) -> dict[tuple[tuple[str, str], ...], float]:
+        """Get the values of a counter or a gauge.
+
+        Args:
+            name: The name of the counter or gauge.
+
+        Returns:
+            A dictionary that maps the sorted (name, value) pairs of the labels to the values.
+        """
+        with self._lock:
+            return dict(self._values.get(name, {}))
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format.
+
+        Returns:
+            The text.
+        """
+        lines = []
+        with self._lock:
+            for name, values in sorted(self._values.items()):
+                if name in self._help.keys():
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                    lines.append(f"# TYPE {name} {self._types[name]}")
+                for key, value in sorted(values.items()):
+                    if isinstance(value, _Histogram):
+                        cumulative = 0
+                        for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                            cumulative += count
+                            le = "+Inf" if bound == float("inf") else repr(bound)
+                            lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                        lines.append(f"{name}_sum{_format_labels(key)} {value.sum}")
+                        lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+                    else:
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: pathlib.Path) -> None:
+        """Write all metrics in the Prometheus text format to the given file, replacing it atomically.
+
+        Args:
+            path: The path of the file.
+        """
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, host: str, port: int) -> None:
+        """Serve all metrics in the Prometheus text format over HTTP in a background thread.
+
+        Args:
+            host: The host to bind to.
+            port: The port to bind to.
+        """
+        if self._server is not None:
+            return
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                content = bytes(metrics.render(), "utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serve metrics on http://{host}:{self._server.server_address[1]}/metrics.")
+
+
+class Tracer:
+    """Collects the traces of the requests of one run, appends them to a JSONL file, and updates the metrics."""
+    start_time: float
+
+    def __init__(self, metrics: Metrics, path: pathlib.Path | None = None) -> None:
+        """Create the tracer.
+
+        Args:
+            metrics: The metrics to update.
+            path: An optional JSONL file to which the traces are appended.
+        """
+        self.start_time = time.monotonic()
+        self._metrics = metrics
+        self._file = None if path is None else open(path, "a", encoding="utf-8")
+        self._run_started = time.time()
+
+    def finish(self, trace: RequestTrace) -> None:
+        """Record the trace of a request that is done.
+
+        Args:
+            trace: The trace.
+        """
+        trace.done = time.monotonic()
+        model = trace.model
+        self._metrics.inc("openai_requests_total", model=model, cache=trace.cache or "none",
+                          status=str(trace.status))
+        if trace.attempts > 1:
+            self._metrics.inc("openai_retries_total", trace.attempts - 1, model=model)
+        if trace.actual_tokens is not None:
+            self._metrics.inc("openai_tokens_total", trace.actual_tokens, model=model)
+        for limiter, seconds in trace.blocked.items():
+            self._metrics.inc("openai_blocked_seconds_total", seconds, limiter=limiter)
+        if trace.admitted is not None:
+            self._metrics.observe("openai_queue_seconds", trace.admitted - trace.enqueued, model=model)
+        if trace.sent is not None:
+            self._metrics.observe("openai_request_seconds", trace.done - trace.sent, model=model)
+        if trace.first_byte is not None and trace.sent is not None:
+            self._metrics.observe("openai_first_byte_seconds", trace.first_byte - trace.sent, model=model)
+
+        if self._file is not None:
+            record = dataclasses.asdict(trace)
+            for name in _trace_times:
+                if record[name] is not None:
+                    record[name] = round(record[name] - self.start_time, 6)
+            self._file.write(json.dumps({"run_started": self._run_started, **record}) + "\n")
+
+    def close(self) -> None:
+        """Close the trace file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _format_labels(key: tuple[tuple[str, str], ...]) -> str:
+    """Format the labels of a metric.
+
+    >>> _format_labels((("model", "gpt-4"), ("cache", 'a"b')))
+    '{model="gpt-4",cache="a\\\\"b"}'
+    >>> _format_labels(())
+    ''
+    """
+    if len(key) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(key, escaped)) + "}"
@@ -5,6 +5,8 @@ set -e
 limit_instances=null
 
 api_name="openai"
+execute_mode="sync"  # use "batch" to push the requests through the Batch API
+offline=${offline:-false}  # use true to only replay the responses in data/openai_cache (as reproduce.sh does)
 
 limit_instances=500
 
@@ -23,7 +25,7 @@ for dataset in "${datasets[@]}"; do
   for model in "${models[@]}"; do
 
     exp_name="$model-with-headers"
-    params="exp_name=$exp_name dataset=$dataset limit_instances=$limit_instances api_name=$api_name model=$model use_inst_all_column_types=$use_inst_all_column_types num_inst_all_column_types=$num_inst_all_column_types"
+    params="exp_name=$exp_name dataset=$dataset limit_instances=$limit_instances api_name=$api_name model=$model use_inst_all_column_types=$use_inst_all_column_types num_inst_all_column_types=$num_inst_all_column_types execute_mode=$execute_mode offline=$offline"
     python scripts/column_type_inference/$dataset/preprocess.py $params
     python scripts/column_type_inference/prepare_requests.py $params
     python scripts/execute_requests.py -cp "../config/column_type_inference" $params
@@ -31,7 +33,7 @@ for dataset in "${datasets[@]}"; do
     python scripts/column_type_inference/plot.py exp_name=$exp_name $params
 
     exp_name="$model-without-headers"
-    params="exp_name=$exp_name dataset=$dataset limit_instances=$limit_instances api_name=$api_name model=$model use_inst_all_column_types=$use_inst_all_column_types num_inst_all_column_types=$num_inst_all_column_types"
+    params="exp_name=$exp_name dataset=$dataset limit_instances=$limit_instances api_name=$api_name model=$model use_inst_all_column_types=$use_inst_all_column_types num_inst_all_column_types=$num_inst_all_column_types execute_mode=$execute_mode offline=$offline"
     python scripts/column_type_inference/$dataset/preprocess.py $params
     python scripts/column_type_inference/prepare_requests.py $params 'linearize_table.template="{{table}}"' linearize_table.csv_params.header=false
     python scripts/execute_requests.py -cp "../config/column_type_inference" $params
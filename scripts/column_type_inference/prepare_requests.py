@@ -9,6 +9,7 @@ from omegaconf import DictConfig, OmegaConf
 from lib.data import get_instances_dir, get_requests_dir, load_json, load_str, dump_json
 from lib.linearize import linearize_table, linearize_list
 from lib.prompt import sample_examples, sample_rows, fill_chat_template, max_tokens_for_ground_truth
+from lib.tokens import get_token_counter
 
 logger = logging.getLogger(__name__)
 
@@ -108,6 +109,8 @@ def prepare_requests(cfg: DictConfig) -> None:
 
         dump_json(request, requests_dir / f"{path.name}.json")
 
+    get_token_counter().save()
+
 
 def stringify_unspecified_column_types(column_types: list[str | None], cfg: DictConfig) -> list[str]:
     return [ct if ct is not None else cfg.unspecified_column_type_string for ct in column_types]
@@ -1,11 +1,18 @@
 import collections
+import json
 import logging
+import os
+import pathlib
+from typing import Iterator
 
 import hydra
 from omegaconf import DictConfig
 
-from lib.data import get_requests_dir, get_responses_dir, load_json, dump_json
-from lib.model import execute_requests_against_api
+from lib.data import get_instances_dir, get_requests_dir, get_responses_dir, get_ledger_path, get_trace_path, \
+    load_json, dump_json
+from lib.ledger import summarize_ledger
+from lib.linearize import list_stop_detector
+from lib.model import execute_requests_against_api, stream_requests_against_api
 
 logger = logging.getLogger(__name__)
 
@@ -14,22 +21,97 @@ _openai_request_seed: int = 321164097
 
 @hydra.main(version_base=None, config_name="config.yaml")  # specify config path via command line flag -cp
 def execute_requests(cfg: DictConfig) -> None:
+    if cfg.execute_mode == "local_batch":
+        raise AssertionError("The execution mode `local_batch` answers with canned responses, which must not be stored "
+                             "as the responses of an experiment!")
+
     requests_dir = get_requests_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
-    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name, clear=True)
+    # do not clear the responses directory so that an interrupted run can be resumed
+    responses_dir = get_responses_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+
+    request_paths = list(sorted(requests_dir.glob("*.json")))
+    all_request_names = set(request_path.name for request_path in request_paths)
+    for response_path in responses_dir.glob("*.json"):
+        if response_path.name not in all_request_names:
+            os.remove(response_path)
+
+    finish_reasons = collections.Counter()
+    pending_request_paths = []
+    for request_path in request_paths:
+        # a response can be reused if it is successful and was written after the request was prepared
+        response_path = responses_dir / request_path.name
+        if response_path.is_file() and response_path.stat().st_mtime >= request_path.stat().st_mtime:
+            try:
+                response = load_json(response_path)
+            except json.JSONDecodeError:
+                response = {}
+            if "choices" in response.keys():
+                finish_reasons[response["choices"][0]["finish_reason"]] += 1
+                continue
+        pending_request_paths.append(request_path)
 
-    requests = []
-    request_names = []  # we need to remember these since sorting paths is not numerical
-    for request_path in list(sorted(requests_dir.glob("*.json"))):
-        requests.append(load_json(request_path))
-        request_names.append(request_path.name)
+    if len(pending_request_paths) < len(request_paths):
+        logger.info(f"Resume execution with {len(pending_request_paths)} of {len(request_paths)} requests still "
+                    f"missing.")
 
-    for request in requests:
+    def load_request(request_path: pathlib.Path) -> dict:
+        request = load_json(request_path)
         request["seed"] = _openai_request_seed
+        return request
+
+    ledger_path = get_ledger_path(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+    budget = cfg.budget
+    if budget is not None:
+        # the budget covers the whole experiment, so a resumed run may only spend what the previous runs have not spent
+        spent = summarize_ledger(ledger_path)["cost"]
+        budget = max(0.0, budget - spent)
+        if spent > 0:
+            logger.info(f"The experiment has already spent ${spent:.2f}, ${budget:.2f} of the budget remain.")
+    trace_path = get_trace_path(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name) if cfg.trace_requests else None
+    if cfg.execute_mode == "stream" and not cfg.offline:
+        if cfg.execute_order != "longest_first" or cfg.stream_until_list_complete or cfg.hedge_percentile is not None \
+                or cfg.pin_responses:
+            raise AssertionError("The execution mode `stream` executes the requests in order without stopping the "
+                                 "generation early, hedging, or pinning the responses!")
+
+        # the request files are loaded one by one while they are executed, so that the memory stays flat
+        def execute_stream() -> Iterator[dict]:
+            for name, response in stream_requests_against_api(
+                    ((path.name, load_request(path)) for path in pending_request_paths), cfg.api_name,
+                    budget=budget, ledger_path=ledger_path, trace_path=trace_path):
+                dump_json(response, responses_dir / name, atomic=True)
+                yield response
 
-    responses = execute_requests_against_api(requests, cfg.api_name)
+        responses = execute_stream()
+    else:
+        requests = [load_request(request_path) for request_path in pending_request_paths]
+        request_names = [request_path.name for request_path in pending_request_paths]  # sorting is not numerical
+
+        def on_response(index: int, response: dict) -> None:
+            dump_json(response, responses_dir / request_names[index], atomic=True)
+
+        stop_detector = None
+        if cfg.stream_until_list_complete:
+            # each request belongs to the instance of the same name, whose ground truth has one type per column
+            instances_dir = get_instances_dir(cfg.task_name, cfg.dataset.dataset_name, cfg.exp_name)
+            detectors = [
+                list_stop_detector(len(load_json(instances_dir / name.removesuffix(".json") / "column_types.json")),
+                                   **cfg.linearize_list)
+                for name in request_names
+            ]
+
+            def detect_list_end(index: int, text: str) -> int | None:
+                return detectors[index](text)
+
+            stop_detector = detect_list_end
+
+        responses = execute_requests_against_api(requests, cfg.api_name, mode=cfg.execute_mode,
+                                                 on_response=on_response, pin=cfg.pin_responses, budget=budget,
+                                                 ledger_path=ledger_path, trace_path=trace_path,
+                                                 order=cfg.execute_order, stop_detector=stop_detector,
+                                                 hedge_percentile=cfg.hedge_percentile, offline=cfg.offline)
 
     num_failed = 0
-    finish_reasons = collections.Counter()
     for response in responses:
         if "choices" in response.keys():
             finish_reasons[response["choices"][0]["finish_reason"]] += 1
@@ -43,8 +125,8 @@ def execute_requests(cfg: DictConfig) -> None:
     if num_failed > 0:
         logger.warning(f"{num_failed} requests failed!")
 
-    for response, request_name in zip(responses, request_names):
-        dump_json(response, responses_dir / request_name)
+    ledger = summarize_ledger(ledger_path)
+    logger.info(f"The experiment has spent ${ledger['cost']:.2f} on {ledger['num_requests']} executed requests.")
 
 
 if __name__ == "__main__":
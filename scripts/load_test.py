@@ -0,0 +1,109 @@
+import contextlib
+import json
+import logging
+import math
+import pathlib
+import tempfile
+
+import attrs
+import hydra
+import numpy as np
+from hydra.core.config_store import ConfigStore
+
+import lib.openai
+from lib.data import load_json
+from lib.linearize import list_stop_detector
+from lib.openai import Credential
+from lib.openai_mock import MockOpenAIServer
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    workload: str = ""  # JSONL file with one request (or Batch API line) per line or directory with request JSON files
+    num_requests: int | None = None
+    num_servers: int = 1
+    api_share: float = 1.0
+    latency: float = 0.5
+    latency_distribution: str = "lognormal"
+    rate_limit_error_rate: float = 0.0
+    server_error_rate: float = 0.0
+    retry_after: float | None = 1.0
+    content: str = "[]"
+    max_rpm: int | None = None
+    max_tpm: int | None = None
+    prompt_cache_min_tokens: int | None = None
+    token_latency: float = 0.0
+    order: str = "longest_first"
+    hedge_percentile: float | None = None
+    stream_until_list_complete: bool = False  # stream and stop once the generated content starts with a JSON list
+    trace: str | None = None  # JSONL file to which the trace of each request is appended
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+def load_workload(path: pathlib.Path) -> list[dict]:
+    if path.is_dir():
+        return [load_json(request_path) for request_path in sorted(path.glob("*.json"))]
+    requests = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip() != "":
+                request = json.loads(line)
+                requests.append(request["body"] if "body" in request.keys() else request)
+    return requests
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    requests = load_workload(pathlib.Path(hydra.utils.to_absolute_path(cfg.workload)))
+    if cfg.num_requests is not None:
+        requests = requests[:cfg.num_requests]
+
+    # execute against an empty cache so that every request is sent to the servers
+    lib.openai._cache_path = pathlib.Path(tempfile.mkdtemp()) / "openai_cache"
+    lib.openai._api_share = cfg.api_share
+
+    # each server stands in for one endpoint with its own API key and limits
+    with contextlib.ExitStack() as stack:
+        servers = [stack.enter_context(MockOpenAIServer(
+            latency=cfg.latency, latency_distribution=cfg.latency_distribution,
+            rate_limit_error_rate=cfg.rate_limit_error_rate, server_error_rate=cfg.server_error_rate,
+            retry_after=cfg.retry_after, content=cfg.content, max_rpm=cfg.max_rpm, max_tpm=cfg.max_tpm,
+            prompt_cache_min_tokens=cfg.prompt_cache_min_tokens, token_latency=cfg.token_latency, seed=742508314 + i
+        )) for i in range(cfg.num_servers)]
+        credentials = [Credential(server.base_url, f"mock-{i}") for i, server in enumerate(servers)]
+        trace_path = None if cfg.trace is None else pathlib.Path(hydra.utils.to_absolute_path(cfg.trace))
+        detect = list_stop_detector(None, mode="json_list", sep=",", strip=True)
+        stop_detector = (lambda index, text: detect(text)) if cfg.stream_until_list_complete else None
+        lib.openai.openai_execute(requests, force=math.inf, credentials=credentials, trace_path=trace_path,
+                                  order=cfg.order, stop_detector=stop_detector, hedge_percentile=cfg.hedge_percentile)
+        num_connections = sum(server.num_connections for server in servers)
+        num_generated_tokens = sum(server.num_generated_tokens for server in servers)
+
+    stats = lib.openai.openai_execution_stats()
+    p50, p95, p99 = np.percentile(stats["latencies"], [50, 95, 99]) if len(stats["latencies"]) > 0 else (0, 0, 0)
+    num_tokens = stats["prompt_tokens"] + stats["completion_tokens"]
+    logger.info(f"Executed {stats['num_requests']} requests ({stats['num_failed']} failed, {stats['num_retries']} "
+                f"retries, {stats['num_hedges']} hedges) over {num_connections} connections in "
+                f"{stats['wall_time']:.2f} seconds.")
+    logger.info(f"Throughput: {stats['num_requests'] / stats['wall_time']:.1f} requests/s, "
+                f"{num_tokens / stats['wall_time'] * 60:.0f} tokens/min")
+    if stats["cached_prompt_tokens"] > 0:
+        logger.info(f"Prompt cache: {stats['cached_prompt_tokens']} of {stats['prompt_tokens']} prompt tokens "
+                    f"({stats['cached_prompt_tokens'] / stats['prompt_tokens']:.1%})")
+    logger.info(f"Latency: p50 {p50:.3f} s, p95 {p95:.3f} s, p99 {p99:.3f} s")
+    logger.info(f"The servers generated {num_generated_tokens} tokens.")
+    logger.info(f"Final limit of requests in flight: {stats['in_flight_limit']:.0f}")
+    blocked = lib.openai.openai_metrics().samples("openai_blocked_seconds_total")
+    if len(blocked) > 0:
+        logger.info("Time requests waited for limiters: " + ", ".join(
+            f"{dict(labels)['limiter']} {seconds:.1f} s" for labels, seconds in sorted(blocked.items())))
+    logger.info(f"Scheduler CPU time: {stats['cpu_time']:.2f} s "
+                f"({stats['cpu_time'] / max(stats['num_requests'], 1) * 1000:.3f} ms per request)")
+
+
+if __name__ == "__main__":
+    main()
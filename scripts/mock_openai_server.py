@@ -0,0 +1,53 @@
+import logging
+import time
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+from lib.openai_mock import MockOpenAIServer
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    host: str = "127.0.0.1"
+    port: int = 8000
+    latency: float = 0.0
+    latency_distribution: str = "constant"
+    rate_limit_error_rate: float = 0.0
+    server_error_rate: float = 0.0
+    retry_after: float | None = 1.0
+    content: str = "[]"
+    max_rpm: int | None = None
+    max_tpm: int | None = None
+    api_key: str | None = None
+    prompt_cache_min_tokens: int | None = None
+    token_latency: float = 0.0
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    # run experiments against the server with OPENAI_BASE_URL=http://<host>:<port>/v1 and any OPENAI_API_KEY (unless
+    # api_key is set) or list the server in the file given by OPENAI_CREDENTIALS_PATH
+    with MockOpenAIServer(host=cfg.host, port=cfg.port, latency=cfg.latency,
+                          latency_distribution=cfg.latency_distribution,
+                          rate_limit_error_rate=cfg.rate_limit_error_rate, server_error_rate=cfg.server_error_rate,
+                          retry_after=cfg.retry_after, content=cfg.content,
+                          max_rpm=cfg.max_rpm, max_tpm=cfg.max_tpm, api_key=cfg.api_key,
+                          prompt_cache_min_tokens=cfg.prompt_cache_min_tokens,
+                          token_latency=cfg.token_latency) as server:
+        logger.info(f"Serving on {server.base_url}, press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info(f"Served {server.num_requests} requests over {server.num_connections} connections.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import logging
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+import lib.openai
+from lib.cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    max_entries: int | None = None
+    max_bytes: int | None = None
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    cache = ResponseCache(lib.openai._cache_path, max_entries=cfg.max_entries, max_bytes=cfg.max_bytes)
+    cache.evict()
+    cache.compact()
+    logger.info(f"The cache contains {len(cache)} pairs.")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import logging
+import pathlib
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+import lib.openai
+from lib.cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    target: str = "data/openai_cache_export"
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    # write one `<timestamp>-<hash>.json` file per pair, e.g., to create `openai_cache.zip` for reproduction
+    cache = ResponseCache(lib.openai._cache_path)
+    num_exported = cache.export_files(pathlib.Path(cfg.target))
+    logger.info(f"Exported {num_exported} pairs to '{cfg.target}'.")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import logging
+import os
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+import lib.cache
+import lib.openai
+from lib.cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    storage: str | None = None  # layout of the re-keyed pairs, defaults to the current layout of the cache
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    # store the pairs under the canonical request hash, pairs under the old hash are still found without migrating
+    storage = cfg.storage
+    if storage is None:
+        # keep an unpacked `openai_cache.zip` unpacked, moving the pairs into segments is up to pack.py
+        file_names = os.listdir(lib.openai._cache_path) if lib.openai._cache_path.is_dir() else []
+        is_unpacked = any(lib.cache._cache_file_name_pattern.match(file_name) for file_name in file_names)
+        storage = "files" if is_unpacked else "segments"
+    cache = ResponseCache(lib.openai._cache_path, storage=storage)
+    num_rekeyed = cache.rekey(lambda pair: lib.openai._hash_request(pair["request"]))
+    logger.info(f"Re-keyed {num_rekeyed} of {len(cache)} pairs.")
+    cache.compact()
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import logging
+import pathlib
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+import lib.openai
+from lib.cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    source: str | None = None  # directory with `<timestamp>-<hash>.json` files, defaults to the cache directory itself
+    remove: bool = True
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    # move the pairs of an unpacked `openai_cache.zip` into compressed segments
+    cache = ResponseCache(lib.openai._cache_path, storage="segments")
+    source = lib.openai._cache_path if cfg.source is None else pathlib.Path(cfg.source)
+    num_imported = cache.import_files(source, remove=cfg.remove)
+    logger.info(f"Imported {num_imported} pairs from '{source}'.")
+    cache.compact()
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import logging
+import pathlib
+import time
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+import lib.openai
+from lib.cache_server import ResponseCacheServer
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    path: str | None = None  # defaults to the local cache of the API helpers
+    host: str = "127.0.0.1"  # e.g., 0.0.0.0 to serve the other nodes of a trusted network
+    port: int = 8100
+    max_entries: int | None = None
+    max_bytes: int | None = None
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    # run experiments on each node with OPENAI_CACHE_URL=http://<host>:<port>
+    path = lib.openai._cache_path if cfg.path is None else pathlib.Path(hydra.utils.to_absolute_path(cfg.path))
+    with ResponseCacheServer(path, host=cfg.host, port=cfg.port, max_entries=cfg.max_entries,
+                             max_bytes=cfg.max_bytes, storage=lib.openai._cache_storage) as server:
+        logger.info(f"Serving on {server.url}, press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info(f"Served {server.num_requests} requests.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import logging
+import pathlib
+
+import attrs
+import hydra
+from hydra.core.config_store import ConfigStore
+
+import lib.openai
+from lib.data import load_json
+from lib.scheduling import simulate_makespan
+
+logger = logging.getLogger(__name__)
+
+
+@attrs.define
+class Config:
+    requests_dir: str = ""  # directory with request JSON files, e.g., the `requests` directory of an experiment
+    api_share: float | None = None  # defaults to the share of the executor
+    num_credentials: int = 1  # each credential has its own limits
+    latency: float = 5.0  # seconds per request
+    completion_ratio: float = 1.0  # share of the maximum completion tokens that the responses actually use
+    max_in_flight: int | None = None  # defaults to the maximum of the executor
+
+
+ConfigStore.instance().store(name="config", node=Config)
+
+
+@hydra.main(version_base=None, config_name="config")
+def main(cfg: Config) -> None:
+    requests_dir = pathlib.Path(hydra.utils.to_absolute_path(cfg.requests_dir))
+    requests = [lib.openai._Request(load_json(path)) for path in sorted(requests_dir.glob("*.json"))]
+    if len(requests) == 0:
+        raise AssertionError(f"There are no requests in '{requests_dir}'!")
+
+    api_share = lib.openai._api_share if cfg.api_share is None else cfg.api_share
+    limits = {}
+    for model in set(request.model for request in requests):
+        model_params = lib.openai._get_model_params(model)
+        limits[model] = (model_params["max_rpm"] * api_share * cfg.num_credentials,
+                         model_params["max_tpm"] * api_share * cfg.num_credentials)
+
+    # the executor charges the maximum usage of a request and corrects it once the actual usage is known
+    items = []
+    for request in requests:
+        actual_usage = request.estimate_input_usage() + int(request.estimate_max_output_usage() * cfg.completion_ratio)
+        items.append((request.model, request.estimate_max_total_usage(), actual_usage))
+    items.sort(key=lambda item: item[1], reverse=True)
+
+    max_in_flight = lib.openai._max_in_flight if cfg.max_in_flight is None else cfg.max_in_flight
+    logger.info(f"Simulate {len(items)} requests with {sum(item[2] for item in items)} tokens.")
+    for order, window in [("longest_first", 1), ("packed", lib.openai._lookahead_window)]:
+        result = simulate_makespan(items, limits, latency=cfg.latency, max_in_flight=max_in_flight, window=window,
+                                   max_skips=lib.openai._max_lookahead_skips)
+        logger.info(f"Order `{order}`: projected makespan of {result['makespan'] / 60:.1f} minutes at "
+                    f"{result['tokens_per_minute']:,.0f} tokens per minute, "
+                    f"{result['mean_wait_time']:.1f} seconds of mean wait for admission.")
+
+
+if __name__ == "__main__":
+    main()
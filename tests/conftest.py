@@ -0,0 +1,55 @@
+import pytest
+
+import lib.openai
+import lib.tokens
+from lib.openai_mock import MockOpenAIServer
+from lib.retry import RetryPolicy
+
+
+@pytest.fixture(autouse=True)
+def isolated_api_helpers(tmp_path, monkeypatch):
+    """Give each test a fresh response cache, token counter, and rate limiters, and retry without long delays."""
+    monkeypatch.delenv(lib.openai._credentials_path_variable, raising=False)
+    monkeypatch.delenv(lib.openai._cache_url_variable, raising=False)
+    monkeypatch.setattr(lib.openai, "_cache_path", tmp_path / "openai_cache")
+    monkeypatch.setattr(lib.openai, "_cache", None)
+    monkeypatch.setattr(lib.openai, "_rate_limiters", {})
+    monkeypatch.setattr(lib.openai, "_rate_limiter_credentials", {})
+    monkeypatch.setattr(lib.openai, "_retry_policy", RetryPolicy(max_attempts=6, base_delay=0.01, max_delay=0.05))
+    monkeypatch.setattr(lib.tokens, "_token_counter", lib.tokens.TokenCounter(None))
+
+
+@pytest.fixture
+def start_server(monkeypatch):
+    """Start mock OpenAI servers, the last of which the API helpers send their requests to."""
+    servers = []
+
+    def start(**kwargs) -> MockOpenAIServer:
+        server = MockOpenAIServer(**kwargs)
+        server.start()
+        servers.append(server)
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def create_requests():
+    """Create distinct chat completion requests that pass the reproducibility checks."""
+    def create(num_requests: int, *, model: str = "gpt-4-0613", max_tokens: int = 16) -> list[dict]:
+        return [
+            {
+                "model": model,
+                "messages": [{"role": "user", "content": f"Request number {index}"}],
+                "temperature": 0,
+                "seed": 321164097,
+                "max_tokens": max_tokens
+            }
+            for index in range(num_requests)
+        ]
+
+    return create
@@ -0,0 +1,32 @@
+from lib.openai import openai_execute
+
+
+def test_identical_requests_are_sent_once(start_server, create_requests):
+    requests = create_requests(10)
+    server = start_server()
+    responses = openai_execute(requests * 3, force=1, silent=True)
+
+    assert server.num_requests == 10
+    assert all("choices" in response.keys() for response in responses)
+    assert responses[:10] == responses[10:20] == responses[20:]
+
+
+def test_cached_responses_are_replayed_without_requests(start_server, create_requests):
+    requests = create_requests(10)
+    start_server()
+    first_responses = openai_execute(requests, force=1, silent=True)
+
+    server = start_server()
+    responses = openai_execute(requests + requests[:5], force=1, silent=True)
+    assert server.num_requests == 0
+    assert responses == first_responses + first_responses[:5]
+
+
+def test_on_response_is_called_for_each_duplicate(start_server, create_requests):
+    requests = create_requests(3)
+    start_server()
+    called = []
+    responses = openai_execute(requests * 2, force=1, silent=True,
+                               on_response=lambda index, response: called.append((index, response)))
+
+    assert sorted(called, key=lambda c: c[0]) == list(enumerate(responses))
@@ -0,0 +1,35 @@
+import collections
+import json
+
+import pytest
+
+import lib.openai
+from lib.ledger import summarize_ledger
+from lib.openai import openai_execute, openai_execution_stats
+
+
+def test_slow_requests_are_hedged_and_billed_once(start_server, create_requests, tmp_path):
+    requests = create_requests(100)
+    start_server(latency=0.02, latency_distribution="pareto")
+    ledger_path = tmp_path / "ledger.jsonl"
+    responses = openai_execute(requests, force=1, silent=True, ledger_path=ledger_path, hedge_percentile=0.8)
+
+    assert all("choices" in response.keys() for response in responses)
+    stats = openai_execution_stats()
+    assert stats["num_hedges"] > 0
+
+    # each request is recorded once, and each duplicate that was sent is recorded as a hedge
+    with open(ledger_path, "r", encoding="utf-8") as file:
+        entries = [json.loads(line) for line in file]
+    sync_hashes = collections.Counter(entry["hash"] for entry in entries if entry["mode"] == "sync")
+    assert len(sync_hashes) == 100 and set(sync_hashes.values()) == {1}
+    assert sum(entry["mode"] == "hedge" for entry in entries) == stats["num_hedges"]
+    assert summarize_ledger(ledger_path)["cost"] == pytest.approx(stats["cost"])
+
+
+def test_requests_are_not_hedged_before_the_latency_percentile_is_known(start_server, create_requests):
+    server = start_server(latency=0.02, latency_distribution="pareto")
+    openai_execute(create_requests(lib.openai._hedge_min_samples - 1), force=1, silent=True, hedge_percentile=0.5)
+
+    assert openai_execution_stats()["num_hedges"] == 0
+    assert server.num_requests == lib.openai._hedge_min_samples - 1
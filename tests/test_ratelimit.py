@@ -0,0 +1,40 @@
+import pytest
+
+import lib.openai
+from lib.openai import openai_execute, openai_execution_stats, openai_rate_limits
+from lib.ratelimit import AdaptiveConcurrency
+
+
+def test_limits_adapt_to_the_rate_limit_headers(start_server, create_requests):
+    start_server(max_rpm=600, max_tpm=200_000)
+    responses = openai_execute(create_requests(20), force=1, silent=True)
+
+    assert all("choices" in response.keys() for response in responses)
+    (limits,) = openai_rate_limits().values()  # of the only credential
+    assert limits["gpt-4-0613"]["requests"]["capacity"] == 600
+    assert limits["gpt-4-0613"]["tokens"]["capacity"] == 200_000
+
+
+def test_requests_in_flight_back_off_on_rate_limit_errors(start_server, create_requests):
+    start_server(rate_limit_error_rate=0.5, retry_after=0.01)
+    openai_execute(create_requests(40), force=1, silent=True)
+
+    assert openai_execution_stats()["in_flight_limit"] < lib.openai._initial_in_flight
+
+
+def test_concurrency_increases_additively_and_decreases_multiplicatively():
+    concurrency = AdaptiveConcurrency(10, minimum=2, maximum=11, cooldown=1.0)
+    for _ in range(10):
+        concurrency.on_success()
+    assert concurrency.limit == pytest.approx(10.95, abs=0.01)
+    for _ in range(10):
+        concurrency.on_success()
+    assert concurrency.limit == 11
+
+    concurrency.on_overload(now=100.0)
+    assert concurrency.limit == 5.5
+    concurrency.on_overload(now=100.5)  # within the cooldown
+    assert concurrency.limit == 5.5
+    concurrency.on_overload(now=101.5)
+    concurrency.on_overload(now=103.0)
+    assert concurrency.limit == 2
@@ -0,0 +1,39 @@
+import lib.openai
+from lib.openai import openai_execute
+
+
+def test_transient_errors_are_retried(start_server, create_requests):
+    server = start_server(rate_limit_error_rate=0.1, server_error_rate=0.1, retry_after=0.01)
+    responses = openai_execute(create_requests(30), force=1, silent=True)
+
+    assert all("choices" in response.keys() for response in responses)
+    assert server.num_errors > 0
+    assert server.num_requests == 30 + server.num_errors
+
+
+def test_attempts_per_request_are_limited(start_server, create_requests):
+    server = start_server(server_error_rate=1.0)
+    (response,) = openai_execute(create_requests(1), force=1, silent=True)
+
+    assert "error" in response.keys()
+    assert server.num_requests == lib.openai._retry_policy.max_attempts
+
+
+def test_retry_budget_is_shared_by_the_requests_of_a_run(start_server, create_requests, monkeypatch):
+    monkeypatch.setattr(lib.openai, "_min_retry_budget", 3)
+    server = start_server(server_error_rate=1.0)
+    responses = openai_execute(create_requests(5), force=1, silent=True)
+
+    assert all("error" in response.keys() for response in responses)
+    assert server.num_requests == 5 + 3
+
+
+def test_failed_responses_are_not_cached(start_server, create_requests):
+    requests = create_requests(1)
+    start_server(server_error_rate=1.0)
+    openai_execute(requests, force=1, silent=True)
+
+    server = start_server()
+    (response,) = openai_execute(requests, force=1, silent=True)
+    assert "choices" in response.keys()
+    assert server.num_requests == 1